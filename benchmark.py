@@ -0,0 +1,159 @@
+"""Python command-line script for benchmarking the scripts in this repository offline.
+ A local stand-in for the CKAN action API (see mock_ckan.py) is started in a
+ separate process, serving a synthetic catalog of the requested size and
+ hierarchy depth, with an optional delay on every request. The core function
+ of each script is then run against it for a number of iterations, and the
+ median and 95th percentile run times, the request throughput and the peak
+ memory allocated by each function are reported.
+
+ Because the catalog and latency are fixed, the results can be compared
+ between versions of the code to spot performance regressions, without
+ touching a production CKAN instance.
+
+ Example: benchmark the full-catalog scans against 10,000 datasets with 20 ms
+ of latency, running each five times.
+
+     python benchmark.py --datasets 10000 --latency 0.02 --iterations 5 \\
+       sum_resource_size retrieve_metadata
+
+ """
+import argparse
+import json
+import logging
+import math
+import os
+import time
+import tracemalloc
+
+import datasize
+import hierarchy_search_compare
+import package_search
+import retrieve_all_metadata
+import transport
+from mock_ckan import MockCKAN
+
+
+def percentile(values, fraction):
+    """Return the value at the passed fraction of the sorted values, using the
+     nearest-rank method.
+    """
+    ordered = sorted(values)
+    rank = max(1, math.ceil(fraction * len(ordered)))
+    return ordered[rank - 1]
+
+
+def get_benchmarks(args, deepest):
+    """Return the benchmarks to run, as a dictionary of functions taking a
+     connection to the mock CKAN instance.
+    """
+    return {
+        'sum_resource_size': lambda connection: datasize.sum_resource_size(
+            connection, 5, None, args.workers, args.per_host),
+        'retrieve_metadata': lambda connection: retrieve_all_metadata.retrieve_metadata(
+            connection),
+        'get_hierarchy_show': lambda connection: hierarchy_search_compare.get_hierarchy_show(
+            connection, {'id': deepest}),
+        'get_hierarchy_search': lambda connection: hierarchy_search_compare.get_hierarchy_search(
+            connection, {'id': deepest}),
+        'do_package_search': lambda connection: package_search.do_package_search(
+            connection, 'extras_data_quality:false', ['id', 'name', 'title']),
+    }
+
+
+def run_benchmark(mock, connection, function, iterations, warmup):
+    """Run a benchmark function repeatedly, returning its timing, request and
+     memory statistics.
+    """
+    for i in range(warmup):
+        function(connection)
+
+    timings = []
+    before = sum(mock.stats().values())
+    for i in range(iterations):
+        start = time.perf_counter()
+        function(connection)
+        timings.append(time.perf_counter() - start)
+    requests = sum(mock.stats().values()) - before
+
+    # Memory is measured in a separate run, since tracing allocations slows
+    # the code down.
+    tracemalloc.start()
+    function(connection)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    total = sum(timings)
+    return {
+        'iterations': iterations,
+        'p50_seconds': percentile(timings, 0.50),
+        'p95_seconds': percentile(timings, 0.95),
+        'mean_seconds': total / iterations,
+        'requests_per_iteration': requests / iterations,
+        'requests_per_second': requests / total if total else 0.0,
+        'peak_memory_bytes': peak,
+    }
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.WARNING))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Benchmark the scripts in this repository against a local mock CKAN instance.
+''')
+    ap.add_argument('benchmarks', nargs='*',
+        help='The names of the benchmarks to run. All benchmarks are run if none are named.')
+    ap.add_argument('-d', '--datasets', dest='datasets', default=2000, type=int,
+        help='The number of datasets in the synthetic catalog.')
+    ap.add_argument('-r', '--resources', dest='resources', default=2, type=int,
+        help='The number of resources in each dataset.')
+    ap.add_argument('--depth', dest='depth', default=3, type=int,
+        help='The depth of the collection hierarchy.')
+    ap.add_argument('--fanout', dest='fanout', default=3, type=int,
+        help='The number of children of each collection in the hierarchy.')
+    ap.add_argument('--payload-bytes', dest='payload_bytes', default=0, type=int,
+        help='The number of padding bytes added to each dataset.')
+    ap.add_argument('--file-size', dest='file_size', default=64*1024, type=int,
+        help='The size in bytes of each data file.')
+    ap.add_argument('-l', '--latency', dest='latency', default=0.0, type=float,
+        help='The number of seconds the mock instance waits before answering each request.')
+    ap.add_argument('-n', '--iterations', dest='iterations', default=5, type=int,
+        help='The number of timed runs of each benchmark.')
+    ap.add_argument('--warmup', dest='warmup', default=1, type=int,
+        help='The number of untimed runs of each benchmark before the timed runs.')
+    ap.add_argument('-w', '--workers', dest='workers', default=1, type=int,
+        help='The number of URLs probed at the same time by sum_resource_size.')
+    ap.add_argument('--per-host', dest='per_host', default=2, type=int,
+        help='The number of URLs probed at the same time on one host by sum_resource_size.')
+    ap.add_argument('-o', '--output', dest='output', default=None,
+        help='A file for writing the results as JSON, for comparison between runs.')
+    args = ap.parse_args()
+
+    with MockCKAN(latency=args.latency, datasets=args.datasets,
+                  resources=args.resources, depth=args.depth, fanout=args.fanout,
+                  payload_bytes=args.payload_bytes, file_size=args.file_size) as mock:
+        connection = transport.remote_ckan(mock.url)
+
+        # Use the last dataset in the hierarchy, so the whole walk up to the
+        # top and back down is measured.
+        tree_size = min(args.datasets,
+                        sum(args.fanout ** level for level in range(args.depth + 1)))
+        benchmarks = get_benchmarks(args, f'dataset-{tree_size - 1}')
+        names = args.benchmarks or list(benchmarks)
+
+        results = {}
+        print(f'{"benchmark":<22} {"p50 s":>9} {"p95 s":>9} {"req/run":>9} {"req/s":>9} {"peak MB":>9}')
+        for name in names:
+            if name not in benchmarks:
+                logging.error('Unknown benchmark %s. Choose from %s.', name, ', '.join(benchmarks))
+                continue
+            result = run_benchmark(mock, connection, benchmarks[name],
+                                   args.iterations, args.warmup)
+            results[name] = result
+            print(f'{name:<22} {result["p50_seconds"]:>9.3f} {result["p95_seconds"]:>9.3f} '
+                  f'{result["requests_per_iteration"]:>9.0f} {result["requests_per_second"]:>9.1f} '
+                  f'{result["peak_memory_bytes"] / 1e6:>9.1f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as output_file:
+            json.dump({'parameters': vars(args), 'results': results}, output_file, indent=2)
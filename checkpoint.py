@@ -0,0 +1,65 @@
+"""Checkpoints for resuming long catalog scans.
+ A scan periodically saves its progress (the offset reached in the catalog
+ listing and whatever it has gathered so far) to a small JSON file. If the
+ scan stops early, the next run can load the checkpoint and continue from
+ that offset instead of starting again from the beginning. The file is
+ written to a temporary name and moved into place, so a checkpoint is never
+ left half written. Checkpoints are removed once the scan completes.
+
+ Offsets in the catalog listing shift if datasets are added or removed
+ between runs, so resuming is meant for picking up a scan that was
+ interrupted, not for runs days apart.
+
+ """
+import json
+import logging
+import os
+import time
+
+DEFAULT_INTERVAL = 60
+
+
+class Checkpoint:
+    """Progress of a scan, saved to a JSON file at most once per interval.
+    """
+
+    def __init__(self, path, interval=DEFAULT_INTERVAL, context=None):
+        self.path = path
+        self.interval = interval
+        self.context = context
+        self._saved = time.monotonic()
+
+    def load(self):
+        """Return the saved state, or None if there is no checkpoint. Raises
+         ValueError if the checkpoint was saved for a different context, such
+         as a different input file.
+        """
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, 'r') as checkpoint_file:
+            state = json.load(checkpoint_file)
+        if state.get('context') != self.context:
+            raise ValueError(f'The checkpoint {self.path} was saved for {state.get("context")}, '
+                             f'not {self.context}.')
+        logging.info('Loaded checkpoint %s', self.path)
+        return state
+
+    def due(self):
+        """Check whether the interval has passed since the last save.
+        """
+        return time.monotonic() - self._saved >= self.interval
+
+    def save(self, state):
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as checkpoint_file:
+            json.dump(dict(state, context=self.context), checkpoint_file)
+        os.replace(temp_path, self.path)
+        self._saved = time.monotonic()
+        logging.debug('Saved checkpoint %s', self.path)
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
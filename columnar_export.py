@@ -0,0 +1,240 @@
+"""Python command-line script for exporting flattened CKAN metadata in a columnar format.
+ The datasets in a snapshot written by retrieve_all_metadata.py (either the
+ indented JSON document or newline-delimited JSON) are written as a Parquet
+ file, so reports can read just the columns they need. If pyarrow is not
+ installed, or the output file name ends in ".csv", a CSV file is written
+ instead.
+
+ The columns are derived from the dataset and license classes of the catalog
+ model in catalog.md, followed by the columns unravel_metadata adds for the owner
+ organization, tags and groups. The schema is the same for every export,
+ whichever fields the datasets happen to have: missing fields are left
+ empty, and fields that are not in the model are left out. The tag and group
+ lists are stored as list columns in Parquet, and as JSON arrays in CSV.
+
+ Datasets are converted and written in batches, so memory use depends on the
+ batch size rather than the size of the catalog.
+
+ Example: convert a compressed NDJSON snapshot to Parquet.
+
+     python columnar_export.py catalog.ndjson.gz catalog.parquet
+
+ """
+import argparse
+import csv
+import json
+import logging
+import os
+import re
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+import dcat_stream
+import ndjson
+
+_DEFAULT_MODEL = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'catalog.md')
+
+_DEFAULT_BATCH_SIZE = 10000
+
+# Columns added by unravel_metadata, which are not part of the catalog model.
+_DERIVED_COLUMNS = [
+    ('org_id', 'String', False),
+    ('org_name', 'String', False),
+    ('taglist', 'String', True),
+    ('grouplist', 'String', True),
+]
+
+_FIELD = re.compile(r'^\s*(\w+)\s+([\w@\-]+)')
+
+
+def _class_fields(model_file_name, class_name):
+    # Read the (name, type) fields of a class in the mermaid class diagram.
+    fields = []
+    in_class = False
+    with open(model_file_name, 'r') as model_file:
+        for line in model_file:
+            stripped = line.strip()
+            if not in_class:
+                if re.match(rf'^class\s+{re.escape(class_name)}\s*\{{', stripped):
+                    in_class = True
+                continue
+            if stripped.startswith('}'):
+                break
+            field = _FIELD.match(stripped)
+            if field:
+                fields.append((field.group(2), field.group(1)))
+    return fields
+
+
+def load_schema(model_file_name=_DEFAULT_MODEL, class_name='dataset', embedded=('license',)):
+    """Read the columns for a class of the catalog model, returning a list of
+     (name, type, is_list) columns in the order they are listed. The fields of
+     the embedded classes, which CKAN stores on the dataset itself, follow,
+     and then the columns added by unravel_metadata.
+    """
+    columns = []
+    for name in (class_name,) + tuple(embedded):
+        columns.extend((field, type, False) for field, type in _class_fields(model_file_name, name))
+    names = {name for name, type, is_list in columns}
+    return columns + [column for column in _DERIVED_COLUMNS if column[0] not in names]
+
+
+def _convert(value, type):
+    # Convert a metadata value to the column type, leaving values that do not
+    # convert cleanly empty.
+    if value is None or value == '':
+        return None
+    try:
+        if type == 'Boolean':
+            if isinstance(value, str):
+                return {'true': True, 'false': False}.get(value.strip().lower())
+            return bool(value)
+        if type == 'Integer':
+            return int(value)
+        if type == 'Timestamp':
+            return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=None)
+    except (TypeError, ValueError):
+        return None
+    if isinstance(value, (dict, list)):
+        return json.dumps(value)
+    return str(value)
+
+
+def _arrow_type(type, is_list):
+    # Dates are kept as text, since DCAT-US dates may be partial dates or ranges.
+    base = {'Boolean': pyarrow.bool_(),
+            'Integer': pyarrow.int64(),
+            'Timestamp': pyarrow.timestamp('us')}.get(type, pyarrow.string())
+    return pyarrow.list_(base) if is_list else base
+
+
+def arrow_schema(schema):
+    """Return the pyarrow schema for a list of (name, type, is_list) columns.
+    """
+    return pyarrow.schema([(name, _arrow_type(type, is_list)) for name, type, is_list in schema])
+
+
+def _batches(datasets, batch_size):
+    batch = []
+    for dataset in datasets:
+        batch.append(dataset)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _columns(batch, schema):
+    # Build one list of converted values per column for a batch of datasets.
+    columns = {}
+    for name, type, is_list in schema:
+        if is_list:
+            columns[name] = [None if dataset.get(name) is None else
+                             [_convert(item, type) for item in dataset[name]]
+                             for dataset in batch]
+        else:
+            columns[name] = [_convert(dataset.get(name), type) for dataset in batch]
+    return columns
+
+
+def write_parquet(datasets, output_file_name, schema, batch_size=_DEFAULT_BATCH_SIZE):
+    """Write flattened datasets to a Parquet file, a batch at a time.
+    """
+    count = 0
+    table_schema = arrow_schema(schema)
+    with pyarrow.parquet.ParquetWriter(output_file_name, table_schema) as writer:
+        for batch in _batches(datasets, batch_size):
+            columns = _columns(batch, schema)
+            writer.write_batch(pyarrow.record_batch(
+                [pyarrow.array(columns[name], type=table_schema.field(name).type)
+                 for name, type, is_list in schema],
+                schema=table_schema))
+            count += len(batch)
+    return count
+
+
+def write_csv(datasets, output_file_name, schema, batch_size=_DEFAULT_BATCH_SIZE):
+    """Write flattened datasets to a CSV file, a batch at a time. List columns
+     are written as JSON arrays.
+    """
+    count = 0
+    names = [name for name, type, is_list in schema]
+    with open(output_file_name, 'w', newline='', encoding='utf-8') as output_file:
+        writer = csv.writer(output_file)
+        writer.writerow(names)
+        for batch in _batches(datasets, batch_size):
+            columns = _columns(batch, schema)
+            for name, type, is_list in schema:
+                if is_list:
+                    columns[name] = [None if value is None else json.dumps(value)
+                                     for value in columns[name]]
+                elif type == 'Timestamp':
+                    columns[name] = [None if value is None else value.isoformat()
+                                     for value in columns[name]]
+            writer.writerows(zip(*[columns[name] for name in names]))
+            count += len(batch)
+    return count
+
+
+def write_columnar(datasets, output_file_name, schema=None, batch_size=_DEFAULT_BATCH_SIZE):
+    """Write flattened datasets as Parquet, or as CSV if the file name ends in
+     ".csv" or pyarrow is not installed. Returns the name of the file written.
+    """
+    if schema is None:
+        schema = load_schema()
+    if output_file_name.endswith('.csv'):
+        count = write_csv(datasets, output_file_name, schema, batch_size)
+    elif pyarrow is None:
+        output_file_name = re.sub(r'\.parquet$', '', output_file_name) + '.csv'
+        logging.warning('pyarrow is not installed. Writing CSV to %s instead of Parquet.',
+                        output_file_name)
+        count = write_csv(datasets, output_file_name, schema, batch_size)
+    else:
+        count = write_parquet(datasets, output_file_name, schema, batch_size)
+    logging.info('Wrote %d datasets to %s', count, output_file_name)
+    return output_file_name
+
+
+def read_snapshot(input_file_name):
+    """Yield the datasets in a snapshot written by retrieve_all_metadata.py,
+     in either the indented JSON or newline-delimited JSON format.
+    """
+    with ndjson.open_input(input_file_name) as input_file:
+        first = input_file.read(1)
+        while first.isspace():
+            first = input_file.read(1)
+    if first == '[':
+        # The indented JSON format is decoded one dataset at a time.
+        with ndjson.open_input(input_file_name) as input_file:
+            for dataset in dcat_stream.iter_array(input_file):
+                yield dataset
+        return
+    for dataset in ndjson.read_records(input_file_name):
+        yield dataset
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Export the flattened datasets in a metadata snapshot as Parquet or CSV.
+''')
+    ap.add_argument('input_file_name',
+        help='The snapshot written by retrieve_all_metadata.py, as JSON or newline-delimited JSON.')
+    ap.add_argument('output_file_name',
+        help='The Parquet file to write, or a CSV file if the name ends in ".csv".')
+    ap.add_argument('-m', '--model', dest='model', default=_DEFAULT_MODEL,
+        help='The catalog model to derive the columns from.')
+    ap.add_argument('-b', '--batch-size', dest='batch_size', default=_DEFAULT_BATCH_SIZE, type=int,
+        help='The number of datasets to convert and write at a time.')
+    args = ap.parse_args()
+
+    write_columnar(read_snapshot(args.input_file_name), args.output_file_name,
+                   load_schema(args.model), args.batch_size)
@@ -9,7 +9,10 @@ with data files listed in a JSON file, to identify potential duplicates.
  even URL. This script identifies data files that appear to have the
  same content, and thus warrant additional scrutiny.
  The JSON input file is assumed to be compliant with the DCAT-US schema
- version 1.1.
+ version 1.1. It is read incrementally, one dataset at a time, and only a
+ bounded number of its distributions are compared at once, with each match
+ printed as soon as it is found, so memory use does not grow with the size
+ of the file.
 
  The base URL for the API to use (without the trailing "/api/action" text)
  can be specified in an environment variable named 'CKAN_URL'. The value for the
@@ -19,71 +22,487 @@ with data files listed in a JSON file, to identify potential duplicates.
  variable named 'CKAN_KEY'. The value for the API key will be prompted for input
  if the environment variable is not set.
 
- A single command line argument may be provided, naming the JSON file to
+ A command line argument may be provided, naming the JSON file to
  use for comparison. The file name will be prompted for input if not
  provided on the command line.
+
+ The digests of downloaded files are kept in an index file, along with the
+ validators returned by the server, so later runs only download files that
+ have changed. The same index can be used when comparing against different
+ JSON files.
+
+ Rather than downloading every file in full, files are first compared by
+ the size reported by the server, then by a digest of their first few
+ megabytes, and only files that match on both are downloaded in full.
+ When the server does not report the size of a file in response to a HEAD
+ request, the size is taken from the response to the request for its first
+ few megabytes instead.
+
+ Progress is saved to a checkpoint file every minute or so: first the
+ offset reached in the CKAN listing and the resources found so far, then
+ the distributions already compared and the matches found. If the run
+ stops early, running the script again with the --resume option prints the
+ matches already found and continues from the checkpoint.
+
+ With the --shard i/N option, only the resources of the CKAN datasets in the
+ i-th of N shards of the catalog pages are compared (see sharding.py), so
+ each CKAN data file is probed and hashed by one shard only, and the matches
+ are also written to a partial output file. Every shard compares all the
+ distributions in the JSON file against its resources. Running every shard,
+ with the same input file, and passing the partial output files to
+ merge_shards.py prints all the matches.
  
  """
+import argparse
 import getpass
 import hashlib
-import json
+import itertools
 import logging
 import os
-import requests
 import sys
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
-import ckanapi
+import dcat_stream
+import paginator
+import sharding
+import transport
+from checkpoint import Checkpoint, DEFAULT_INTERVAL
+from datasize import get_url_size
+from host_pool import HostLimitedPool
+from url_cache import UrlCache
 
-def get_hash(url):
+# The number of bytes at the start of each file compared before downloading
+# the whole file.
+_PREFIX_LENGTH = 4*1024*1024
+
+def get_hash(url, index=None):
+    """Retrieve the file at the passed URL and return a SHA-512 digest of its contents.
+     When an index is passed, a digest recorded within the index time-to-live
+     is returned without contacting the server. An older digest is checked
+     with a conditional request, so the file is only downloaded again if the
+     server reports it has changed.
+     Returns None if the file could not be retrieved.
+    """
     try:
+        cached = None
+        headers = {}
+        if index is not None:
+            cached = index.get(url)
+            if cached is not None and cached.get('digest') is not None:
+                if index.has_fresh_digest(cached):
+                    return cached['digest']
+                if cached.get('etag'):
+                    headers['If-None-Match'] = cached['etag']
+                if cached.get('last_modified'):
+                    headers['If-Modified-Since'] = cached['last_modified']
+            else:
+                cached = None
         # Initialize the hash object.
         hash = hashlib.sha512()
         # Retrieve the file at the passed URL as a stream, 
         # in case it is larger than will fit in memory.
-        response = requests.get(url, stream=True)
+        response = transport.get_session().get(url, stream=True, headers=headers)
+        if response.status_code == 304 and cached is not None:
+            response.close()
+            index.put_digest(url, cached['digest'], cached.get('content_length'),
+                             response.headers.get('etag', cached.get('etag')),
+                             response.headers.get('last-modified', cached.get('last_modified')))
+            return cached['digest']
+        response.raise_for_status()
         # Read the stream, using whatever chunk size is used in the 
         # network messages, updating the hash object for each one received.
         for buff in response.iter_content(chunk_size=None):
             if buff:
                 hash.update(buff)
-        return hash.digest()
+        digest = hash.digest()
+        if index is not None:
+            # Record the Content-Length header, as a size probe does, rather
+            # than the decoded size, so a later probe of the unchanged file
+            # keeps the digest.
+            content_length = response.headers.get('content-length', None)
+            index.put_digest(url, digest,
+                             int(content_length) if content_length is not None else None,
+                             response.headers.get('etag', None),
+                             response.headers.get('last-modified', None))
+        return digest
     except Exception as e:
         logging.error(e)
-        return null
+        return None
+
+
+def _total_size(response):
+    # Return the size of the whole file from the headers of a response to a
+    # Range request, or None if they do not give it.
+    if response.status_code == 206:
+        total = response.headers.get('content-range', '').rpartition('/')[2]
+    else:
+        total = response.headers.get('content-length', '')
+    return int(total) if total.isdigit() else None
 
 
-def get_resource_fingerprints(connection):
-    """Retrieve the metadata for all datasets in the connected CKAN repository.
+def get_prefix_hash(url, length, timeout=None):
+    """Return a SHA-512 digest of the first length bytes of the file at the
+     passed URL, along with the size of the whole file.
+     Only the prefix is requested, using a Range request, and the size is
+     taken from the Content-Range header of the response. Servers that ignore
+     the Range header send the whole file, so the download is abandoned once
+     the prefix has been read. When the size is not reported, the whole file
+     is read to count its length. For files no longer than the prefix, the
+     digest is the same as the digest of the entire file.
+     Returns (None, None) if the file could not be retrieved.
     """
-    metadata = {}
     try:
-        offset = 0
-        increment = 1000
-        while (True):
-            pass_data_dict = { "limit": increment, "offset": offset }
-            pass_result = connection.call_action(action='current_package_list_with_resources', data_dict=pass_data_dict)
-            if len(pass_result) == 0: break
-            offset += increment
-            # Iterate over the retrieved datasets.
-            for dataset in pass_result:
-                if ('type' in dataset and dataset['type'] == "dataset"):
-                    if 'resources' in dataset:
-                        for resource in dataset['resources']:
-                            if 'url' in resource:
-                                hash = get_hash(resource['url'])
-                                if hash:
-                                    metadata[hash] = {"title": dataset['name'], "dataset_id": dataset['id'],"resource_id": resource['id'], "url": resource['url']}
-
-            logging.info('Retrieving from offset %d', offset)
-        return metadata
+        hash = hashlib.sha512()
+        session = transport.get_session()
+        response = session.get(url, stream=True, timeout=timeout,
+                               headers={'Range': f'bytes=0-{length - 1}',
+                                        'Accept-Encoding': 'identity'})
+        response.raise_for_status()
+        size = _total_size(response)
+        remaining = length
+        read = 0
+        for buff in response.iter_content(chunk_size=64*1024):
+            read += len(buff)
+            if remaining > 0:
+                hash.update(buff[:remaining])
+                remaining -= len(buff)
+            if remaining <= 0 and size is not None:
+                break
+        response.close()
+        if size is None and (remaining > 0 or response.status_code != 206):
+            # The whole file has been read.
+            size = read
+        elif size is None:
+            response = session.get(url, stream=True, timeout=timeout,
+                                   headers={'Accept-Encoding': 'identity'})
+            response.raise_for_status()
+            size = sum(len(buff) for buff in response.iter_content(chunk_size=64*1024))
+            response.close()
+        return hash.digest(), size
     except Exception as e:
         logging.error(e)
-        return metadata
-    
-    
+        return None, None
+
+
+class TieredMatcher:
+    """Find reference data files with the same contents as other data files,
+     downloading as little as possible.
+     Files are compared in stages. First the sizes reported in the response
+     headers are compared, so files of different sizes are ruled out without
+     downloading anything. Files of the same size are then compared by a
+     digest of their first few megabytes, retrieved with a Range request.
+     Only the files that still match are downloaded in full and compared by
+     the digest of their entire contents. When a size probe does not report
+     the size, it is taken from the response to the prefix request. Files
+     whose size cannot be found that way either are counted in unsized.
+     All the requests run concurrently on a pool limiting the connections
+     to each host, and each result is computed at most once per URL.
+    """
+
+    def __init__(self, index=None, workers=8, per_host=2,
+                 prefix_length=_PREFIX_LENGTH, timeout=30):
+        self.index = index
+        self.prefix_length = prefix_length
+        self.timeout = timeout
+        self.workers = workers
+        self._pool = HostLimitedPool(workers, per_host)
+        self._lock = threading.Lock()
+        self._sizes = {}
+        self._prefixes = {}
+        self._digests = {}
+        self._references = {}
+        self._by_size = None
+        self.unsized = 0
+
+    def _memo(self, results, url, fn, *args):
+        with self._lock:
+            future = results.get(url)
+            if future is None:
+                future = self._pool.submit(url, fn, *args)
+                results[url] = future
+        return future
+
+    def size(self, url):
+        return self._memo(self._sizes, url, get_url_size, url, self.timeout, self.index)
+
+    def prefix(self, url):
+        return self._memo(self._prefixes, url, get_prefix_hash, url,
+                          self.prefix_length, self.timeout)
+
+    def digest(self, url):
+        return self._memo(self._digests, url, get_hash, url, self.index)
+
+    def file_size(self, url):
+        """Return the size of the file at the passed URL, from the size probe
+         or else from the prefix request, or None if neither gives it.
+        """
+        size = self.size(url).result()
+        if size is None:
+            size = self.prefix(url).result()[1]
+        return size
+
+    def add_references(self, references):
+        """Add (url, info) pairs for the reference data files, and start
+         retrieving their sizes.
+        """
+        for url, info in references:
+            self._references.setdefault(url, []).append(info)
+            self.size(url)
+        self._by_size = None
+
+    def _references_by_size(self):
+        with self._lock:
+            by_size = self._by_size
+        if by_size is None:
+            by_size = {}
+            unsized = 0
+            urls = list(self._references)
+            # Start the prefix requests for every file without a reported
+            # size before waiting for any of them.
+            for url in urls:
+                if self.size(url).result() is None:
+                    self.prefix(url)
+            for url in urls:
+                size = self.file_size(url)
+                if size is None:
+                    unsized += 1
+                else:
+                    by_size.setdefault(size, []).append(url)
+            if unsized:
+                logging.warning('Skipping %d reference files whose size could not be found',
+                                unsized)
+            with self._lock:
+                self._by_size = by_size
+        return by_size
+
+    def match(self, url):
+        """Return the info for each reference data file with the same contents
+         as the file at the passed URL.
+        """
+        by_size = self._references_by_size()
+        size = self.file_size(url)
+        if size is None:
+            logging.info('Skipping %s, whose size could not be found', url)
+            with self._lock:
+                self.unsized += 1
+            return []
+        candidates = by_size.get(size, [])
+        if not candidates:
+            return []
+
+        # Files no longer than the prefix are compared by their full digest
+        # straight away, since the prefix would be the whole file.
+        if size > self.prefix_length:
+            prefixes = [(c, self.prefix(c)) for c in candidates]
+            prefix = self.prefix(url).result()[0]
+            if prefix is None:
+                return []
+            candidates = [c for c, p in prefixes if p.result()[0] == prefix]
+            if not candidates:
+                return []
+
+        digests = [(c, self.digest(c)) for c in candidates]
+        digest = self.digest(url).result()
+        if digest is None:
+            return []
+        matches = []
+        for c, d in digests:
+            if d.result() == digest:
+                matches.extend(self._references[c])
+        return matches
+
+    def forget(self, url):
+        """Drop the results kept for a URL that is not a reference file, once
+         it has been compared.
+        """
+        with self._lock:
+            if url not in self._references:
+                self._sizes.pop(url, None)
+                self._prefixes.pop(url, None)
+                self._digests.pop(url, None)
+
+    def match_each(self, candidates, max_pending=None):
+        """Yield (url, info, references) for each of the passed (url, info)
+         candidate pairs, in the order the comparisons finish, with the info
+         of the reference files having the same contents.
+         Candidates are taken from the iterable as comparisons finish, with at
+         most max_pending (by default twice the number of workers) in progress,
+         so a long stream of candidates is never held in memory at once.
+        """
+        if max_pending is None:
+            max_pending = 2 * self.workers
+        candidates = iter(candidates)
+        pending = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            try:
+                while True:
+                    for url, info in itertools.islice(candidates, max_pending - len(pending)):
+                        pending[executor.submit(self.match, url)] = (url, info)
+                    if not pending:
+                        break
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        url, info = pending.pop(future)
+                        references = future.result()
+                        self.forget(url)
+                        yield url, info, references
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def match_all(self, candidates):
+        """Yield (candidate info, reference info) pairs for each of the passed
+         (url, info) candidate pairs with the same contents as a reference file,
+         in the order the matches are found.
+        """
+        for url, info, references in self.match_each(candidates):
+            for reference in references:
+                yield info, reference
+
+    def close(self):
+        self._pool.shutdown(wait=False)
+
+
+def get_resource_references(connection, page_size=paginator.DEFAULT_PAGE_SIZE,
+                            concurrency=paginator.DEFAULT_CONCURRENCY,
+                            checkpoint=None, state=None, shard=None):
+    """Retrieve the URL and identifying information for every resource of every
+     dataset in the connected CKAN repository, as a list of (url, info) pairs.
+     When a shard is passed, only the datasets in that shard of the catalog
+     pages are listed.
+     When a checkpoint is passed, the references gathered so far are saved to
+     it periodically, and if the listing fails, in which case the error is
+     raised rather than returning the partial list. A state loaded from the
+     checkpoint continues the listing where it stopped.
+    """
+    references = []
+    start = None
+    if state is not None:
+        references = [tuple(reference) for reference in state['references']]
+        start = state['offset']
+        logging.info('Resuming the resource listing from offset %d', start)
+    offset = paginator.first_offset(page_size, shard) if start is None else start
+
+    def save():
+        checkpoint.save({'phase': 'references', 'offset': offset, 'references': references})
+
+    try:
+        for page_offset, datasets in paginator.iter_package_pages(connection, page_size,
+                                                                  concurrency, start, shard):
+            logging.info('Retrieved %d datasets from offset %d', len(datasets), page_offset)
+            for dataset in datasets:
+                if dataset.get('type', None) != 'dataset':
+                    continue
+                for resource in dataset.get('resources', []):
+                    if resource.get('url'):
+                        references.append((resource['url'],
+                            {"title": dataset['name'], "dataset_id": dataset['id'],
+                             "resource_id": resource['id'], "url": resource['url']}))
+            offset = page_offset + paginator.page_stride(page_size, shard)
+            if checkpoint is not None and checkpoint.due():
+                save()
+    except Exception as e:
+        logging.error(e)
+        if checkpoint is not None:
+            save()
+            raise
+    return references
+
+
+def get_distribution_candidates(dcatus):
+    """List the download URL and identifying information for every distribution
+     in a DCAT-US catalog, as a list of (url, info) pairs.
+    """
+    candidates = []
+    for dataset in dcatus.get('dataset', []):
+        for distribution in dataset.get('distribution', []):
+            if distribution.get('downloadURL'):
+                candidates.append((distribution['downloadURL'],
+                    {"identifier": dataset.get('identifier'), "title": dataset.get('title'),
+                     "url": distribution['downloadURL']}))
+    return candidates
+
+
+def iter_distribution_candidates(input_file_name):
+    """Yield the download URL and identifying information for every
+     distribution in a DCAT-US catalog file, as (url, info) pairs, reading the
+     file incrementally.
+    """
+    for dataset, distribution in dcat_stream.iter_distributions(input_file_name):
+        if distribution.get('downloadURL'):
+            yield (distribution['downloadURL'],
+                   {"identifier": dataset.get('identifier'), "title": dataset.get('title'),
+                    "url": distribution['downloadURL']})
+
+
+class _Progress:
+    """Positions of the candidates already compared, kept as the position
+     below which every candidate is done, along with the positions past it
+     that are done too. Only the comparisons in progress leave gaps, so the
+     set stays small however many candidates there are.
+    """
+
+    def __init__(self, watermark=0, completed=()):
+        self.watermark = watermark
+        self.completed = set(completed)
+
+    def __contains__(self, position):
+        return position < self.watermark or position in self.completed
+
+    def add(self, position):
+        self.completed.add(position)
+        while self.watermark in self.completed:
+            self.completed.remove(self.watermark)
+            self.watermark += 1
+
+
 if __name__ == '__main__':
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Identify data files in a CKAN instance with the same contents as
+data files listed in a DCAT-US JSON file.
+''')
+    ap.add_argument('input_file_name', nargs='?', default=None,
+        help='The name of the DCAT-US JSON file to compare. The name will be prompted for '
+             'input if not provided.')
+    ap.add_argument('--page-size', dest='page_size', default=paginator.DEFAULT_PAGE_SIZE, type=int,
+        help='The number of datasets to request in each page of the catalog listing.')
+    ap.add_argument('--page-concurrency', dest='page_concurrency',
+        default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of catalog listing pages to request at the same time.')
+    ap.add_argument('-x', '--index', dest='index', default='fingerprints.sqlite',
+        help='The file for recording the digests of downloaded data files between runs.')
+    ap.add_argument('--index-ttl', dest='index_ttl', default=24, type=float,
+        help='The number of hours a recorded digest is used before checking whether the file '
+             'has changed.')
+    ap.add_argument('-w', '--workers', dest='workers', default=8, type=int,
+        help='The total number of data file requests to run at the same time.')
+    ap.add_argument('--per-host', dest='per_host', default=2, type=int,
+        help='The maximum number of data file requests to run at the same time on any one host.')
+    ap.add_argument('--prefix-mb', dest='prefix_mb', default=4, type=float,
+        help='The number of megabytes at the start of each file to compare before downloading '
+             'the whole file.')
+    ap.add_argument('--max-pending', dest='max_pending', default=None, type=int,
+        help='The maximum number of distributions being compared at the same time. Defaults to '
+             'twice the number of workers.')
+    ap.add_argument('--checkpoint', dest='checkpoint', default=None,
+        help='The file for saving the progress of the comparison. Defaults to '
+             'compare.checkpoint.json, or compare.shard-i-of-N.checkpoint.json with --shard.')
+    ap.add_argument('--checkpoint-interval', dest='checkpoint_interval',
+        default=DEFAULT_INTERVAL, type=float,
+        help='The number of seconds between saves of the progress of the comparison.')
+    ap.add_argument('--resume', dest='resume', action='store_true',
+        help='Continue the comparison from the saved progress of an earlier run.')
+    ap.add_argument('--shard', dest='shard', default=None, type=sharding.parse_shard,
+        help='Compare against only shard i of N of the CKAN catalog pages, given as i/N '
+             'with i from 0 to N - 1, and write the matches to a partial output file '
+             'for merge_shards.py.')
+    ap.add_argument('-o', '--partial-output', dest='partial_output', default=None,
+        help='The partial output file written with --shard. Defaults to compare.shard-i-of-N.json.')
+    args = ap.parse_args()
     
     # Retrieve the URL and API Key from environment variables, if set.
     url = os.getenv('CKAN_URL', None)
@@ -95,23 +514,82 @@ if __name__ == '__main__':
     if not api_key:
         api_key = getpass.getpass('Enter CKAN API key:')
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+    remote = transport.remote_ckan(url, api_key)
 
-    output_file_name = ''
-    if len(sys.argv) > 1:
-        input_file_name = sys.argv[1]
-    else:
+    input_file_name = args.input_file_name
+    if input_file_name is None:
         input_file_name = input('Enter name for JSON comparison file:')
 
-    with open(input_file_name, "rt") as input_file:
-        ckan_metadata = get_resource_fingerprints(remote)
-        dcatus = json.load(input_file)
-        print('CKAN dataset id, resource id, URL, JSON dataset id, URL, CKAN title, JSON title')
-        for dataset in dcatus['dataset']:
-            if 'distribution' in dataset:
-                for distribution in dataset['distribution']:
-                    if 'downloadURL' in distribution:
-                        dcathash = get_hash(distribution['downloadURL'])
-                        if dcathash and dcathash in ckan_metadata:
-                            match = ckan_metadata[dcathash]
-                            print(f"{match['datasetid']}, {match['resourceid']}, {match['url']}, {dataset['identifier']},{distribution['downloadURL']}, {match['title']},{dataset['title']}")
+    index = UrlCache(args.index, ttl=args.index_ttl*3600)
+
+    checkpoint_file_name = args.checkpoint
+    if checkpoint_file_name is None:
+        checkpoint_file_name = ('compare.checkpoint.json' if args.shard is None
+                                else f'compare.{sharding.shard_label(args.shard)}.checkpoint.json')
+    checkpoint = Checkpoint(checkpoint_file_name, args.checkpoint_interval,
+                            {'input_file_name': input_file_name,
+                             'shard': None if args.shard is None else list(args.shard)})
+    state = checkpoint.load() if args.resume else None
+
+    # Keep the references in the checkpoint, along with the comparisons
+    # finished and the matches found, so a resumed run skips both.
+    if state is not None and state['phase'] == 'matching':
+        references = [tuple(reference) for reference in state['references']]
+    else:
+        try:
+            references = get_resource_references(remote, args.page_size, args.page_concurrency,
+                                                 checkpoint, state, args.shard)
+        except Exception:
+            logging.error('Run again with --resume to continue from the saved progress.')
+            sys.exit(1)
+        state = None
+    # Distributions are identified by their position in the DCAT-US file.
+    progress = (_Progress(state['watermark'], state['completed']) if state is not None
+                else _Progress())
+    matches = state['matches'] if state is not None else []
+
+    def save():
+        checkpoint.save({'phase': 'matching', 'references': references,
+                         'watermark': progress.watermark, 'completed': sorted(progress.completed),
+                         'matches': matches})
+
+    matcher = TieredMatcher(index, args.workers, args.per_host,
+                            int(args.prefix_mb*1024*1024))
+    matcher.add_references(references)
+    print('CKAN dataset id, resource id, URL, JSON dataset id, URL, CKAN title, JSON title')
+    for line in matches:
+        print(line)
+    distributions = iter_distribution_candidates(input_file_name)
+    candidates = ((url, (position, info))
+                  for position, (url, info) in enumerate(distributions)
+                  if position not in progress)
+    try:
+        for url, (position, candidate), found in matcher.match_each(candidates, args.max_pending):
+            for match in found:
+                line = (f"{match['dataset_id']}, {match['resource_id']}, {match['url']}, "
+                        f"{candidate['identifier']},{candidate['url']}, "
+                        f"{match['title']},{candidate['title']}")
+                print(line, flush=True)
+                matches.append(line)
+            progress.add(position)
+            if checkpoint.due():
+                save()
+    except BaseException:
+        save()
+        raise
+    finally:
+        matcher.close()
+    checkpoint.remove()
+    if matcher.unsized:
+        logging.warning('Skipped %d distributions whose size could not be found',
+                        matcher.unsized)
+
+    if args.shard is not None:
+        partial_output = args.partial_output or f'compare.{sharding.shard_label(args.shard)}.json'
+        sharding.write_partial(partial_output, 'compare', args.shard,
+                               {'input_file_name': os.path.basename(input_file_name)},
+                               {'matches': matches})
+        logging.info('Wrote the matches in %s to %s', sharding.shard_label(args.shard),
+                     partial_output)
+
+    index.close()
@@ -0,0 +1,85 @@
+"""Persistent cache of Digital Analytics Program report data, partitioned by day.
+ The cache is a SQLite database with one partition for each agency, report
+ and date, holding every record of the report for that day.
+
+ The statistics for a day no longer change once the day is over, so
+ partitions for past days are kept forever and used without contacting the
+ API. The current day, which is still open, is never cached and is
+ retrieved again on every request. The number of open days can be raised
+ when the API is slow to settle a day's data.
+
+ """
+import json
+import sqlite3
+import threading
+import time
+from datetime import date, timedelta
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS partitions (
+    agency TEXT,
+    report TEXT,
+    date TEXT,
+    records TEXT,
+    fetched REAL,
+    PRIMARY KEY (agency, report, date)
+);
+'''
+
+
+class DapCache:
+    """On-disk cache of report records by agency, report and day, safe to
+     share between threads.
+    """
+
+    def __init__(self, path, open_days=1):
+        self.open_days = open_days
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.executescript(_SCHEMA)
+
+    def is_closed(self, day, today=None):
+        """Check whether a day, in YYYY-MM-DD format, is over, so its records
+         can be cached.
+        """
+        if today is None:
+            today = date.today()
+        return date.fromisoformat(day) <= today - timedelta(days=self.open_days)
+
+    def get(self, agency, report, days):
+        """Return the cached records for the passed days, as a dictionary of
+         record lists by day. Days that are not cached are left out.
+        """
+        partitions = {}
+        with self._lock:
+            for day in days:
+                row = self._db.execute('SELECT records FROM partitions '
+                                       'WHERE agency = ? AND report = ? AND date = ?',
+                                       (agency, report, day)).fetchone()
+                if row is not None:
+                    partitions[day] = json.loads(row[0])
+        return partitions
+
+    def put(self, agency, report, day, records):
+        """Record the complete list of records for a day, if the day is over.
+         Returns whether the records were cached.
+        """
+        if not self.is_closed(day):
+            return False
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO partitions '
+                             '(agency, report, date, records, fetched) VALUES (?, ?, ?, ?, ?)',
+                             (agency, report, day, json.dumps(records, separators=(',', ':')),
+                              time.time()))
+            self._db.commit()
+        return True
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -1,19 +1,222 @@
+"""Python command-line script for retrieving website statistics from the
+Digital Analytics Program API.
+ By default a single page of a report is retrieved and printed as indented
+ JSON.
+
+ With the --all option, every record of the report between the --after and
+ --before dates is retrieved. The date window is split into shards of
+ --shard-days days, and each shard is paged through until a short page is
+ returned. Several shards, and several pages within each shard, are
+ requested at the same time. Records are written as soon as their shard is
+ complete, in date order of the shards, as newline-delimited JSON or, if the
+ output file name ends in ".csv", as CSV with the columns of the first
+ record. Only the shards in flight are held in memory.
+
+ With the --cache option, the records retrieved with --all are kept in a
+ local cache partitioned by agency, report and day (see dap_cache.py). Days
+ that are over never change, so they are read from the cache on later runs,
+ and only the days not yet cached, along with the current day, are
+ requested from the API. Consecutive missing days are requested together.
+ Records read through the cache are written in date order within each shard.
+
+ Example: retrieve a year of download statistics as compressed NDJSON.
+
+     python dap_retrieve.py --all -r download -a 2023-01-01 -b 2023-12-31 \\
+       -o downloads-2023.ndjson.gz
+
+ """
+import collections
+import csv
 import getpass
 import json
 import logging
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
 
-import requests
+import ndjson
+import paginator
+import transport
+from dap_cache import DapCache
 
 base_url = "https://api.gsa.gov/analytics/dap/v2.0.0/"
 
 action = "agencies/education/reports/"
 
+_DEFAULT_AGENCY = "education"
+
+# The largest page of records the API returns.
+_MAX_LIMIT = 10000
+
+_DEFAULT_SHARD_DAYS = 7
+
+
+def report_url(report, agency=None):
+    """Return the URL of the data for a report, for the passed agency or the
+     default agency of this script.
+    """
+    agency_action = action if agency is None else f"agencies/{agency}/reports/"
+    return f'{base_url}{agency_action}{report}/data'
+
+
+def get_report_page(api_key, report, after=None, before=None, page=None, limit=None,
+                    agency=None):
+    """Retrieve one page of a report, returning the list of records.
+    """
+    params = {}
+    if after is not None:
+        params['after'] = after
+    if before is not None:
+        params['before'] = before
+    if page is not None:
+        params['page'] = page
+    if limit is not None:
+        params['limit'] = limit
+    result = transport.get_session().get(report_url(report, agency),
+                                         headers={"x-api-key": api_key}, params=params)
+    result.raise_for_status()
+    return result.json()
+
+
+def date_shards(after, before, shard_days=_DEFAULT_SHARD_DAYS):
+    """Split the inclusive date range from after to before, given in
+     YYYY-MM-DD format, into a list of consecutive (after, before) ranges of
+     at most shard_days days each.
+    """
+    start = date.fromisoformat(after)
+    end = date.fromisoformat(before)
+    shards = []
+    while start <= end:
+        shard_end = min(end, start + timedelta(days=shard_days - 1))
+        shards.append((start.isoformat(), shard_end.isoformat()))
+        start = shard_end + timedelta(days=1)
+    return shards
+
+
+def get_shard(api_key, report, after, before, agency=None, limit=_MAX_LIMIT,
+              concurrency=paginator.DEFAULT_CONCURRENCY):
+    """Retrieve every record of a report between two dates, requesting
+     several pages at the same time.
+    """
+    def fetch_page(offset, limit):
+        return get_report_page(api_key, report, after, before,
+                               offset // limit + 1, limit, agency)
+
+    records = []
+    for offset, page in paginator.iter_pages(fetch_page, limit, concurrency):
+        records.extend(page)
+        if len(page) < limit:
+            break
+    logging.info('Retrieved %d %s records from %s to %s', len(records), report, after, before)
+    return records
+
+
+def _runs(days):
+    # Group a sorted list of days into (first, last) runs of consecutive days.
+    runs = []
+    for day in days:
+        if runs and date.fromisoformat(day) == date.fromisoformat(runs[-1][1]) + timedelta(days=1):
+            runs[-1][1] = day
+        else:
+            runs.append([day, day])
+    return runs
+
+
+def get_cached_shard(cache, api_key, report, after, before, agency=None, limit=_MAX_LIMIT,
+                     concurrency=paginator.DEFAULT_CONCURRENCY):
+    """Retrieve every record of a report between two dates, reading the days
+     already in the cache from it and requesting the rest from the API. The
+     records are returned in date order.
+    """
+    agency_name = agency or _DEFAULT_AGENCY
+    days = [shard_after for shard_after, shard_before in date_shards(after, before, 1)]
+    partitions = cache.get(agency_name, report, days)
+    missing = [day for day in days if day not in partitions]
+    logging.debug('Read %d days of %s records from the cache', len(partitions), report)
+
+    unpartitioned = []
+    for run_after, run_before in _runs(missing):
+        records = get_shard(api_key, report, run_after, run_before, agency, limit, concurrency)
+        run_days = set(day for day in missing if run_after <= day <= run_before)
+        fetched = {day: [] for day in run_days}
+        undated = []
+        for record in records:
+            if record.get('date') in run_days:
+                fetched[record['date']].append(record)
+            else:
+                undated.append(record)
+        if len(undated):
+            # Records without one of the requested dates cannot be assigned
+            # to a partition, so the run is not cached.
+            logging.warning('Not caching %s records from %s to %s with unexpected dates',
+                            report, run_after, run_before)
+            unpartitioned.extend(undated)
+        else:
+            for day, day_records in fetched.items():
+                cache.put(agency_name, report, day, day_records)
+        partitions.update(fetched)
+    return [record for day in days for record in partitions.get(day, [])] + unpartitioned
+
+
+def iter_report(api_key, report, after, before, agency=None, limit=_MAX_LIMIT,
+                shard_days=_DEFAULT_SHARD_DAYS, concurrency=paginator.DEFAULT_CONCURRENCY,
+                page_concurrency=2, cache=None):
+    """Yield every record of a report between the after and before dates,
+     retrieving up to concurrency date shards at the same time. Records are
+     yielded shard by shard, in date order of the shards. When a cache is
+     passed, the days already in it are not requested again.
+    """
+    shards = collections.deque(date_shards(after, before, shard_days))
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        try:
+            while shards or pending:
+                while shards and len(pending) < max(1, concurrency):
+                    shard_after, shard_before = shards.popleft()
+                    if cache is None:
+                        future = executor.submit(get_shard, api_key, report, shard_after,
+                                                 shard_before, agency, limit, page_concurrency)
+                    else:
+                        future = executor.submit(get_cached_shard, cache, api_key, report,
+                                                 shard_after, shard_before, agency, limit,
+                                                 page_concurrency)
+                    pending.append(future)
+                for record in pending.popleft().result():
+                    yield record
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def write_report(records, output_file_name):
+    """Write report records as CSV if the file name ends in ".csv", or as
+     newline-delimited JSON otherwise. Returns the number of records written.
+    """
+    count = 0
+    if output_file_name.endswith('.csv'):
+        with open(output_file_name, 'w', newline='', encoding='utf-8') as output_file:
+            writer = None
+            for record in records:
+                if writer is None:
+                    writer = csv.DictWriter(output_file, fieldnames=list(record),
+                                            restval='', extrasaction='ignore')
+                    writer.writeheader()
+                writer.writerow(record)
+                count += 1
+    else:
+        with ndjson.open_output(output_file_name) as output_file:
+            for record in records:
+                ndjson.write_record(output_file, record)
+                count += 1
+    logging.info('Wrote %d records to %s', count, output_file_name)
+    return count
+
+
 if __name__ == '__main__':
 
     logging.basicConfig(level=logging.INFO)
-    
+
     ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
         description='''Retrieve website statistics from the Digital Analytics Program API.
 ''',
@@ -31,20 +234,29 @@ if __name__ == '__main__':
         help='The report page to retrieve.')
     ap.add_argument('-l', '--limit', dest='limit', type=int,
         help='The maximum number of responses to include in the report, capped at 10,000.')
-    
-    args = ap.parse_args()
+    ap.add_argument('-g', '--agency', dest='agency', default=None,
+        help='The agency to retrieve statistics for. Defaults to education.')
+    ap.add_argument('--all', dest='all', action='store_true',
+        help='Retrieve every record between the after and before dates, paging through the '
+             'report automatically.')
+    ap.add_argument('-o', '--output', dest='output', default='-',
+        help='The file for the records retrieved with --all, as CSV if the name ends in ".csv" '
+             'and newline-delimited JSON otherwise. Defaults to standard output.')
+    ap.add_argument('--shard-days', dest='shard_days', default=_DEFAULT_SHARD_DAYS, type=int,
+        help='The number of days in each date range retrieved with --all.')
+    ap.add_argument('--concurrency', dest='concurrency',
+        default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of date ranges retrieved at the same time with --all.')
+    ap.add_argument('--page-concurrency', dest='page_concurrency', default=2, type=int,
+        help='The number of pages of each date range requested at the same time with --all.')
+    ap.add_argument('-c', '--cache', dest='cache', default=None,
+        help='A file for caching the records retrieved with --all by day, so past days are not '
+             'requested again.')
+    ap.add_argument('--cache-open-days', dest='cache_open_days', default=1, type=int,
+        help='The number of most recent days, including today, that are not cached because '
+             'their data may still change.')
 
-    params = {}
-    if args.after_date is not None:
-        params['after'] = args.after_date
-    if args.before_date is not None:
-        params['before'] = args.before_date
-    if args.page is not None:
-        params['page'] = args.page
-    if args.limit is not None:
-        params['limit'] = args.limit
-    if args.report is not None:
-        detail = f"{args.report}/data"
+    args = ap.parse_args()
 
     # Retrieve the API Key from the environment variable, if set.
     api_key = os.getenv('DAP_KEY', None)
@@ -53,17 +265,42 @@ if __name__ == '__main__':
     if not api_key:
         api_key = getpass.getpass('Enter DAP API key:')
 
-    headers = {"x-api-key": api_key}
-
-    api_call = f'{base_url}{action}{detail}'
-    print(api_call)
-    result = requests.get(api_call, headers=headers, params=params)
-
-    if result.status_code == 200:
-        interpreted_result = json.loads(result.text)
-        print(json.dumps(interpreted_result, indent=2))
+    if args.all:
+        if args.after_date is None:
+            ap.error('The --after date is needed with --all.')
+        before_date = args.before_date or date.today().isoformat()
+        cache = None
+        if args.cache is not None:
+            cache = DapCache(args.cache, args.cache_open_days)
+        try:
+            write_report(iter_report(api_key, args.report, args.after_date, before_date,
+                                     args.agency, min(args.limit or _MAX_LIMIT, _MAX_LIMIT),
+                                     args.shard_days, args.concurrency, args.page_concurrency,
+                                     cache),
+                         args.output)
+        finally:
+            if cache is not None:
+                cache.close()
     else:
-        print(result.status_code)
-        print(result.text)
+        params = {}
+        if args.after_date is not None:
+            params['after'] = args.after_date
+        if args.before_date is not None:
+            params['before'] = args.before_date
+        if args.page is not None:
+            params['page'] = args.page
+        if args.limit is not None:
+            params['limit'] = args.limit
+
+        headers = {"x-api-key": api_key}
 
+        api_call = report_url(args.report, args.agency)
+        print(api_call)
+        result = transport.get_session().get(api_call, headers=headers, params=params)
 
+        if result.status_code == 200:
+            interpreted_result = json.loads(result.text)
+            print(json.dumps(interpreted_result, indent=2))
+        else:
+            print(result.status_code)
+            print(result.text)
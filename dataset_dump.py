@@ -1,14 +1,51 @@
+"""Python command line script for dumping the metadata of CKAN datasets.
+ Given a single dataset identifier, the full metadata for that dataset is
+ printed as indented JSON.
+
+ With the --ids option, identifiers (ids or names) are read one per line from
+ a file, or from standard input if the file name is "-", and the metadata for
+ every dataset is written as newline-delimited JSON. The datasets are
+ fetched concurrently. Responses are kept in a local cache along with the
+ metadata_modified value of each dataset. Before fetching, the
+ metadata_modified values for a batch of identifiers are looked up with one
+ package_search call, and datasets that have not changed are written from
+ the cache instead of being fetched again. Solr returns the values with at
+ most millisecond precision, so they are compared with the cached values at
+ that precision.
+ """
 import argparse
 import configparser
 import json
 import logging
 import os
+import sqlite3
 import sys
 import re
+from concurrent.futures import ThreadPoolExecutor
 
-from ckanapi import RemoteCKAN
+import ndjson
+from transport import RemoteCKAN
 
 _DEFAULT_CONFIG="ckan-explore.ini"
+_DEFAULT_CACHE="dataset_dump_cache.sqlite"
+
+# The number of identifiers checked in each package_search call.
+_BATCH_SIZE = 100
+
+# The number of cached datasets written between commits.
+_COMMIT_INTERVAL = 100
+
+_TIMESTAMP = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z?$')
+
+_CACHE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS datasets (
+    id TEXT PRIMARY KEY,
+    name TEXT,
+    metadata_modified TEXT,
+    body TEXT
+);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets (name);
+'''
 
 def do_dataset_dump(ckan_connection, id):
     result = None
@@ -19,6 +56,137 @@ def do_dataset_dump(ckan_connection, id):
         print(json.dumps(result, indent=2))
     except Exception as e:
         logging.exception(f'Failed to retrieve dataset {id}.')
+
+def timestamp_ms(timestamp):
+    """Convert a metadata timestamp, either as returned by package_show or as
+     a Solr date, to a common form with millisecond precision.
+    """
+    match = _TIMESTAMP.match(timestamp or '')
+    if match is None:
+        return timestamp
+    return f"{match.group(1)}.{(match.group(2) or '')[:3].ljust(3, '0')}"
+
+class DatasetCache:
+    """Local cache of package_show responses, keyed by dataset id and
+     recording the metadata_modified value of each response.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path)
+        self._db.executescript(_CACHE_SCHEMA)
+        self._pending = 0
+
+    def get(self, id, metadata_modified):
+        """Return the cached dataset with the passed id or name, if its
+         metadata_modified value matches. Otherwise return None.
+        """
+        row = self._db.execute('SELECT metadata_modified, body FROM datasets '
+                               'WHERE id = ? OR name = ?', (id, id)).fetchone()
+        if row is None or timestamp_ms(row[0]) != timestamp_ms(metadata_modified):
+            return None
+        return json.loads(row[1])
+
+    def put(self, dataset):
+        self._db.execute('INSERT OR REPLACE INTO datasets (id, name, metadata_modified, body) '
+                         'VALUES (?, ?, ?, ?)',
+                         (dataset['id'], dataset.get('name'),
+                          dataset.get('metadata_modified'), json.dumps(dataset)))
+        # Commit periodically, so the datasets cached so far survive a crash.
+        self._pending += 1
+        if self._pending >= _COMMIT_INTERVAL:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self._db.commit()
+        self._db.close()
+
+def read_ids(file_name):
+    """Yield the dataset identifiers listed one per line in a file, or on
+     standard input if the file name is "-". Blank lines are skipped.
+    """
+    input_file = sys.stdin if file_name == '-' else open(file_name, 'r')
+    try:
+        for line in input_file:
+            line = line.strip()
+            if line:
+                yield line
+    finally:
+        if input_file is not sys.stdin:
+            input_file.close()
+
+def get_modified(ckan_connection, ids):
+    """Look up the metadata_modified value of each of the passed dataset ids or
+     names with a single package_search call. Identifiers that are not found
+     are left out of the returned dictionary.
+    """
+    terms = ' OR '.join(json.dumps(id) for id in ids)
+    result = ckan_connection.call_action(action='package_search', data_dict={
+        'q': '*:*',
+        'fq': f'id:({terms}) OR name:({terms})',
+        'fl': 'id,name,metadata_modified',
+        'rows': 2 * len(ids),
+        'include_private': True,
+        'include_drafts': True
+        })
+    modified = {}
+    for dataset in result.get('results', []):
+        modified[dataset.get('id')] = dataset.get('metadata_modified')
+        modified[dataset.get('name')] = dataset.get('metadata_modified')
+    return modified
+
+def show_dataset(ckan_connection, id):
+    try:
+        return ckan_connection.call_action(action='package_show',
+                                           data_dict={ 'id': id })
+    except Exception:
+        logging.exception(f'Failed to retrieve dataset {id}.')
+        return None
+
+def _batches(ids, size):
+    batch = []
+    for id in ids:
+        batch.append(id)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def dump_datasets(ckan_connection, ids, output_file_name, workers=8, cache=None):
+    """Write the metadata for every dataset identifier to a newline-delimited
+     JSON file, in the order given. Datasets are fetched concurrently, and
+     unchanged datasets are written from the cache when one is passed.
+    """
+    fetched = 0
+    cached = 0
+    with ndjson.open_output(output_file_name) as output_file, \
+            ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch in _batches(ids, _BATCH_SIZE):
+            datasets = {}
+            if cache is not None:
+                try:
+                    modified = get_modified(ckan_connection, batch)
+                except Exception as e:
+                    logging.warning('Unable to check for changed datasets.', exc_info=e)
+                    modified = {}
+                for id in batch:
+                    if modified.get(id) is not None:
+                        dataset = cache.get(id, modified[id])
+                        if dataset is not None:
+                            datasets[id] = dataset
+            missing = [id for id in batch if id not in datasets]
+            for id, dataset in zip(missing,
+                    executor.map(lambda id: show_dataset(ckan_connection, id), missing)):
+                datasets[id] = dataset
+                if dataset is not None and cache is not None:
+                    cache.put(dataset)
+            cached += len(batch) - len(missing)
+            fetched += len(missing)
+            for id in batch:
+                if datasets[id] is not None:
+                    ndjson.write_record(output_file, datasets[id])
+    logging.info('Wrote %d datasets from the cache and fetched %d.', cached, fetched)
  	
 if __name__ == '__main__':
 
@@ -26,8 +194,18 @@ if __name__ == '__main__':
     
     ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
         description='''Retrieve and print all the metadata for a specified dataset.''')
-    ap.add_argument('id', help='Identifier for the dataset to dump.')
+    ap.add_argument('id', nargs='?', default=None, help='Identifier for the dataset to dump.')
     ap.add_argument('-c','--config', help='Name of the configuration file to use.', default=_DEFAULT_CONFIG)
+    ap.add_argument('-i','--ids', dest='ids', default=None,
+        help='Name of a file listing dataset identifiers, one per line, to dump as '
+             'newline-delimited JSON. Use "-" for standard input.')
+    ap.add_argument('-o','--output', dest='output', default='-',
+        help='Name of the file for the newline-delimited JSON output. Defaults to standard output.')
+    ap.add_argument('-w','--workers', dest='workers', type=int, default=8,
+        help='Number of datasets to fetch at the same time.')
+    ap.add_argument('--cache', dest='cache', default=_DEFAULT_CACHE,
+        help='Name of the file for caching datasets between runs. Use an empty name to disable '
+             'the cache.')
     args = ap.parse_args()
 
     cp = configparser.ConfigParser()
@@ -47,6 +225,8 @@ if __name__ == '__main__':
 
     if url is None:
         errors.append(f'CKAN API URL not specified in configuration file {args.config}.')
+    if args.id is None and args.ids is None:
+        errors.append('Specify either a dataset identifier or a file of identifiers.')
     if api_key is None:
         logging.warning(f'CKAN API key not specified in configuration file {args.config}. Using anonymous access.')
 
@@ -57,6 +237,12 @@ if __name__ == '__main__':
 
     remote_ckan = RemoteCKAN(address=url, apikey=api_key)
 
-    do_dataset_dump(remote_ckan, args.id)
+    if args.ids is not None:
+        cache = DatasetCache(args.cache) if args.cache else None
+        dump_datasets(remote_ckan, read_ids(args.ids), args.output, args.workers, cache)
+        if cache is not None:
+            cache.close()
+    else:
+        do_dataset_dump(remote_ckan, args.id)
 
     
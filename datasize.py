@@ -10,6 +10,19 @@
  variable named 'CKAN_KEY'. If the environment variable is not set, only
  anonymous access is used, resulting in only the publicly-available resources
  being included in the sum.
+
+ Progress is saved to a checkpoint file every minute or so: the offset
+ reached in the catalog listing, the running sum, and the size of every URL
+ probed so far. If the scan stops early, running the script again with the
+ --resume option continues from the last checkpoint. URLs that were still
+ being probed are probed again. The checkpoint is removed when the scan
+ completes.
+
+ With the --shard i/N option, only the i-th of N disjoint shards of the
+ catalog pages is scanned (see sharding.py), and the sum for the shard is
+ written to a partial output file rather than printed. Running every shard,
+ with the same options, and passing the partial output files to
+ merge_shards.py prints the total for the whole catalog.
  
  """
 import argparse
@@ -18,24 +31,133 @@ import os
 import re
 import sys
 
-import ckanapi
-import requests
+import paginator
+import sharding
+import transport
+from checkpoint import Checkpoint, DEFAULT_INTERVAL
+from host_pool import HostLimitedPool
+from url_cache import UrlCache
+
+
+def probe_url(url, timeout, cached=None):
+    """Retrieve the size and validators of the file at the passed URL from the
+     response headers. When a previously cached entry is passed, its ETag and
+     Last-Modified values are sent as a conditional request, and the cached
+     size is kept if the server reports the file has not changed.
+     Returns a dictionary with the content_length, etag and last_modified
+     values, or None if the URL could not be probed.
+    """
+    headers = {}
+    if cached is not None:
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('last_modified'):
+            headers['If-Modified-Since'] = cached['last_modified']
+    try:
+        response = transport.get_session().head(url,allow_redirects=True, timeout=timeout,
+                                                headers=headers)
+        if response is not None:
+            if response.status_code == 304 and cached is not None:
+                return {'content_length': cached.get('content_length'),
+                        'etag': response.headers.get('etag', cached.get('etag')),
+                        'last_modified': response.headers.get('last-modified',
+                                                              cached.get('last_modified'))}
+            if response.status_code != 200:
+                return None
+            size = response.headers.get('content-length', None)
+            return {'content_length': int(size) if size is not None else None,
+                    'etag': response.headers.get('etag', None),
+                    'last_modified': response.headers.get('last-modified', None)}
+    except Exception:
+        return None
+    return None
+
 
+def get_url_size(url, timeout, cache=None):
+    """Retrieve the size of the file at the passed URL.
+     A fresh entry in the cache is used without contacting the server. Otherwise
+     the URL is probed and the result recorded in the cache.
+     Returns None if the size cannot be determined.
+    """
+    cached = None
+    if cache is not None:
+        cached = cache.get(url)
+        if cached is not None and cache.is_fresh(cached):
+            return cached['content_length']
+    probe = probe_url(url, timeout, cached)
+    if probe is None:
+        return None
+    if cache is not None:
+        cache.put(url, **probe)
+    return probe['content_length']
 
-def sum_resource_size(connection, timeout, filter):
+
+def sum_resource_size(connection, timeout, filter, workers=1, per_host=2, cache=None,
+                      page_size=paginator.DEFAULT_PAGE_SIZE,
+                      concurrency=paginator.DEFAULT_CONCURRENCY,
+                      checkpoint=None, resume=False, shard=None):
     """Retrieve the metadata in the connected CKAN repository.
+     Each distinct URL of a resource without a recorded size is probed only
+     once, and its size is counted once for every resource referencing it.
+     When more than one worker is requested, the URLs are probed concurrently,
+     with at most per_host probes running against any one host.
+     When a cache is passed, URLs with fresh cache entries are not probed.
+     The catalog is listed page_size datasets at a time, with up to
+     concurrency pages requested at the same time.
+     When a checkpoint is passed, progress is saved to it periodically and
+     if the scan fails. With resume, the scan continues from the saved
+     progress, if any.
+     When a shard is passed, only the resources of the datasets in that shard
+     of the catalog pages are summed.
     """
     sum = 0
+    start = None
+    pool = None
+    # Sizes of the URLs probed so far, and futures for those being probed.
+    sizes = {}
+    probes = {}
+    counts = {}
+    if workers > 1:
+        pool = HostLimitedPool(workers, per_host)
+
+    def probe(url):
+        if pool is not None:
+            probes[url] = pool.submit(url, get_url_size, url, timeout, cache)
+        else:
+            sizes[url] = get_url_size(url, timeout, cache)
+
+    def save(offset):
+        probed = dict(sizes)
+        for url, future in probes.items():
+            if future.done():
+                probed[url] = future.result()
+        checkpoint.save({'filter': filter, 'shard': shard, 'offset': offset, 'sum': sum,
+                         'counts': counts, 'sizes': probed})
+        logging.info('Saved checkpoint at offset %d', offset)
+
+    state = checkpoint.load() if checkpoint is not None and resume else None
+    if state is not None:
+        if state.get('filter') != filter:
+            raise ValueError('The checkpoint was saved for a different filter.')
+        if state.get('shard') != (None if shard is None else list(shard)):
+            raise ValueError('The checkpoint was saved for a different shard.')
+        start, sum, counts, sizes = state['offset'], state['sum'], state['counts'], state['sizes']
+        logging.info('Resuming from offset %d, with %d URLs already counted.', start, len(counts))
+        for url in counts:
+            if url not in sizes:
+                probe(url)
+
+    offset = paginator.first_offset(page_size, shard) if start is None else start
+    complete = False
     try:
-        offset = 0
-        increment = 1000
-        while (True):
-#        while (offset < increment):
-            pass_data_dict = { "limit": increment, "offset": offset }
-            pass_result = connection.call_action(action='current_package_list_with_resources', data_dict=pass_data_dict)
-            if len(pass_result) == 0: break
-            offset += increment
-            for dataset in pass_result:
+        for page_offset, datasets in paginator.iter_package_pages(connection, page_size,
+                                                                  concurrency, start, shard):
+            logging.info('Retrieved %d datasets from offset %d', len(datasets), page_offset)
+            # Gather the page before adding it to the totals, so a checkpoint
+            # always covers whole pages.
+            page_sum = 0
+            page_urls = []
+            for dataset in datasets:
                 if dataset.get('type', None) != 'dataset':
                     continue
                 for resource in dataset.get('resources',[]):
@@ -49,23 +171,40 @@ def sum_resource_size(connection, timeout, filter):
                                 logging.info('Checking %s', url)
                     size = resource.get("size", None)
                     if size is not None:
-                        sum += size
-                    else:
-                            try:
-                                response = requests.head(url,allow_redirects=True, timeout=timeout)
-                                if response is not None:
-                                    if response.status_code != 200:
-                                        continue
-                                    size = response.headers.get('content-length', None)
-                                    if size is not None:
-                                        sum += int(size)
-                            except Exception:
-                                continue
+                        page_sum += size
+                        continue
+                    if url is None:
+                        continue
+                    page_urls.append(url)
+            sum += page_sum
+            for url in page_urls:
+                if url not in counts:
+                    probe(url)
+                counts[url] = counts.get(url, 0) + 1
+            offset = page_offset + paginator.page_stride(page_size, shard)
+            if checkpoint is not None and checkpoint.due():
+                save(offset)
+        complete = True
 
-        return sum
     except Exception as e:
         logging.info('Error scanning CKAN resources.', exc_info=e)
-        return sum
+
+    if pool is not None:
+        pool.shutdown()
+    if checkpoint is not None:
+        if complete:
+            checkpoint.remove()
+        else:
+            save(offset)
+
+    for url, future in probes.items():
+        sizes[url] = future.result()
+    for url, count in counts.items():
+        size = sizes.get(url)
+        if size is not None:
+            sum += size * count
+    logging.info('Probed %d distinct URLs.', len(counts))
+    return sum
 
     
 if __name__ == '__main__':
@@ -84,9 +223,49 @@ if __name__ == '__main__':
     ap.add_argument('-t', '--timeut', dest='timeout', default=5, type=int,
         help='The number of seconds to wait for URL headers.')
     ap.add_argument('-f','--filter', dest='filter', default=None,
-        help='A URL for filtering resources. Only the resources starting with the specified URL will be included in the sum.')
+        help='A URL for filtering resources. Only the resources starting with the specified '
+             'URL will be included in the sum.')
+    ap.add_argument('-w', '--workers', dest='workers', default=1, type=int,
+        help='The total number of URLs to probe at the same time. The default of 1 probes each '
+             'URL in turn.')
+    ap.add_argument('--per-host', dest='per_host', default=2, type=int,
+        help='The maximum number of URLs to probe at the same time on any one host.')
+    ap.add_argument('-c', '--cache', dest='cache', default=None,
+        help='A file for caching the sizes of probed URLs between runs. URLs with fresh '
+             'entries are not probed again.')
+    ap.add_argument('--cache-ttl', dest='cache_ttl', default=24, type=float,
+        help='The number of hours a cached size is used before the URL is probed again.')
+    ap.add_argument('--cache-max-age', dest='cache_max_age', default=30, type=float,
+        help='The number of days an unused URL is kept in the cache.')
+    ap.add_argument('--cache-max-entries', dest='cache_max_entries', default=None, type=int,
+        help='The maximum number of URLs kept in the cache, discarding the least recently used.')
+    ap.add_argument('--page-size', dest='page_size', default=paginator.DEFAULT_PAGE_SIZE, type=int,
+        help='The number of datasets to request in each page of the catalog listing.')
+    ap.add_argument('--page-concurrency', dest='page_concurrency',
+        default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of catalog listing pages to request at the same time.')
+    ap.add_argument('--checkpoint', dest='checkpoint', default=None,
+        help='The file for saving the progress of the scan. Defaults to '
+             'datasize.checkpoint.json, or datasize.shard-i-of-N.checkpoint.json with --shard.')
+    ap.add_argument('--checkpoint-interval', dest='checkpoint_interval',
+        default=DEFAULT_INTERVAL, type=float,
+        help='The number of seconds between saves of the progress of the scan.')
+    ap.add_argument('--resume', dest='resume', action='store_true',
+        help='Continue the scan from the saved progress of an earlier run.')
+    ap.add_argument('--shard', dest='shard', default=None, type=sharding.parse_shard,
+        help='Scan only shard i of N of the catalog pages, given as i/N with i from 0 to '
+             'N - 1, and write the sum to a partial output file for merge_shards.py.')
+    ap.add_argument('-o', '--partial-output', dest='partial_output', default=None,
+        help='The partial output file written with --shard. Defaults to '
+             'datasize.shard-i-of-N.json.')
     args = ap.parse_args()
 
+    checkpoint_file_name = args.checkpoint
+    if checkpoint_file_name is None:
+        checkpoint_file_name = ('datasize.checkpoint.json' if args.shard is None
+                                else f'datasize.{sharding.shard_label(args.shard)}.checkpoint.json')
+    checkpoint = Checkpoint(checkpoint_file_name, args.checkpoint_interval)
+
     # Retrieve the URL and API Key from environment variables, if set.
     url = os.getenv('CKAN_URL', None)
     api_key = os.getenv('CKAN_KEY', None)
@@ -95,11 +274,31 @@ if __name__ == '__main__':
     if not url:
         url = input('Enter CKAN URL:')
 
-    remote = None
-    if api_key is not None:
-        remote = ckanapi.RemoteCKAN(url, api_key)
-    else:
-        remote = ckanapi.RemoteCKAN(url)
+    remote = transport.remote_ckan(url, api_key)
 
-    sum = sum_resource_size(remote, args.timeout, args.filter)
-    print(f'Total size of referenced datafiles: {sum} bytes')
+    cache = None
+    if args.cache is not None:
+        cache = UrlCache(args.cache, ttl=args.cache_ttl*3600,
+                         max_age=args.cache_max_age*24*3600,
+                         max_entries=args.cache_max_entries)
+
+    sum = sum_resource_size(remote, args.timeout, args.filter,
+                            args.workers, args.per_host, cache,
+                            args.page_size, args.page_concurrency,
+                            checkpoint, args.resume, args.shard)
+    if cache is not None:
+        cache.close()
+    if args.shard is None:
+        print(f'Total size of referenced datafiles: {sum} bytes')
+    elif checkpoint.exists():
+        # The checkpoint is only kept when the scan did not complete.
+        logging.error('The scan of %s did not complete, so no partial output was written. '
+                      'Run again with --resume to continue.', sharding.shard_label(args.shard))
+        sys.exit(1)
+    else:
+        partial_output = args.partial_output or f'datasize.{sharding.shard_label(args.shard)}.json'
+        sharding.write_partial(partial_output, 'datasize', args.shard,
+                               {'filter': args.filter, 'page_size': args.page_size},
+                               {'sum': sum})
+        print(f'Size of referenced datafiles in {sharding.shard_label(args.shard)}: {sum} bytes, '
+              f'written to {partial_output}')
@@ -0,0 +1,128 @@
+"""Incremental reader for DCAT-US catalog files.
+ A DCAT-US catalog is a single JSON object, with the datasets listed in its
+ "dataset" array. Federal catalogs run to hundreds of megabytes, so rather
+ than loading the whole object, the file is read a chunk at a time and each
+ entry of the "dataset" array is decoded and yielded on its own. Only the
+ current chunk and the dataset being decoded are held in memory. The other
+ top-level fields of the catalog are skipped. Plain JSON arrays, such as
+ the indented snapshots written by retrieve_all_metadata.py, can be read
+ the same way.
+
+ Compressed catalogs are recognized by their contents and decompressed as
+ they are read.
+
+ """
+import json
+
+import ndjson
+
+_CHUNK_SIZE = 1024*1024
+
+_WHITESPACE = ' \t\n\r'
+
+
+class _Reader:
+    """Buffer over a text file, with JSON values decoded at the current
+     position and more of the file read whenever a value is incomplete.
+    """
+
+    def __init__(self, input_file, chunk_size=_CHUNK_SIZE):
+        self.input_file = input_file
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def fill(self):
+        # Drop the consumed part of the buffer and read another chunk.
+        chunk = self.input_file.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Skip whitespace and return the next character, or '' at the end.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.fill():
+                return ''
+
+    def expect(self, characters):
+        character = self.peek()
+        if character == '' or character not in characters:
+            raise ValueError(f'Expected one of {characters!r} in the catalog, found {character!r}')
+        self.pos += 1
+        return character
+
+    def value(self):
+        """Decode the JSON value at the current position.
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.fill():
+                    continue
+                raise
+            # A number at the end of the buffer may continue in the next chunk.
+            if end == len(self.buffer) and not self.eof and self.fill():
+                continue
+            self.pos = end
+            return value
+
+
+def _items(reader):
+    # Yield the entries of the array at the current position.
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.expect(']')
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_array(input_file, chunk_size=_CHUNK_SIZE):
+    """Yield each entry of a JSON array read from an open text file, such as
+     a metadata snapshot written by retrieve_all_metadata.py.
+    """
+    yield from _items(_Reader(input_file, chunk_size))
+
+
+def iter_datasets(input_file, chunk_size=_CHUNK_SIZE):
+    """Yield each entry of the "dataset" array of a DCAT-US catalog read from
+     an open text file.
+    """
+    reader = _Reader(input_file, chunk_size)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'dataset' and reader.peek() == '[':
+            yield from _items(reader)
+        else:
+            reader.value()
+        if reader.expect(',}') == '}':
+            return
+
+
+def iter_distributions(file_name, chunk_size=_CHUNK_SIZE):
+    """Yield (dataset, distribution) pairs for every distribution of every
+     dataset in a DCAT-US catalog file.
+    """
+    with ndjson.open_input(file_name) as input_file:
+        for dataset in iter_datasets(input_file, chunk_size):
+            for distribution in dataset.get('distribution', []):
+                yield dataset, distribution
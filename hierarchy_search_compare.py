@@ -13,84 +13,225 @@ import os
 import sys
 import timeit
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import ckanapi
 
+import transport
+
+# The number of API calls issued at the same time while walking a hierarchy.
+_CONCURRENCY = 8
+
+# The number of packages checked for visibility in each package_search call.
+# Each is matched by both name and id, keeping the query well within Solr's
+# default limit of 1024 clauses.
+_VISIBILITY_BATCH_SIZE = 200
+
 def encapsulate(func, *args, **kwargs):
     def encapsulated():
         return func(*args, **kwargs)
     return encapsulated
 
+def list_relationships(connection, package_id, relationship_type):
+    """Retrieve the relationships of one type for a package, or an empty list
+     if there are none.
+    """
+    try:
+        return connection.call_action(action='package_relationships_list',
+                                      data_dict = {'id': package_id, 'rel': relationship_type})
+    except ckanapi.errors.NotFound:
+        logging.info('No %s relationships found for %s',
+            relationship_type,
+            package_id
+        )
+        return []
+
 def get_relationships_from_api(connection,
                                package_id,
                                relationship_type,
                                hierarchy=None,
-                               i=1):
-    relationships = []
-
+                               i=1,
+                               concurrency=_CONCURRENCY):
+    """Walk the relationships of a package.
+     For child_of relationships, the parents are followed up to the top of the
+     hierarchy, returning the child_of relationships of the package just
+     below the top. For parent_of relationships, the hierarchy below the
+     package is walked one level at a time, retrieving the relationships of
+     every package on a level concurrently, and a list of the packages found
+     is returned with the name of the parent and the level of each.
+    """
     if hierarchy is None:
         hierarchy = list()
 
-    try:
-        relationships = connection.call_action(action='package_relationships_list',
-                                              data_dict = {'id': package_id, 'rel': relationship_type})
-
-    except ckanapi.errors.NotFound:
-        logging.info('No %s relationships found for %s',
-            relationship_type,
-            package_id
-        )
+    if relationship_type == 'parent_of':
+        visited = {package_id}
+        level = [package_id]
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            while level:
+                next_level = []
+                for relationships in executor.map(
+                        lambda parent: list_relationships(connection, parent, relationship_type),
+                        level):
+                    hierarchy += [
+                        {'name': c['object'], 'parent': c['subject'], 'level': i}
+                        for c in relationships
+                    ]
+                    for child in relationships:
+                        if child['object'] not in visited:
+                            visited.add(child['object'])
+                            next_level.append(child['object'])
+                level = next_level
+                i += 1
         return hierarchy
 
-    if relationship_type == 'parent_of':
-        hierarchy += [
-            {'name': c['object'], 'parent': c['subject'], 'level': i}
-            for c in relationships
+    else:
+        visited = {package_id}
+        while True:
+            relationships = list_relationships(connection, package_id, relationship_type)
+            if not relationships or relationships[0]['object'] in visited:
+                return hierarchy
+            hierarchy = relationships
+            package_id = relationships[0]['object']
+            visited.add(package_id)
+
+def show_package(connection, name):
+    """Retrieve a package using package_show, or an empty dictionary if not found.
+    """
+    try:
+        return connection.call_action(action='package_show', data_dict={'id': name})
+    except ckanapi.NotFound:
+        logging.debug('Unable to retrieve package for name: {}'.format(name))
+        return {}
+
+def search_package(connection, name):
+    """Retrieve the fields of a package needed for the hierarchy using
+     package_search, or an empty dictionary if not found.
+    """
+    try:
+        result = connection.call_action(action='package_search',
+                                        data_dict={'q': 'name:' + name,
+                                                   'fl': 'id,name,title,type'})
+    except ckanapi.NotFound:
+        result = {}
+    results = result.get('results') or []
+    if not results:
+        logging.debug('Unable to retrieve package for name: {}'.format(name))
+        return {}
+    return results[0]
+
+def fetch_packages(connection, names, fetch, packages, concurrency=_CONCURRENCY):
+    """Look up every name not already in the packages dictionary, concurrently,
+     adding the results to the dictionary so each package is fetched only
+     once per traversal.
+    """
+    missing = [name for name in dict.fromkeys(names) if name not in packages]
+    if missing:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for name, package in zip(missing,
+                    executor.map(lambda name: fetch(connection, name), missing)):
+                packages[name] = package
+    return packages
+
+def nest_hierarchy(hierarchy, packages):
+    """Build the nested hierarchy from the list of packages, their parents and
+     levels, using the retrieved packages for the titles.
+    """
+    lowest_level = max([level['level'] for level in hierarchy])
+    nested_hierarchy = {}
+
+    for i in range(lowest_level, -1, -1):
+        tmp_nested_hierarchy = {}
+
+        current_level = [
+            relationship for relationship in hierarchy
+            if relationship['level'] == i
         ]
-        i += 1
-
-        for child in relationships:
-            get_relationships_from_api(
-                connection,
-                child['object'],
-                relationship_type,
-                hierarchy,
-                i
-            )
-        return hierarchy
 
+        for relationship in current_level:
+            cur_pkg = packages.get(relationship['name'], {})
+
+            if cur_pkg.get('type') != 'dataset':
+                continue
+
+            updated_hierarchy = OrderedDict({
+                relationship['name']: OrderedDict([
+                    ('title', cur_pkg.get('title')),
+                    ('level', relationship['level']),
+                    ('parent', relationship['parent']),
+                    ('children', nested_hierarchy.get(
+                        relationship['name']
+                    ))
+                ])
+            })
+
+            if relationship['parent'] in tmp_nested_hierarchy:
+                tmp_nested_hierarchy[relationship['parent']].update(
+                    updated_hierarchy)
+            elif i > 0:
+                tmp_nested_hierarchy[relationship['parent']] = \
+                    updated_hierarchy
+            else:
+                tmp_nested_hierarchy = updated_hierarchy
+
+        nested_hierarchy = tmp_nested_hierarchy
+
+    return nested_hierarchy
+
+def check_visible(connection, names):
+    """Return the subset of the passed package names or ids that are visible
+     to the connection, using a single package_search call.
+    """
+    terms = ' OR '.join('"{}"'.format(name) for name in names)
+    result = connection.call_action(action='package_search',
+                                    data_dict={'q': '*:*',
+                                               'fq': 'name:({0}) OR id:({0})'.format(terms),
+                                               'fl': 'id,name',
+                                               'rows': len(names),
+                                               'include_private': True})
+    visible = set()
+    for package in result.get('results') or []:
+        visible.update((package.get('name'), package.get('id')))
+    visible.discard(None)
+    return visible
+
+def visible_packages(connection, names, batch_size=_VISIBILITY_BATCH_SIZE,
+                     concurrency=_CONCURRENCY):
+    """Return the subset of the passed package names or ids that are visible
+     to the connection, checking batch_size of them in each package_search
+     call, with up to concurrency calls at the same time.
+    """
+    names = [name for name in dict.fromkeys(names) if name]
+    batches = [names[i:i + batch_size] for i in range(0, len(names), batch_size)]
+    visible = set()
+    if len(batches) == 1:
+        visible.update(check_visible(connection, batches[0]))
+    elif batches:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for batch_visible in executor.map(
+                    lambda batch: check_visible(connection, batch), batches):
+                visible.update(batch_visible)
+    return visible
+
+def remove_private_relationships(connection, relationships, hierarchy=False):
+    """Return the relationships whose packages are all visible to the
+     connection. With hierarchy set, the relationships are checked by their
+     subject and object, and otherwise by their id.
+    """
+    if hierarchy is False:
+        keys = [[relationship.get('id')] for relationship in relationships]
     else:
-        return get_relationships_from_api(
-            connection,
-            relationships[0]['object'],
-            relationship_type,
-            relationships
-        )
+        keys = [[relationship.get('object'), relationship.get('subject')]
+                for relationship in relationships]
+    visible = visible_packages(connection, [key for pair in keys for key in pair])
+    return [relationship for relationship, pair in zip(relationships, keys)
+            if all(key in visible for key in pair)]
 
 def remove_private_relationships_show(connection, relationships, hierarchy=False):
+    return remove_private_relationships(connection, relationships, hierarchy)
 
-    for relationship in relationships:
-        if hierarchy is False:
-            package_id = relationship.get('id')
-
-            try:
-                connection.call_action(action='package_show', data_dict={'id': package_id})
-            except ckanapi.errors.NotAuthorized:
-                relationships.remove(relationship)
-        else:
-            relationship_object = relationship.get('object')
-            relationship_subject = relationship.get('subject')
-
-            try:
-                connection.call_action(action='package_show', data_dict={'id': relationship_object})
-                connection.call_action(action='package_show', data_dict={'id': relationship_subject})
-            except ckanapi.errors.NotAuthorized:
-                relationships.remove(relationship)
-
-    return relationships
-
-def get_hierarchy_show(connection, data_dict):
+def get_hierarchy(connection, data_dict, fetch, remove_private, concurrency=_CONCURRENCY):
     package_id = data_dict.get('id')
+    packages = {}
 
     top_level_parent = get_relationships_from_api(
         connection,
@@ -98,11 +239,13 @@ def get_hierarchy_show(connection, data_dict):
         'child_of'
     )
 
-    top_level_parent = remove_private_relationships_show(connection, top_level_parent, True)
+    top_level_parent = remove_private(connection, top_level_parent, True)
 
     if isinstance(top_level_parent, list):
         if not top_level_parent or top_level_parent[0].get('object') is None:
-            top_level_parent_id = connection.call_action(action='package_show', data_dict= {'id': package_id}).get('name')
+            fetch_packages(connection, [package_id], fetch, packages, concurrency)
+            top_level_parent_id = packages[package_id].get('name')
+            packages.setdefault(top_level_parent_id, packages[package_id])
         else:
             top_level_parent_id = top_level_parent[0].get('object')
 
@@ -111,149 +254,25 @@ def get_hierarchy_show(connection, data_dict):
         ] + get_relationships_from_api(
             connection,
             top_level_parent_id,
-            'parent_of'
+            'parent_of',
+            concurrency=concurrency
         )
-        
-        lowest_level = max([level['level'] for level in hierarchy])
-        nested_hierarchy = {}
-
-        for i in range(lowest_level, -1, -1):
-            tmp_nested_hierarchy = {}
-
-            current_level = [
-                relationship for relationship in hierarchy
-                if relationship['level'] == i
-            ]
-
-            for relationship in current_level:
-                cur_pkg = {}
-
-                try:
-                    cur_pkg = connection.call_action(action='package_show', data_dict={'id': relationship['name']})
-                except ckanapi.NotFound:
-                    logging.debug('Unable to retrieve package for name: {}'
-                              .format(relationship['name']))
-
-                if cur_pkg.get('type') != 'dataset':
-                    continue
-
-                updated_hierarchy = OrderedDict({
-                    relationship['name']: OrderedDict([
-                        ('title', cur_pkg.get('title')),
-                        ('level', relationship['level']),
-                        ('parent', relationship['parent']),
-                        ('children', nested_hierarchy.get(
-                            relationship['name']
-                        ))
-                    ])
-                })
-
-                if relationship['parent'] in tmp_nested_hierarchy:
-                    tmp_nested_hierarchy[relationship['parent']].update(
-                        updated_hierarchy)
-                elif i > 0:
-                    tmp_nested_hierarchy[relationship['parent']] = \
-                        updated_hierarchy
-                else:
-                    tmp_nested_hierarchy = updated_hierarchy
-
-            nested_hierarchy = tmp_nested_hierarchy
-
-        return nested_hierarchy
-
-def remove_private_relationships_search(connection, relationships, hierarchy=False):
-
-    for relationship in relationships:
-        if hierarchy is False:
-            package_id = relationship.get('id')
-
-            try:
-                connection.call_action(action='package_search', data_dict={'q':'name:' + package_id, 'fl': 'id,name'})
-            except ckanapi.errors.NotAuthorized:
-                relationships.remove(relationship)
-        else:
-            relationship_object = relationship.get('object')
-            relationship_subject = relationship.get('subject')
-
-            try:
-                connection.call_action(action='package_search', data_dict={'q':'name:' + relationship_object, 'fl':'id,name'})
-                connection.call_action(action='package_search', data_dict={'q':'name:' + relationship_subject, 'fl': 'id,name'})
-            except ckanapi.errors.NotAuthorized:
-                relationships.remove(relationship)
 
-    return relationships
-
-def get_hierarchy_search(connection, data_dict):
-    package_id = data_dict.get('id')
+        fetch_packages(connection, [relationship['name'] for relationship in hierarchy],
+                       fetch, packages, concurrency)
 
-    top_level_parent = get_relationships_from_api(
-        connection,
-        package_id,
-        'child_of'
-    )
+        return nest_hierarchy(hierarchy, packages)
 
-    top_level_parent = remove_private_relationships_search(connection, top_level_parent, True)
+def get_hierarchy_show(connection, data_dict, concurrency=_CONCURRENCY):
+    return get_hierarchy(connection, data_dict, show_package,
+                         remove_private_relationships_show, concurrency)
 
-    if isinstance(top_level_parent, list):
-        if not top_level_parent or top_level_parent[0].get('object') is None:
-            top_level_parent_id = connection.call_action(action='package_search', data_dict= {'q':'name:' + package_id, 'fl':'id,name'}).get('name')
-        else:
-            top_level_parent_id = top_level_parent[0].get('object')
+def remove_private_relationships_search(connection, relationships, hierarchy=False):
+    return remove_private_relationships(connection, relationships, hierarchy)
 
-        hierarchy = [
-            {'name': top_level_parent_id, 'parent': None, 'level': 0}
-        ] + get_relationships_from_api(
-            connection,
-            top_level_parent_id,
-            'parent_of'
-        )
-        
-        lowest_level = max([level['level'] for level in hierarchy])
-        nested_hierarchy = {}
-
-        for i in range(lowest_level, -1, -1):
-            tmp_nested_hierarchy = {}
-
-            current_level = [
-                relationship for relationship in hierarchy
-                if relationship['level'] == i
-            ]
-
-            for relationship in current_level:
-                cur_pkg = {}
-
-                try:
-                    cur_pkg = connection.call_action(action='package_search', data_dict={'q':'name:' + relationship['name'], 'fl': 'id, name'})
-                except ckanapi.NotFound:
-                    logging.debug('Unable to retrieve package for name: {}'
-                              .format(relationship['name']))
-
-                if cur_pkg.get('type') != 'dataset':
-                    continue
-
-                updated_hierarchy = OrderedDict({
-                    relationship['name']: OrderedDict([
-                        ('title', cur_pkg.get('title')),
-                        ('level', relationship['level']),
-                        ('parent', relationship['parent']),
-                        ('children', nested_hierarchy.get(
-                            relationship['name']
-                        ))
-                    ])
-                })
-
-                if relationship['parent'] in tmp_nested_hierarchy:
-                    tmp_nested_hierarchy[relationship['parent']].update(
-                        updated_hierarchy)
-                elif i > 0:
-                    tmp_nested_hierarchy[relationship['parent']] = \
-                        updated_hierarchy
-                else:
-                    tmp_nested_hierarchy = updated_hierarchy
-
-            nested_hierarchy = tmp_nested_hierarchy
-
-        return nested_hierarchy
+def get_hierarchy_search(connection, data_dict, concurrency=_CONCURRENCY):
+    return get_hierarchy(connection, data_dict, search_package,
+                         remove_private_relationships_search, concurrency)
 
 if __name__ == '__main__':
 
@@ -268,7 +287,7 @@ if __name__ == '__main__':
     if not api_key:
         api_key = getpass.getpass('Enter CKAN API key:')
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+    remote = transport.remote_ckan(url, api_key)
     
     id = ''
     if len(sys.argv) > 1:
@@ -285,3 +304,12 @@ if __name__ == '__main__':
     print('Time using show: {} seconds'.format(using_show_timing))
     print('Time using search: {} seconds'.format(using_search_timing))
 
+    # A relationship graph file (see relationship_graph.py) may be passed as
+    # a second argument, to time the same lookup answered from the graph.
+    if len(sys.argv) > 2:
+        import relationship_graph
+        graph = relationship_graph.RelationshipGraph.load(sys.argv[2])
+        using_graph = encapsulate(relationship_graph.get_hierarchy_graph, graph, data_dict={'id':id})
+        using_graph_timing = timeit.timeit(stmt=using_graph, number=iterations)
+        print('Time using graph: {} seconds'.format(using_graph_timing))
+
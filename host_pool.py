@@ -0,0 +1,110 @@
+"""Bounded worker pool that limits the number of simultaneous requests per host.
+ Tasks are submitted along with the URL they will contact. A fixed number of
+ worker threads run the tasks, but never more than a set number at a time
+ for any one host, so a long queue of URLs on a slow server cannot tie up
+ every worker while other hosts sit idle.
+
+ Each submission returns a concurrent.futures.Future, so callers can collect
+ results the same way they would from a ThreadPoolExecutor.
+
+ """
+import collections
+import threading
+from concurrent.futures import Future
+from urllib.parse import urlsplit
+
+
+def host_of(url):
+    """Return the host portion of a URL, used as the key for per-host limits.
+    """
+    try:
+        return urlsplit(url).netloc.lower()
+    except Exception:
+        return ''
+
+
+class HostLimitedPool:
+    """Run tasks on a bounded set of worker threads, with a cap on the number
+    of tasks running at the same time for any single host.
+    """
+
+    def __init__(self, max_workers=8, per_host=2):
+        self._per_host = max(1, per_host)
+        self._cond = threading.Condition()
+        # Pending tasks, grouped by host. The order of the hosts is rotated
+        # as tasks are taken, so every host gets a turn.
+        self._queues = collections.OrderedDict()
+        self._active = collections.Counter()
+        self._shutdown = False
+        self._threads = []
+        for i in range(max(1, max_workers)):
+            thread = threading.Thread(target=self._work, daemon=True,
+                                      name=f'host-pool-{i}')
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, url, fn, *args, **kwargs):
+        """Queue a call to fn(*args, **kwargs), counted against the host in url.
+        """
+        future = Future()
+        host = host_of(url)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError('Cannot submit tasks after shutdown.')
+            self._queues.setdefault(host, collections.deque()).append(
+                (future, fn, args, kwargs))
+            self._cond.notify()
+        return future
+
+    def _next_task(self):
+        # Called with the condition lock held.
+        for host, queue in self._queues.items():
+            if self._active[host] < self._per_host:
+                task = queue.popleft()
+                if queue:
+                    self._queues.move_to_end(host)
+                else:
+                    del self._queues[host]
+                self._active[host] += 1
+                return host, task
+        return None
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while True:
+                    next_task = self._next_task()
+                    if next_task is not None:
+                        break
+                    if self._shutdown and not self._queues:
+                        return
+                    self._cond.wait()
+            host, (future, fn, args, kwargs) = next_task
+            if future.set_running_or_notify_cancel():
+                try:
+                    result = fn(*args, **kwargs)
+                except BaseException as e:
+                    future.set_exception(e)
+                else:
+                    future.set_result(result)
+            with self._cond:
+                self._active[host] -= 1
+                if self._active[host] <= 0:
+                    del self._active[host]
+                self._cond.notify_all()
+
+    def shutdown(self, wait=True):
+        """Stop accepting tasks, and optionally wait for queued tasks to finish.
+        """
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
@@ -0,0 +1,62 @@
+"""Python command-line script for combining the partial outputs of a sharded scan.
+ Scans run with the --shard i/N option write their results to partial output
+ files (see sharding.py). Once every shard has finished, this script checks
+ that the files passed hold each of the N shards of the same scan exactly
+ once, and prints the combined results in the same form as an unsharded run:
+ - for datasize.py, the total size of the referenced data files;
+ - for compare_resource_contents.py, the matches found by all the shards.
+
+ Example: sum the sizes over four processes on one host.
+
+     for i in 0 1 2 3; do python datasize.py --shard $i/4 & done; wait
+     python merge_shards.py datasize.shard-*-of-4.json
+
+ """
+import argparse
+import logging
+import os
+import sys
+
+import sharding
+
+
+def merge_datasize(results):
+    """Return the total size over the partial results of datasize.py.
+    """
+    return sum(result['sum'] for result in results)
+
+
+def merge_compare(results):
+    """Return the matches over the partial results of
+     compare_resource_contents.py, in shard order.
+    """
+    return [line for result in results for line in result['matches']]
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Combine the partial output files written by the shards of a scan run with --shard.
+''')
+    ap.add_argument('partial_file_names', nargs='+',
+        help='The partial output files of every shard of the scan.')
+    args = ap.parse_args()
+
+    try:
+        kind, options, results = sharding.read_partials(args.partial_file_names)
+    except (OSError, ValueError, KeyError) as e:
+        logging.error(e)
+        sys.exit(1)
+    logging.info('Merging %d shards of a %s scan with options %s', len(results), kind, options)
+
+    if kind == 'datasize':
+        print(f'Total size of referenced datafiles: {merge_datasize(results)} bytes')
+    elif kind == 'compare':
+        print('CKAN dataset id, resource id, URL, JSON dataset id, URL, CKAN title, JSON title')
+        for line in merge_compare(results):
+            print(line)
+    else:
+        logging.error('Unknown kind of scan: %s', kind)
+        sys.exit(1)
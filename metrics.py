@@ -0,0 +1,186 @@
+"""Instrumentation of the CKAN API calls and HTTP requests made by the scripts.
+ When enabled, every call_action made through transport.RemoteCKAN and every
+ request made through the shared transport session is recorded:
+ - CKAN actions by action name, with the latency, including decoding the
+   response, and whether the call raised an error. Each page of a paged
+   listing is one call, so the call counts are also page counts.
+ - HTTP requests by method, host and, for CKAN API requests, action name,
+   with the latency to the response headers, the response size, the number
+   of times the request was retried, and the response status.
+ Latencies are kept as histograms with fixed buckets, so memory use does not
+ grow with the number of calls.
+
+ Instrumentation is off unless the METRICS_FILE or METRICS_PROMETHEUS_FILE
+ environment variable is set, or enable() is called. When it is off, the
+ hooks only check a flag. At exit, a JSON summary is written to
+ METRICS_FILE, and the same figures in the Prometheus text format to
+ METRICS_PROMETHEUS_FILE, for whichever of the two are set.
+
+ """
+import atexit
+import bisect
+import collections
+import json
+import logging
+import os
+import threading
+from urllib.parse import urlsplit
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+enabled = False
+
+_lock = threading.Lock()
+_series = {}
+_files = {'json': None, 'prometheus': None}
+_registered = False
+
+
+class _Series:
+    """Running totals and latency histogram for one kind and label of call.
+    """
+    __slots__ = ('count', 'errors', 'seconds', 'max_seconds', 'buckets', 'bytes',
+                 'retries', 'statuses')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.bytes = 0
+        self.retries = 0
+        self.statuses = collections.Counter()
+
+    def quantile(self, fraction):
+        # Estimate a quantile as the upper bound of the bucket holding it.
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max_seconds
+        return 0.0
+
+
+def enable(json_file=None, prometheus_file=None):
+    """Start recording, writing the summary files at exit.
+    """
+    global enabled, _registered
+    with _lock:
+        if json_file is not None:
+            _files['json'] = json_file
+        if prometheus_file is not None:
+            _files['prometheus'] = prometheus_file
+        enabled = True
+        if not _registered:
+            atexit.register(write)
+            _registered = True
+
+
+def observe(kind, label, seconds, nbytes=None, error=False, retries=0, status=None):
+    """Record one call of the passed kind ('action' or 'request') and label.
+    """
+    with _lock:
+        series = _series.get((kind, label))
+        if series is None:
+            series = _series[(kind, label)] = _Series()
+        series.count += 1
+        series.seconds += seconds
+        series.max_seconds = max(series.max_seconds, seconds)
+        series.buckets[bisect.bisect_left(BUCKETS, seconds)] += 1
+        if error:
+            series.errors += 1
+        if nbytes:
+            series.bytes += nbytes
+        series.retries += retries
+        if status is not None:
+            series.statuses[str(status)] += 1
+
+
+def request_label(method, url):
+    """Return the label of an HTTP request: the method and host, followed by
+     the action name for CKAN API requests.
+    """
+    parts = urlsplit(url)
+    label = f'{method.upper()} {parts.netloc.lower()}'
+    path = parts.path.rstrip('/')
+    marker = '/api/action/'
+    if marker in path:
+        label += ' ' + path[path.index(marker) + len(marker):]
+    return label
+
+
+def summary():
+    """Return the recorded figures as a dictionary, by kind and label.
+    """
+    result = {}
+    with _lock:
+        for (kind, label), series in sorted(_series.items()):
+            result.setdefault(kind, {})[label] = {
+                'count': series.count,
+                'errors': series.errors,
+                'total_seconds': series.seconds,
+                'mean_seconds': series.seconds / series.count if series.count else 0.0,
+                'p50_seconds': series.quantile(0.50),
+                'p95_seconds': series.quantile(0.95),
+                'max_seconds': series.max_seconds,
+                'bytes': series.bytes,
+                'retries': series.retries,
+                'statuses': dict(series.statuses),
+                'buckets': dict(zip([str(bound) for bound in BUCKETS] + ['+Inf'], series.buckets)),
+            }
+    return result
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def prometheus_text():
+    """Return the recorded figures in the Prometheus text exposition format.
+    """
+    lines = [
+        '# HELP ckan_explore_seconds Latency of CKAN actions and HTTP requests.',
+        '# TYPE ckan_explore_seconds histogram',
+    ]
+    totals = []
+    with _lock:
+        for (kind, label), series in sorted(_series.items()):
+            labels = f'kind="{_escape(kind)}",label="{_escape(label)}"'
+            cumulative = 0
+            for bound, count in zip(list(BUCKETS) + ['+Inf'], series.buckets):
+                cumulative += count
+                lines.append(f'ckan_explore_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'ckan_explore_seconds_sum{{{labels}}} {series.seconds}')
+            lines.append(f'ckan_explore_seconds_count{{{labels}}} {series.count}')
+            totals.append((labels, series))
+    for name, help, attribute in (('errors', 'Calls that failed.', 'errors'),
+                                  ('bytes', 'Response bytes received.', 'bytes'),
+                                  ('retries', 'Requests sent again.', 'retries')):
+        lines.append(f'# HELP ckan_explore_{name}_total {help}')
+        lines.append(f'# TYPE ckan_explore_{name}_total counter')
+        for labels, series in totals:
+            lines.append(f'ckan_explore_{name}_total{{{labels}}} {getattr(series, attribute)}')
+    return '\n'.join(lines) + '\n'
+
+
+def write(json_file=None, prometheus_file=None):
+    """Write the JSON summary and the Prometheus text to the passed files, or
+     to the files set when recording was enabled.
+    """
+    json_file = json_file or _files['json']
+    prometheus_file = prometheus_file or _files['prometheus']
+    if json_file:
+        with open(json_file, 'w') as output_file:
+            json.dump(summary(), output_file, indent=2)
+        logging.debug('Wrote metrics summary to %s', json_file)
+    if prometheus_file:
+        with open(prometheus_file, 'w') as output_file:
+            output_file.write(prometheus_text())
+        logging.debug('Wrote Prometheus metrics to %s', prometheus_file)
+
+
+if os.getenv('METRICS_FILE') or os.getenv('METRICS_PROMETHEUS_FILE'):
+    enable(os.getenv('METRICS_FILE') or None, os.getenv('METRICS_PROMETHEUS_FILE') or None)
@@ -0,0 +1,483 @@
+"""Local stand-in for the CKAN action API, serving a synthetic catalog.
+ The server answers the actions used by the scripts in this repository
+ (current_package_list_with_resources, package_search, package_show,
+ package_relationships_list and resource_search), and also serves the data
+ files referenced by the resources, so whole scans can be run offline.
+
+ The catalog is generated from a few parameters: the number of datasets, the
+ number of resources per dataset, the depth and fan-out of a collection
+ hierarchy rooted at the first dataset, and the number of padding bytes added
+ to each dataset to control the size of the responses. A fixed delay can be
+ added to every action call and data file request to imitate a remote server.
+
+ The server can be run on its own from the command line, or started in a
+ separate process from other programs with MockCKAN, as the benchmark script
+ does. The /_stats path reports the number of requests served so far.
+
+ Example: serve a catalog of 5,000 datasets on port 5000, with 50 ms of
+ latency on every request.
+
+     python mock_ckan.py --datasets 5000 --latency 0.05 --port 5000
+
+ """
+import argparse
+import json
+import multiprocessing
+import re
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+_BASE_DATE = datetime(2020, 1, 1)
+
+
+class SyntheticCatalog:
+    """Deterministic catalog of datasets, resources and parent/child relationships.
+    """
+
+    def __init__(self, datasets=1000, resources=2, depth=3, fanout=3,
+                 payload_bytes=0, file_size=64*1024, base_url=''):
+        self.count = datasets
+        self.resources = resources
+        self.fanout = fanout
+        self.payload_bytes = payload_bytes
+        self.file_size = file_size
+        self.base_url = base_url
+        # The first datasets form a single collection hierarchy, rooted at
+        # the first dataset, with the requested depth and fan-out.
+        self.tree_size = min(datasets, sum(fanout ** level for level in range(depth + 1)))
+        self.datasets = [self._dataset(i) for i in range(datasets)]
+        self.by_name = {}
+        for dataset in self.datasets:
+            self.by_name[dataset['name']] = dataset
+            self.by_name[dataset['id']] = dataset
+
+    @staticmethod
+    def dataset_id(i):
+        return f'{i:08x}-0000-4000-8000-{i:012x}'
+
+    @staticmethod
+    def dataset_name(i):
+        return f'dataset-{i}'
+
+    def parent(self, i):
+        if 0 < i < self.tree_size:
+            return (i - 1) // self.fanout
+        return None
+
+    def children(self, i):
+        if i >= self.tree_size:
+            return []
+        return [c for c in range(self.fanout * i + 1, self.fanout * i + self.fanout + 1)
+                if c < self.tree_size]
+
+    def _dataset(self, i):
+        modified = _BASE_DATE + timedelta(minutes=i)
+        dataset = {
+            'id': self.dataset_id(i),
+            'name': self.dataset_name(i),
+            'title': f'Synthetic dataset {i}',
+            'type': 'dataset',
+            'state': 'active',
+            'private': False,
+            'metadata_created': _BASE_DATE.isoformat(),
+            'metadata_modified': modified.isoformat(timespec='microseconds'),
+            'notes': 'x' * self.payload_bytes,
+            'num_resources': self.resources,
+            'num_tags': 1,
+            'organization': {'id': f'org-{i % 10}', 'name': f'organization-{i % 10}'},
+            'extras': [{'key': 'bureau_code', 'value': f'{i % 100:03d}:00'},
+                       {'key': 'data_quality', 'value': 'true' if i % 2 else 'false'}],
+            'tags': [{'display_name': f'tag-{i % 7}'}],
+            'groups': [],
+            'resources': [],
+            'relationships_as_subject': [],
+            'relationships_as_object': [],
+        }
+        # CKAN stores each parent/child relationship once, as child_of with
+        # the child as the subject.
+        parent = self.parent(i)
+        if parent is not None:
+            dataset['relationships_as_subject'].append(self._relationship(i, parent))
+        for child in self.children(i):
+            dataset['relationships_as_object'].append(self._relationship(child, i))
+        for r in range(self.resources):
+            # Every other resource has no recorded size, so it has to be
+            # probed. A tenth of the data files are shared between datasets.
+            file_number = i % max(1, self.count // 10) if r == 0 else i * self.resources + r
+            dataset['resources'].append({
+                'id': f'{i:08x}-{r:04x}-4000-8000-000000000000',
+                'package_id': dataset['id'],
+                'name': f'Resource {r} of dataset {i}',
+                'format': ['CSV', 'JSON', 'XLSX'][r % 3],
+                'url': f'{self.base_url}/files/{file_number}',
+                'size': None if r % 2 == 0 else self.file_size,
+                'position': r,
+            })
+        return dataset
+
+    def _relationship(self, child, parent):
+        return {'id': f'{child:08x}-0000-4000-9000-{parent:012x}',
+                'subject_package_id': self.dataset_id(child),
+                'object_package_id': self.dataset_id(parent),
+                'type': 'child_of', 'comment': '', 'state': 'active'}
+
+    def file_contents(self, number):
+        pattern = f'{number}\n'.encode()
+        return (pattern * (self.file_size // len(pattern) + 1))[:self.file_size]
+
+
+def _field_value(record, field):
+    if field.startswith('extras_'):
+        key = field[len('extras_'):]
+        for extra in record.get('extras', []):
+            if extra['key'] == key:
+                return extra['value']
+        return record.get(key)
+    return record.get(field)
+
+
+def _solr_date(timestamp):
+    # Solr keeps dates to the millisecond and returns them in UTC with a Z,
+    # leaving out a fractional part of zero.
+    moment = datetime.fromisoformat(timestamp)
+    text = moment.strftime('%Y-%m-%dT%H:%M:%S')
+    if moment.microsecond // 1000:
+        text += f'.{moment.microsecond // 1000:03d}'
+    return text + 'Z'
+
+
+def _stored_value(record, field):
+    # The value of a field as returned from the Solr index, when package_search
+    # is called with a field list.
+    value = _field_value(record, field)
+    if value is not None and (field.endswith('modified') or field.endswith('created')):
+        return _solr_date(value)
+    return value
+
+
+_RANGE = re.compile(r'^([\[{])(\S+|"[^"]*") TO (\S+|"[^"]*")([\]}])$')
+
+
+def _clause_matches(record, field, value):
+    actual = _field_value(record, field)
+    if actual is None:
+        return False
+    actual = str(actual)
+    range_match = _RANGE.match(value)
+    if range_match:
+        low_open, low, high, high_open = range_match.groups()
+        low = low.strip('"')
+        high = high.strip('"')
+        if field.endswith('modified') or field.endswith('created'):
+            actual = actual[:19] + 'Z'
+        if low != '*' and (actual < low or (low_open == '{' and actual == low)):
+            return False
+        if high != '*' and (actual > high or (high_open == '}' and actual == high)):
+            return False
+        return True
+    if value.startswith('(') and value.endswith(')'):
+        options = [option.strip().strip('"') for option in value[1:-1].split(' OR ')]
+        return actual in options
+    value = value.strip('"')
+    if value == '*':
+        return True
+    if value.endswith('*'):
+        return actual.startswith(value[:-1])
+    return actual.lower() == value.lower()
+
+
+def _split_clauses(query):
+    clauses = []
+    for match in re.finditer(r'(\S+?):(\([^)]*\)|[\[{][^\]}]*[\]}]|"[^"]*"|\S+)', query or ''):
+        clauses.append((match.group(1), match.group(2)))
+    return clauses
+
+
+def _split_top_level(query, separator):
+    # Split the query on a separator that is not inside brackets or quotes.
+    parts = []
+    depth = 0
+    quoted = False
+    start = 0
+    i = 0
+    while i < len(query):
+        c = query[i]
+        if c == '"':
+            quoted = not quoted
+        elif not quoted and c in '([{':
+            depth += 1
+        elif not quoted and c in ')]}':
+            depth -= 1
+        elif not quoted and depth == 0 and query.startswith(separator, i):
+            parts.append(query[start:i])
+            i += len(separator)
+            start = i
+            continue
+        i += 1
+    parts.append(query[start:])
+    return parts
+
+
+def _query_matches(record, query):
+    if not query or query.strip() == '*:*':
+        return True
+    alternatives = _split_top_level(query, ' OR ')
+    if len(alternatives) > 1:
+        return any(_query_matches(record, alternative) for alternative in alternatives)
+    clauses = _split_clauses(query)
+    if not clauses:
+        text = query.lower()
+        return text in record.get('title', '').lower() or text in record.get('name', '')
+    return all(_clause_matches(record, field, value) for field, value in clauses)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _send_json(self, status, value):
+        self._send(status, json.dumps(value).encode())
+
+    def _count(self, key):
+        with self.server.lock:
+            self.server.stats[key] = self.server.stats.get(key, 0) + 1
+
+    def _file(self):
+        self._count('files')
+        time.sleep(self.server.latency)
+        catalog = self.server.catalog
+        number = self.path.rsplit('/', 1)[-1]
+        if not number.isdigit():
+            return self._send(404, b'Not found', 'text/plain')
+        etag = f'"{number}-{catalog.file_size}"'
+        if self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        contents = catalog.file_contents(int(number))
+        headers = {'ETag': etag, 'Accept-Ranges': 'bytes'}
+        byte_range = re.match(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        if byte_range and self.command == 'GET':
+            start = int(byte_range.group(1))
+            end = int(byte_range.group(2)) if byte_range.group(2) else len(contents) - 1
+            headers['Content-Range'] = f'bytes {start}-{min(end, len(contents) - 1)}/{len(contents)}'
+            return self._send(206, contents[start:end + 1], 'application/octet-stream', headers)
+        return self._send(200, contents, 'application/octet-stream', headers)
+
+    def do_HEAD(self):
+        if self.path.startswith('/files/'):
+            return self._file()
+        return self._send(404, b'', 'text/plain')
+
+    def do_GET(self):
+        if self.path.startswith('/files/'):
+            return self._file()
+        if self.path.startswith('/_stats'):
+            with self.server.lock:
+                return self._send_json(200, dict(self.server.stats))
+        if self.path.startswith('/api/action/'):
+            query = parse_qs(urlsplit(self.path).query)
+            data_dict = {key: values[0] for key, values in query.items()}
+            return self._action(urlsplit(self.path).path.rsplit('/', 1)[-1], data_dict)
+        return self._send(404, b'', 'text/plain')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data_dict = json.loads(self.rfile.read(length) or b'{}')
+        return self._action(self.path.rsplit('/', 1)[-1], data_dict)
+
+    def _action(self, action, data_dict):
+        self._count(action)
+        time.sleep(self.server.latency)
+        method = getattr(self, 'action_' + action, None)
+        if method is None:
+            return self._error(400, 'Bad request - Action name not known: ' + action)
+        try:
+            result = method(self.server.catalog, data_dict)
+        except KeyError as e:
+            return self._error(404, f'Not found: {e}')
+        if result is None:
+            return self._error(404, 'Not found')
+        return self._send_json(200, {'help': '', 'success': True, 'result': result})
+
+    def _error(self, status, message):
+        error_type = 'Not Found Error' if status == 404 else 'Validation Error'
+        return self._send_json(status, {'help': '', 'success': False,
+                                        'error': {'__type': error_type, 'message': message}})
+
+    def action_current_package_list_with_resources(self, catalog, data_dict):
+        offset = int(data_dict.get('offset', 0))
+        limit = int(data_dict.get('limit', 10))
+        return catalog.datasets[offset:offset + limit]
+
+    def action_package_show(self, catalog, data_dict):
+        return catalog.by_name[data_dict['id']]
+
+    def action_package_search(self, catalog, data_dict):
+        results = [d for d in catalog.datasets
+                   if _query_matches(d, data_dict.get('q'))
+                   and _query_matches(d, data_dict.get('fq'))]
+        sort = data_dict.get('sort')
+        if sort:
+            field, direction = (sort.split() + ['asc'])[:2]
+            results.sort(key=lambda d: str(_field_value(d, field)), reverse=direction == 'desc')
+        start = int(data_dict.get('start', 0))
+        rows = int(data_dict.get('rows', 10))
+        page = results[start:start + rows]
+        fields = data_dict.get('fl')
+        if fields:
+            if isinstance(fields, str):
+                fields = fields.split(',')
+            fields = [field.strip() for field in fields if field.strip()]
+            if fields:
+                page = [{field: _stored_value(d, field) for field in fields} for d in page]
+        return {'count': len(results), 'results': page, 'sort': sort or 'score desc'}
+
+    def action_package_relationships_list(self, catalog, data_dict):
+        i = catalog.by_name[data_dict['id']]
+        i = int(i['name'].rsplit('-', 1)[-1])
+        name = catalog.dataset_name(i)
+        if data_dict.get('rel') == 'parent_of':
+            relationships = [{'subject': name, 'object': catalog.dataset_name(c),
+                              'type': 'parent_of', 'comment': ''}
+                             for c in catalog.children(i)]
+        elif data_dict.get('rel') == 'child_of':
+            parent = catalog.parent(i)
+            relationships = [] if parent is None else [
+                {'subject': name, 'object': catalog.dataset_name(parent),
+                 'type': 'child_of', 'comment': ''}]
+        else:
+            relationships = []
+        # CKAN reports a package without relationships as not found.
+        return relationships or None
+
+    def action_resource_search(self, catalog, data_dict):
+        query = data_dict.get('query', [])
+        if isinstance(query, str):
+            query = [query]
+        terms = [term.split(':', 1) for term in query if ':' in term]
+        results = [resource for d in catalog.datasets for resource in d['resources']
+                   if all(value.lower() in str(resource.get(field, '')).lower()
+                          for field, value in terms)]
+        order_by = data_dict.get('order_by')
+        if order_by:
+            results.sort(key=lambda r: str(r.get(order_by)))
+        offset = int(data_dict.get('offset', 0))
+        limit = data_dict.get('limit')
+        page = results[offset:] if limit is None else results[offset:offset + int(limit)]
+        return {'count': len(results), 'results': page}
+
+
+def create_server(host='127.0.0.1', port=0, latency=0.0, **catalog_options):
+    """Create, but do not start, a server for a synthetic catalog.
+    """
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.lock = threading.Lock()
+    server.stats = {}
+    base_url = f'http://{host}:{server.server_address[1]}'
+    server.catalog = SyntheticCatalog(base_url=base_url, **catalog_options)
+    return server
+
+
+def _serve(queue, host, port, latency, catalog_options):
+    server = create_server(host, port, latency, **catalog_options)
+    queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+class MockCKAN:
+    """Run the mock CKAN server in a separate process, so its memory use and
+     CPU time do not count against the program being measured.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.0, **catalog_options):
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.catalog_options = catalog_options
+        self._process = None
+
+    @property
+    def url(self):
+        return f'http://{self.host}:{self.port}'
+
+    def start(self):
+        queue = multiprocessing.Queue()
+        self._process = multiprocessing.Process(
+            target=_serve, daemon=True,
+            args=(queue, self.host, self.port, self.latency, self.catalog_options))
+        self._process.start()
+        self.port = queue.get(timeout=60)
+        return self
+
+    def stats(self):
+        """Return the number of requests served so far, by action.
+        """
+        import urllib.request
+        with urllib.request.urlopen(self.url + '/_stats') as response:
+            return json.load(response)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+if __name__ == '__main__':
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Serve a synthetic catalog through a local stand-in for the CKAN action API.
+''')
+    ap.add_argument('--host', dest='host', default='127.0.0.1',
+        help='The address to listen on.')
+    ap.add_argument('-p', '--port', dest='port', default=5000, type=int,
+        help='The port to listen on.')
+    ap.add_argument('-d', '--datasets', dest='datasets', default=1000, type=int,
+        help='The number of datasets in the catalog.')
+    ap.add_argument('-r', '--resources', dest='resources', default=2, type=int,
+        help='The number of resources in each dataset.')
+    ap.add_argument('--depth', dest='depth', default=3, type=int,
+        help='The depth of the collection hierarchy rooted at the first dataset.')
+    ap.add_argument('--fanout', dest='fanout', default=3, type=int,
+        help='The number of children of each collection in the hierarchy.')
+    ap.add_argument('--payload-bytes', dest='payload_bytes', default=0, type=int,
+        help='The number of padding bytes added to the description of each dataset.')
+    ap.add_argument('--file-size', dest='file_size', default=64*1024, type=int,
+        help='The size in bytes of each data file.')
+    ap.add_argument('-l', '--latency', dest='latency', default=0.0, type=float,
+        help='The number of seconds to wait before answering each request.')
+    args = ap.parse_args()
+
+    server = create_server(args.host, args.port, args.latency,
+                           datasets=args.datasets, resources=args.resources,
+                           depth=args.depth, fanout=args.fanout,
+                           payload_bytes=args.payload_bytes, file_size=args.file_size)
+    print(f'Serving {args.datasets} datasets at http://{args.host}:{server.server_address[1]}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
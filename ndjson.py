@@ -0,0 +1,91 @@
+"""Helpers for reading and writing newline-delimited JSON (NDJSON) files.
+ Each record is written as a single line of compact JSON, so files can be
+ produced and consumed one record at a time without holding the whole
+ collection in memory.
+
+ Files with names ending in ".gz" are compressed with gzip. Compressed input
+ files are recognized by their contents, regardless of the file name. The
+ file name "-" refers to standard output or standard input.
+
+ """
+import contextlib
+import gzip
+import json
+import os
+import sys
+
+_GZIP_MAGIC = b'\x1f\x8b'
+
+
+@contextlib.contextmanager
+def open_output(file_name, compress=None, append=False):
+    """Open a file for writing NDJSON records, compressing the output with gzip
+     if requested or if the file name ends in ".gz". With append, records are
+     added to the end of an existing file; compressed output is added as a
+     new gzip member, which gzip readers treat as a continuation.
+    """
+    if file_name == '-':
+        yield sys.stdout
+        sys.stdout.flush()
+        return
+    if compress is None:
+        compress = file_name.endswith('.gz')
+    mode = 'a' if append else 'w'
+    if compress:
+        output_file = gzip.open(file_name, mode + 't', encoding='utf-8')
+    else:
+        output_file = open(file_name, mode, encoding='utf-8')
+    with output_file:
+        yield output_file
+
+
+@contextlib.contextmanager
+def open_input(file_name):
+    """Open an NDJSON file for reading, decompressing it if it is gzipped.
+    """
+    if file_name == '-':
+        yield sys.stdin
+        return
+    with open(file_name, 'rb') as probe:
+        compressed = probe.read(2) == _GZIP_MAGIC
+    if compressed:
+        input_file = gzip.open(file_name, 'rt', encoding='utf-8')
+    else:
+        input_file = open(file_name, 'r', encoding='utf-8')
+    with input_file:
+        yield input_file
+
+
+def write_record(output_file, record):
+    """Write one record to an open NDJSON file.
+    """
+    output_file.write(json.dumps(record, separators=(',', ':')))
+    output_file.write('\n')
+
+
+def read_records(file_name):
+    """Yield the records in an NDJSON file, one at a time.
+    """
+    with open_input(file_name) as input_file:
+        for line in input_file:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def truncate_records(file_name, count, compress=None):
+    """Keep only the first count records of an NDJSON file, dropping the rest
+     along with any partly written record at the end.
+    """
+    temp_file_name = file_name + '.tmp'
+    with open_input(file_name) as input_file, \
+            open_output(temp_file_name, compress if compress is not None
+                        else file_name.endswith('.gz')) as output_file:
+        kept = 0
+        while kept < count:
+            line = input_file.readline()
+            if not line.endswith('\n'):
+                raise ValueError(f'{file_name} has only {kept} of {count} records.')
+            output_file.write(line)
+            kept += 1
+    os.replace(temp_file_name, file_name)
@@ -0,0 +1,529 @@
+"""Python command-line script for indexing a harvested CKAN snapshot for offline queries.
+ The datasets in a snapshot written by retrieve_all_metadata.py are loaded
+ into a local SQLite database, with a full-text (FTS5) index over the dataset
+ text and an index of every field value of the datasets and their resources.
+
+ The index answers the package_search and resource_search actions through
+ the same call_action method as a CKAN client, so package_search.py and
+ resource_search.py can run their queries against it with the --offline
+ option instead of against the remote Solr. The supported query syntax is:
+ - field:value, field:"quoted value" and field:(value OR value) clauses,
+   where a value may contain * and ? wildcards, and field:* matches any
+   dataset with the field;
+ - field:[low TO high] ranges, with { or } for exclusive bounds and * for an
+   open bound;
+ - extras_name for the extras fields, which the snapshot stores as top-level
+   fields, and the tags, groups, organization and res_format fields;
+ - bare words and "quoted phrases", and title:, notes: and text: clauses,
+   which are matched against the full-text index;
+ - AND, OR, NOT, - and parentheses, with AND as the default operator.
+ Field values are matched without regard to case. As in CKAN, resource_search
+ queries are field:term pairs matched as partial, case-insensitive strings.
+
+ Results without an fl projection are the flattened datasets stored in the
+ snapshot, rather than the nested datasets CKAN returns.
+
+ Example: build the index for a snapshot. Passing the snapshot itself to
+ --offline also builds the index, and rebuilds it when the snapshot changes.
+
+     python offline_index.py catalog.ndjson.gz catalog.sqlite
+     python package_search.py --offline catalog.sqlite extras_data_quality:false id name
+
+ """
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+import columnar_export
+
+_INDEX_SCHEMA = '''
+CREATE TABLE datasets (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT,
+    name TEXT,
+    body TEXT
+);
+CREATE TABLE dataset_fields (
+    dataset INTEGER,
+    field TEXT,
+    value TEXT
+);
+CREATE TABLE resources (
+    rowid INTEGER PRIMARY KEY,
+    dataset INTEGER,
+    id TEXT,
+    body TEXT
+);
+CREATE TABLE resource_fields (
+    resource INTEGER,
+    field TEXT,
+    value TEXT
+);
+CREATE VIRTUAL TABLE datasets_fts USING fts5 (name, title, notes, tags, text, content='');
+'''
+
+# The field indexes are created after loading, which is much faster than
+# keeping them up to date row by row.
+_INDEX_INDEXES = '''
+CREATE UNIQUE INDEX datasets_id ON datasets (id);
+CREATE INDEX dataset_fields_value ON dataset_fields (field, value COLLATE NOCASE);
+CREATE INDEX resource_fields_value ON resource_fields (field, value COLLATE NOCASE);
+CREATE INDEX resources_id ON resources (id);
+'''
+
+# Solr field names that refer to fields stored under other names in the
+# flattened snapshot.
+_ALIASES = {
+    'tags': 'taglist',
+    'groups': 'grouplist',
+    'organization': 'org_name',
+}
+
+# Fields matched against the full-text index rather than their exact values.
+_TEXT_FIELDS = {'title', 'notes', 'text'}
+
+_BATCH_SIZE = 1000
+
+
+def _values(value):
+    # Return the indexed text values of a field, as Solr would render them.
+    if value is None:
+        return []
+    if isinstance(value, bool):
+        return ['true' if value else 'false']
+    if isinstance(value, (int, float, str)):
+        return [str(value)]
+    if isinstance(value, list):
+        return [v for item in value if not isinstance(item, (dict, list)) for v in _values(item)]
+    return []
+
+
+def _dataset_rows(rowid, dataset):
+    fields = []
+    for field, value in dataset.items():
+        if field == 'resources':
+            continue
+        for text in _values(value):
+            fields.append((rowid, field, text))
+    for solr_field, field in _ALIASES.items():
+        for text in _values(dataset.get(field)):
+            fields.append((rowid, solr_field, text))
+    for resource in dataset.get('resources') or []:
+        for field, solr_field in (('format', 'res_format'), ('url', 'res_url'), ('name', 'res_name')):
+            for text in _values(resource.get(field)):
+                fields.append((rowid, solr_field, text))
+    text = ' '.join(value for row_id, field, value in fields)
+    fts = (rowid, dataset.get('name') or '', dataset.get('title') or '',
+           dataset.get('notes') or '', ' '.join(_values(dataset.get('taglist'))), text)
+    return fields, fts
+
+
+def build_index(snapshot_file_name, index_file_name, batch_size=_BATCH_SIZE):
+    """Build the index for a snapshot written by retrieve_all_metadata.py. The
+     index is written to a temporary file and moved into place when complete.
+    """
+    temp_file_name = index_file_name + '.tmp'
+    if os.path.exists(temp_file_name):
+        os.remove(temp_file_name)
+    db = sqlite3.connect(temp_file_name)
+    db.executescript(_INDEX_SCHEMA)
+
+    datasets, fields, fts, resources, resource_fields = [], [], [], [], []
+    def flush():
+        db.executemany('INSERT INTO datasets VALUES (?, ?, ?, ?)', datasets)
+        db.executemany('INSERT INTO dataset_fields VALUES (?, ?, ?)', fields)
+        db.executemany('INSERT INTO datasets_fts (rowid, name, title, notes, tags, text) '
+                       'VALUES (?, ?, ?, ?, ?, ?)', fts)
+        db.executemany('INSERT INTO resources VALUES (?, ?, ?, ?)', resources)
+        db.executemany('INSERT INTO resource_fields VALUES (?, ?, ?)', resource_fields)
+        for rows in (datasets, fields, fts, resources, resource_fields):
+            rows.clear()
+
+    count = 0
+    resource_rowid = 0
+    for rowid, dataset in enumerate(columnar_export.read_snapshot(snapshot_file_name), 1):
+        datasets.append((rowid, dataset.get('id'), dataset.get('name'), json.dumps(dataset)))
+        dataset_fields, dataset_fts = _dataset_rows(rowid, dataset)
+        fields.extend(dataset_fields)
+        fts.append(dataset_fts)
+        for resource in dataset.get('resources') or []:
+            resource_rowid += 1
+            resources.append((resource_rowid, rowid, resource.get('id'), json.dumps(resource)))
+            for field, value in resource.items():
+                for text in _values(value):
+                    resource_fields.append((resource_rowid, field, text))
+        count = rowid
+        if len(datasets) >= batch_size:
+            flush()
+    flush()
+    db.executescript(_INDEX_INDEXES)
+    db.commit()
+    db.close()
+    os.replace(temp_file_name, index_file_name)
+    logging.info('Indexed %d datasets and %d resources from %s in %s',
+                 count, resource_rowid, snapshot_file_name, index_file_name)
+
+
+_SPACE = re.compile(r'\s*')
+_FIELD_NAME = re.compile(r'([\w@\-.]+|\*):(?=\S)')
+_QUOTED = re.compile(r'"((?:[^"\\]|\\.)*)"')
+_RANGE = re.compile(r'([\[{])\s*(\S+)\s+TO\s+(\S+)\s*([\]}])')
+_WORD = re.compile(r'[^\s()]+')
+_DATE = re.compile(r'^(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?Z?$')
+
+
+def _date_ms(value):
+    # Reduce a timestamp, either as CKAN stores it or as a Solr date, to the
+    # millisecond precision of the Solr index, so that the two can be
+    # compared as strings. Other values are returned unchanged.
+    match = _DATE.match(value) if isinstance(value, str) else None
+    if match is None:
+        return value
+    return f"{match.group(1)}.{(match.group(2) or '')[:3].ljust(3, '0')}"
+
+
+def _range_bound(bound):
+    # Return a range bound as a number, a string or None for an open bound.
+    # Quoted bounds are strings. Solr dates are reduced to the form compared
+    # against the stored timestamps.
+    if bound == '*':
+        return None
+    if bound.startswith('"'):
+        return bound.strip('"')
+    try:
+        return float(bound)
+    except ValueError:
+        pass
+    return _date_ms(bound)
+
+
+class _QueryParser:
+    """Recursive descent parser turning a Solr query string into a tree of
+     tuples: ('all',), ('and', [nodes]), ('or', [nodes]), ('not', node),
+     ('text', column, phrase, prefix), ('value', field, value, quoted) and
+     ('range', field, low, high, include_low, include_high).
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.pos = 0
+
+    def parse(self):
+        node = self.parse_or()
+        self.skip_space()
+        if self.pos < len(self.query):
+            raise ValueError(f'Unexpected text at position {self.pos} of query {self.query!r}')
+        return node
+
+    def skip_space(self):
+        self.pos = _SPACE.match(self.query, self.pos).end()
+
+    def peek_keyword(self, keyword):
+        self.skip_space()
+        end = self.pos + len(keyword)
+        if (self.query.startswith(keyword, self.pos)
+                and (end == len(self.query) or self.query[end] in ' \t\n()')):
+            return end
+        return None
+
+    def at_end_of_group(self):
+        self.skip_space()
+        return self.pos >= len(self.query) or self.query[self.pos] == ')'
+
+    def parse_or(self, field=None):
+        nodes = [self.parse_and(field)]
+        while True:
+            end = self.peek_keyword('OR') or self.peek_keyword('||')
+            if end is None:
+                break
+            self.pos = end
+            nodes.append(self.parse_and(field))
+        return nodes[0] if len(nodes) == 1 else ('or', nodes)
+
+    def parse_and(self, field=None):
+        nodes = [self.parse_unary(field)]
+        while not self.at_end_of_group():
+            if self.peek_keyword('OR') or self.peek_keyword('||'):
+                break
+            end = self.peek_keyword('AND') or self.peek_keyword('&&')
+            if end is not None:
+                self.pos = end
+            nodes.append(self.parse_unary(field))
+        return nodes[0] if len(nodes) == 1 else ('and', nodes)
+
+    def parse_unary(self, field=None):
+        self.skip_space()
+        end = self.peek_keyword('NOT')
+        if end is not None:
+            self.pos = end
+            return ('not', self.parse_unary(field))
+        if self.query.startswith('-', self.pos):
+            self.pos += 1
+            return ('not', self.parse_unary(field))
+        if self.query.startswith('+', self.pos):
+            self.pos += 1
+        return self.parse_primary(field)
+
+    def parse_primary(self, field=None):
+        self.skip_space()
+        if self.pos >= len(self.query):
+            raise ValueError(f'Unexpected end of query {self.query!r}')
+        if self.query[self.pos] == '(':
+            self.pos += 1
+            node = self.parse_or(field)
+            self.skip_space()
+            if not self.query.startswith(')', self.pos):
+                raise ValueError(f'Missing ) in query {self.query!r}')
+            self.pos += 1
+            return node
+        if field is None:
+            match = _FIELD_NAME.match(self.query, self.pos)
+            if match:
+                self.pos = match.end()
+                name = match.group(1)
+                if name == '*':
+                    self.parse_value(name)
+                    return ('all',)
+                return self.parse_primary(name)
+        return self.parse_value(field)
+
+    def parse_value(self, field):
+        match = _QUOTED.match(self.query, self.pos)
+        if match:
+            self.pos = match.end()
+            value = re.sub(r'\\(.)', r'\1', match.group(1))
+            return self.make_value(field, value, quoted=True)
+        match = _RANGE.match(self.query, self.pos)
+        if match and field is not None:
+            self.pos = match.end()
+            low, high = [_range_bound(bound) for bound in (match.group(2), match.group(3))]
+            return ('range', field, low, high, match.group(1) == '[', match.group(4) == ']')
+        match = _WORD.match(self.query, self.pos)
+        if not match:
+            raise ValueError(f'Expected a value at position {self.pos} of query {self.query!r}')
+        self.pos = match.end()
+        return self.make_value(field, re.sub(r'\\(.)', r'\1', match.group(0)), quoted=False)
+
+    def make_value(self, field, value, quoted):
+        if field is None or field in _TEXT_FIELDS:
+            column = None if field in (None, 'text') else field
+            if value == '*':
+                return ('all',)
+            prefix = not quoted and value.endswith('*')
+            return ('text', column, value.rstrip('*') if prefix else value, prefix)
+        return ('value', field, value, quoted)
+
+
+def parse_query(query):
+    """Parse a Solr query string, returning a tree of tuples."""
+    if query is None or not query.strip():
+        return ('all',)
+    return _QueryParser(query).parse()
+
+
+def _field_name(field):
+    if field.startswith('extras_'):
+        return field[len('extras_'):]
+    return field
+
+
+def _like_pattern(value):
+    escaped = value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    return escaped.replace('*', '%').replace('?', '_')
+
+
+def _fts_phrase(column, phrase, prefix):
+    expression = '"' + phrase.replace('"', '""') + '"' + (' *' if prefix else '')
+    return expression if column is None else f'{column} : {expression}'
+
+
+def compile_query(node, params):
+    """Compile a parsed query into an SQL condition on the datasets table,
+     aliased d, appending its parameters to the passed list.
+    """
+    kind = node[0]
+    if kind == 'all':
+        return '1'
+    if kind in ('and', 'or'):
+        joiner = ' AND ' if kind == 'and' else ' OR '
+        return '(' + joiner.join(compile_query(child, params) for child in node[1]) + ')'
+    if kind == 'not':
+        return f'NOT {compile_query(node[1], params)}'
+    if kind == 'text':
+        if not node[2]:
+            return '1'
+        params.append(_fts_phrase(node[1], node[2], node[3]))
+        return 'd.rowid IN (SELECT rowid FROM datasets_fts WHERE datasets_fts MATCH ?)'
+    field = _field_name(node[1])
+    params.append(field)
+    subquery = 'd.rowid IN (SELECT dataset FROM dataset_fields WHERE field = ?'
+    if kind == 'value':
+        value, quoted = node[2:]
+        if value == '*' and not quoted:
+            return subquery + ')'
+        if not quoted and ('*' in value or '?' in value):
+            params.append(_like_pattern(value))
+            return subquery + " AND value LIKE ? ESCAPE '\\')"
+        params.append(value)
+        return subquery + ' AND value = ? COLLATE NOCASE)'
+    # A range, compared as numbers when both bounds are numbers, and as
+    # timestamps at the same precision when either bound is a date.
+    low, high, include_low, include_high = node[2:]
+    numeric = all(bound is None or isinstance(bound, float) for bound in (low, high))
+    if numeric:
+        column = 'CAST(value AS REAL)'
+    elif any(isinstance(bound, str) and _DATE.match(bound) for bound in (low, high)):
+        column = 'date_ms(value)'
+    else:
+        column = 'value COLLATE NOCASE'
+    conditions = []
+    for bound, include, operator in ((low, include_low, '>'), (high, include_high, '<')):
+        if bound is not None:
+            params.append(bound if numeric else str(bound))
+            conditions.append(f'{column} {operator}{"=" if include else ""} ?')
+    return subquery + ''.join(' AND ' + condition for condition in conditions) + ')'
+
+
+def _field_list(fl):
+    if fl is None:
+        return None
+    if isinstance(fl, str):
+        fl = re.split(r'[\s,]+', fl.strip())
+    return [field for field in fl if field] or None
+
+
+def _project(dataset, field_list):
+    if field_list is None:
+        return dataset
+    return {field: dataset.get(_ALIASES.get(field, _field_name(field)))
+            for field in field_list}
+
+
+class OfflineIndex:
+    """Local index of a harvested snapshot, answering package_search and
+     resource_search calls in the same way as a CKAN client.
+    """
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.create_function('date_ms', 1, _date_ms, deterministic=True)
+        self._lock = threading.Lock()
+
+    def call_action(self, action, data_dict=None, **kwargs):
+        data_dict = data_dict or {}
+        if action == 'package_search':
+            return self.package_search(**data_dict)
+        if action == 'resource_search':
+            return self.resource_search(**data_dict)
+        raise ValueError(f'The {action} action is not available offline.')
+
+    def package_search(self, q='*:*', fq=None, fl=None, rows=10, start=0, sort=None, **kwargs):
+        """Return the count and the requested page of datasets matching the
+         query and filter query.
+        """
+        params = []
+        condition = compile_query(parse_query(q), params)
+        if fq:
+            condition += ' AND ' + compile_query(parse_query(fq), params)
+        order = 'd.id'
+        order_params = []
+        if sort:
+            field, direction = (sort.split() + ['asc'])[:2]
+            direction = 'DESC' if direction.lower() == 'desc' else 'ASC'
+            if field == 'id':
+                order = f'd.id {direction}'
+            else:
+                order = (f'(SELECT min(value) FROM dataset_fields WHERE dataset = d.rowid '
+                         f'AND field = ?) {direction}, d.id')
+                order_params = [_field_name(field)]
+        field_list = _field_list(fl)
+        with self._lock:
+            count = self._db.execute(f'SELECT count(*) FROM datasets d WHERE {condition}',
+                                     params).fetchone()[0]
+            rows = self._db.execute(f'SELECT body FROM datasets d WHERE {condition} '
+                                    f'ORDER BY {order} LIMIT ? OFFSET ?',
+                                    params + order_params + [int(rows), int(start)]).fetchall()
+        return {'count': count,
+                'results': [_project(json.loads(row[0]), field_list) for row in rows]}
+
+    def resource_search(self, query=None, fields=None, order_by=None, offset=0, limit=None, **kwargs):
+        """Return the count and the requested page of resources with field
+         values containing every field:term pair of the query.
+        """
+        terms = []
+        if isinstance(query, str):
+            terms = re.findall(r'(?:[^\s"]|"[^"]*")+', query)
+        elif query:
+            terms = list(query)
+        for field, term in (fields or {}).items():
+            terms.append(f'{field}:{term}')
+        conditions, params = [], []
+        for term in terms:
+            field, separator, value = term.partition(':')
+            if not separator:
+                raise ValueError(f'Resource search terms must be in the form field:term, not {term!r}')
+            conditions.append('r.rowid IN (SELECT resource FROM resource_fields '
+                              "WHERE field = ? AND value LIKE ? ESCAPE '\\')")
+            params.extend([field, '%' + _like_pattern(value.strip('"')) + '%'])
+        condition = ' AND '.join(conditions) or '1'
+        order = 'r.id'
+        order_params = []
+        if order_by and order_by != 'id':
+            order = ('(SELECT min(value) FROM resource_fields WHERE resource = r.rowid '
+                     'AND field = ?), r.id')
+            order_params = [order_by]
+        with self._lock:
+            count = self._db.execute(f'SELECT count(*) FROM resources r WHERE {condition}',
+                                     params).fetchone()[0]
+            rows = self._db.execute(f'SELECT body FROM resources r WHERE {condition} '
+                                    f'ORDER BY {order} LIMIT ? OFFSET ?',
+                                    params + order_params +
+                                    [-1 if limit is None else int(limit), int(offset)]).fetchall()
+        return {'count': count, 'results': [json.loads(row[0]) for row in rows]}
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def open_index(path):
+    """Open an offline index. If the path names a snapshot rather than an
+     index, the index is kept in a file next to it, and built when missing
+     or older than the snapshot.
+    """
+    if path.endswith(('.sqlite', '.db')):
+        return OfflineIndex(path)
+    index_file_name = path + '.sqlite'
+    if (not os.path.exists(index_file_name)
+            or os.path.getmtime(index_file_name) < os.path.getmtime(path)):
+        build_index(path, index_file_name)
+    return OfflineIndex(index_file_name)
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Index a metadata snapshot for offline package and resource searches.
+''')
+    ap.add_argument('snapshot_file_name',
+        help='The snapshot written by retrieve_all_metadata.py, as JSON or newline-delimited JSON.')
+    ap.add_argument('index_file_name', nargs='?', default=None,
+        help='The index file to write. Defaults to the snapshot file name followed by ".sqlite".')
+    ap.add_argument('-b', '--batch-size', dest='batch_size', default=_BATCH_SIZE, type=int,
+        help='The number of datasets to load at a time.')
+    args = ap.parse_args()
+
+    build_index(args.snapshot_file_name,
+                args.index_file_name or args.snapshot_file_name + '.sqlite',
+                args.batch_size)
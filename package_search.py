@@ -29,14 +29,48 @@
   
     python package_search.py extras_data_quality:false id name title
 
+ By default only the first ten matching packages are printed. With the --all
+ option, every matching package is written as newline-delimited JSON, one
+ package per line, as the results arrive. Pages of results are requested
+ concurrently. Result sets larger than the --keyset-threshold are split into
+ ranges of package ids that are walked in id order, each page starting after
+ the last id of the previous one, so Solr never has to skip over a deep
+ start offset. Packages from different ranges are interleaved in the output.
+
+  Example: Export every package for which the extras data_quality field is
+  false to a compressed file.
+
+    python package_search.py --all -o low_quality.ndjson.gz \
+      extras_data_quality:false
+
+ With the --offline option, the query is answered from a local index of a
+ snapshot written by retrieve_all_metadata.py (see offline_index.py) rather
+ than by the CKAN instance, and no API key is needed.
+
+  Example: Search a snapshot offline.
+
+    python package_search.py --offline catalog.ndjson.gz \
+      extras_data_quality:false id name title
+
 """
+import argparse
 import json
 import logging
 import os
+import queue
 import sys
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
-from ckanapi import RemoteCKAN
+import ndjson
+import offline_index
+import paginator
+from transport import RemoteCKAN
+
+# Boundaries splitting the space of package ids, which are UUIDs, into
+# ranges that can be walked independently.
+_ID_BOUNDARIES = list('123456789abcdef')
 
 def do_package_search(ckan_connection, search_term = "*:*", field_list = None):
     result = None
@@ -54,6 +88,134 @@ def do_package_search(ckan_connection, search_term = "*:*", field_list = None):
         return result
 
     return result.get('results',None)
+
+def _search_data_dict(search_term, field_list, rows, start=0, fq=None):
+    data_dict = {
+        'rows': rows,
+        'start': start,
+        'include_private': True,
+        'include_drafts': True,
+        'q': search_term,
+        'fl': field_list,
+        'sort': 'id asc'
+        }
+    if fq is not None:
+        data_dict['fq'] = fq
+    return data_dict
+
+def _id_ranges():
+    bounds = [None] + _ID_BOUNDARIES + [None]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+def _put(pages, item, stop):
+    # Put an item on the queue, giving up if the consumer has stopped.
+    while not stop.is_set():
+        try:
+            pages.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+def _walk_id_range(ckan_connection, search_term, field_list, rows, low, high, pages, stop):
+    # Walk one range of package ids in order, putting each page of results
+    # on the queue. The lower bound of the range is inclusive and the upper
+    # bound exclusive; None leaves the range open at that end.
+    last_id = None
+    try:
+        while not stop.is_set():
+            if last_id is not None:
+                lower = f'{{"{last_id}"'
+            elif low is not None:
+                lower = f'["{low}"'
+            else:
+                lower = '[*'
+            upper = '*]' if high is None else f'"{high}"}}'
+            result = ckan_connection.call_action(action='package_search',
+                data_dict=_search_data_dict(search_term, field_list, rows,
+                                            fq=f'id:{lower} TO {upper}'))
+            datasets = result.get('results', [])
+            if len(datasets) == 0: break
+            if not _put(pages, datasets, stop): break
+            last_id = datasets[-1]['id']
+    except Exception as e:
+        _put(pages, e, stop)
+    finally:
+        _put(pages, None, stop)
+
+def iter_package_search(ckan_connection, search_term = "*:*", field_list = None,
+                        rows = 1000, concurrency = paginator.DEFAULT_CONCURRENCY,
+                        keyset_threshold = 10000):
+    """Yield every package matching the search term, with the listed fields.
+     Pages of results are requested concurrently. Result sets with more
+     matches than the keyset threshold are walked by ranges of package ids
+     instead of start offsets.
+    """
+    requested_fields = list(field_list or [])
+    fields = requested_fields
+    if requested_fields and 'id' not in requested_fields:
+        fields = requested_fields + ['id']
+
+    def project(dataset):
+        if fields is not requested_fields:
+            dataset.pop('id', None)
+        return dataset
+
+    result = ckan_connection.call_action(action='package_search',
+        data_dict=_search_data_dict(search_term, fields, 0))
+    count = result.get('count', 0)
+    logging.info('Found %d packages matching %s', count, search_term)
+
+    if count <= keyset_threshold:
+        def fetch_page(offset, limit):
+            result = ckan_connection.call_action(action='package_search',
+                data_dict=_search_data_dict(search_term, fields, limit, offset))
+            return result.get('results', [])
+        for offset, datasets in paginator.iter_pages(fetch_page, rows, concurrency):
+            for dataset in datasets:
+                yield project(dataset)
+        return
+
+    # Walk the id ranges concurrently, holding at most a few pages in memory.
+    pages = queue.Queue(maxsize=2 * concurrency)
+    stop = threading.Event()
+    ranges = _id_ranges()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for low, high in ranges:
+            executor.submit(_walk_id_range, ckan_connection, search_term, fields,
+                            rows, low, high, pages, stop)
+        try:
+            remaining = len(ranges)
+            error = None
+            while remaining:
+                page = pages.get()
+                if page is None:
+                    remaining -= 1
+                elif isinstance(page, Exception):
+                    error = page
+                else:
+                    for dataset in page:
+                        yield project(dataset)
+            if error is not None:
+                raise error
+        finally:
+            # Release any walks still waiting to hand over a page.
+            stop.set()
+
+def write_package_search(ckan_connection, output_file_name, search_term = "*:*",
+                         field_list = None, rows = 1000,
+                         concurrency = paginator.DEFAULT_CONCURRENCY,
+                         keyset_threshold = 10000):
+    """Write every package matching the search term to a newline-delimited JSON file.
+    """
+    count = 0
+    with ndjson.open_output(output_file_name) as output_file:
+        for dataset in iter_package_search(ckan_connection, search_term, field_list,
+                                           rows, concurrency, keyset_threshold):
+            ndjson.write_record(output_file, dataset)
+            count += 1
+    logging.info('Wrote %d packages to %s', count, output_file_name)
+    return count
  	
 if __name__ == '__main__':
 
@@ -62,27 +224,52 @@ if __name__ == '__main__':
 
     errors = []
 
-    if not url:
-        errors.append('ED_CKAN_URL environment variable is needed.')
-    if not api_key:
-        errors.append('ED_CKAN_KEY environment variable is needed.')
-
-    search_text = "*:*"
-    field_list = []
-    if len(sys.argv) > 1:
-        search_text = sys.argv[1]
-    for arg in sys.argv[2:]:
-        field_list.append(arg)
-        
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Search the packages in a CKAN instance, returning only the listed fields.
+''')
+    ap.add_argument('search_text', nargs='?', default='*:*',
+        help='The query string to use in conducting the search.')
+    ap.add_argument('field_list', nargs='*',
+        help='The names of the fields to include in the results.')
+    ap.add_argument('-a', '--all', dest='all', action='store_true',
+        help='Write every matching package as newline-delimited JSON, instead of printing the '
+             'first ten.')
+    ap.add_argument('-o', '--output', dest='output', default='-',
+        help='The file for the newline-delimited JSON results. Defaults to standard output.')
+    ap.add_argument('--rows', dest='rows', default=1000, type=int,
+        help='The number of packages to request in each page of results.')
+    ap.add_argument('--concurrency', dest='concurrency', default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of pages of results to request at the same time.')
+    ap.add_argument('--offline', dest='offline', default=None,
+        help='Search a local index, or the snapshot written by retrieve_all_metadata.py, '
+             'instead of the CKAN instance.')
+    ap.add_argument('--keyset-threshold', dest='keyset_threshold', default=10000, type=int,
+        help='The number of matches above which results are walked by ranges of package ids '
+             'rather than start offsets.')
+    args = ap.parse_args()
+
+    if args.offline is None:
+        if not url:
+            errors.append('ED_CKAN_URL environment variable is needed.')
+        if not api_key:
+            errors.append('ED_CKAN_KEY environment variable is needed.')
+
     if len(errors):
         for e in errors:
             logging.error(e)
         sys.exit(1)
 
-    remote_ckan = RemoteCKAN(address=url, apikey=api_key)
+    if args.offline is not None:
+        remote_ckan = offline_index.open_index(args.offline)
+    else:
+        remote_ckan = RemoteCKAN(address=url, apikey=api_key)
+
+    if args.all:
+        write_package_search(remote_ckan, args.output, args.search_text, args.field_list,
+                             args.rows, args.concurrency, args.keyset_threshold)
+        sys.exit(0)
 
     # Perform the package search.
-    dataset_list = do_package_search(remote_ckan, search_text, field_list)
+    dataset_list = do_package_search(remote_ckan, args.search_text, args.field_list)
 
     print(json.dumps(dataset_list, indent=2))
-    
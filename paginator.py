@@ -0,0 +1,86 @@
+"""Parallel paginator for listing every dataset in a CKAN instance.
+ The current_package_list_with_resources action returns the datasets a page
+ at a time. Rather than waiting for each page before requesting the next,
+ the paginator keeps several page requests in flight and yields the datasets
+ in their original order as the pages arrive. The scan stops at the first
+ empty page; any requests already sent for later pages are discarded.
+
+ A scan can also be limited to one shard of the pages, as an (index, count)
+ pair (see sharding.py), so several processes can each list a disjoint
+ share of the catalog. Shard i of N requests every N-th page, starting with
+ page i.
+
+ """
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_CONCURRENCY = 4
+
+
+def page_stride(page_size, shard=None):
+    """Return the distance between the offsets of consecutive pages in a
+     scan of the passed shard, or of all pages if shard is None.
+    """
+    return page_size * (1 if shard is None else shard[1])
+
+
+def first_offset(page_size, shard=None):
+    """Return the offset of the first page in a scan of the passed shard.
+    """
+    return 0 if shard is None else page_size * shard[0]
+
+
+def iter_pages(fetch_page, page_size=DEFAULT_PAGE_SIZE,
+               concurrency=DEFAULT_CONCURRENCY, start=None, shard=None):
+    """Yield (offset, page) pairs in order, calling fetch_page(offset, limit)
+     for up to concurrency pages at the same time. Stops at the first page
+     that is empty. When a shard is passed, only the pages in that shard are
+     requested, and start, if passed, must be the offset of one of them.
+    """
+    concurrency = max(1, concurrency)
+    stride = page_stride(page_size, shard)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = collections.deque()
+    next_offset = first_offset(page_size, shard) if start is None else start
+    try:
+        for i in range(concurrency):
+            pending.append((next_offset, executor.submit(fetch_page, next_offset, page_size)))
+            next_offset += stride
+        while pending:
+            offset, future = pending.popleft()
+            page = future.result()
+            if not page:
+                break
+            pending.append((next_offset, executor.submit(fetch_page, next_offset, page_size)))
+            next_offset += stride
+            yield offset, page
+    finally:
+        for offset, future in pending:
+            future.cancel()
+        executor.shutdown(wait=False)
+
+
+def iter_package_pages(connection, page_size=DEFAULT_PAGE_SIZE,
+                       concurrency=DEFAULT_CONCURRENCY, start=None, shard=None):
+    """Yield (offset, datasets) pairs for every page of datasets, with
+     their resources, in the connected CKAN repository, or in one shard of
+     its pages.
+    """
+    def fetch_page(offset, limit):
+        logging.debug('Requesting datasets from offset %d', offset)
+        return connection.call_action(action='current_package_list_with_resources',
+                                      data_dict={'limit': limit, 'offset': offset})
+
+    return iter_pages(fetch_page, page_size, concurrency, start, shard)
+
+
+def iter_datasets(connection, page_size=DEFAULT_PAGE_SIZE,
+                  concurrency=DEFAULT_CONCURRENCY, start=None, shard=None):
+    """Yield every dataset, with its resources, in the connected CKAN repository.
+    """
+    for offset, datasets in iter_package_pages(connection, page_size, concurrency, start, shard):
+        logging.info('Retrieved %d datasets from offset %d', len(datasets), offset)
+        for dataset in datasets:
+            yield dataset
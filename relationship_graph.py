@@ -0,0 +1,346 @@
+"""Python command-line script for answering collection hierarchy queries from a local relationship graph.
+ Looking up the hierarchy of a dataset through the API (see
+ hierarchy_search_compare.py) takes a package_relationships_list call for
+ every level up to the top of the collection, and another for every
+ dataset below it. This script keeps the parent/child relationships of the
+ whole catalog in a local graph file instead, so the hierarchy, ancestors
+ or subtree of any dataset are answered from memory, in time proportional
+ to the size of the subtree.
+
+ The graph is built from one scan of the catalog listing, using the
+ relationships_as_subject and relationships_as_object lists CKAN includes
+ with each dataset, along with the name, title and type of every dataset.
+ The latest metadata_modified value seen is kept in the graph file. Later
+ runs refresh the graph incrementally: the datasets modified since then are
+ retrieved with package_search and their relationships replaced, and
+ datasets no longer listed in the catalog are dropped. A relationship added
+ or removed without modifying either dataset is only picked up when the
+ graph is rebuilt with --rebuild.
+
+ The graph reflects what the API key used to build it can see. Datasets
+ that are related to, but not visible in, the catalog listing are left out
+ of hierarchies, as they are by the API lookups.
+
+ The base URL for the API to use (without the trailing "/api/action" text)
+ can be specified in an environment variable named 'CKAN_URL'. The value for the
+ URL will be prompted for input if the environment variable is not set.
+
+ The API key to use for authentication can be specified in an environment
+ variable named 'CKAN_KEY'. If the environment variable is not set, only
+ anonymous access is used.
+
+ Example: print the hierarchy of a dataset, and export every collection.
+
+     python relationship_graph.py --hierarchy dataset-4
+     python relationship_graph.py --no-refresh --export collections.ndjson
+
+ """
+import argparse
+import json
+import logging
+import os
+import time
+
+import hierarchy_search_compare
+import ndjson
+import paginator
+import transport
+from retrieve_all_metadata import iter_dataset_ids, iter_modified_since
+
+# The relationship types recorded, and whether the subject is the parent.
+_PARENT_SUBJECT = {'parent_of': True, 'child_of': False}
+
+
+class RelationshipGraph:
+    """Parent/child relationships between the datasets of a catalog, with
+     the name, title and type of each dataset, keyed by dataset id.
+    """
+
+    def __init__(self):
+        self.packages = {}
+        self.names = {}
+        self.parents = {}
+        self.children = {}
+        self.metadata_modified = None
+
+    def _add_edge(self, parent, child):
+        children = self.children.setdefault(parent, [])
+        if child not in children:
+            children.append(child)
+            self.parents.setdefault(child, []).append(parent)
+
+    def _remove_edges(self, package_id):
+        # Drop every relationship of a dataset, in either direction.
+        for parent in self.parents.pop(package_id, []):
+            self.children[parent].remove(package_id)
+            if not self.children[parent]:
+                del self.children[parent]
+        for child in self.children.pop(package_id, []):
+            self.parents[child].remove(package_id)
+            if not self.parents[child]:
+                del self.parents[child]
+
+    def _track_modified(self, dataset):
+        modified = dataset.get('metadata_modified')
+        if modified is not None and (self.metadata_modified is None
+                                     or modified > self.metadata_modified):
+            self.metadata_modified = modified
+
+    def add_dataset(self, dataset, replace=False):
+        """Record a dataset and its relationships. With replace, the
+         relationships recorded earlier for the dataset are dropped first.
+        """
+        package_id = dataset['id']
+        previous = self.packages.get(package_id)
+        if previous is not None and self.names.get(previous['name']) == package_id:
+            del self.names[previous['name']]
+        self.packages[package_id] = {'name': dataset.get('name'), 'title': dataset.get('title'),
+                                     'type': dataset.get('type')}
+        self.names[dataset.get('name')] = package_id
+        if replace:
+            self._remove_edges(package_id)
+        for relationship in (dataset.get('relationships_as_subject', [])
+                             + dataset.get('relationships_as_object', [])):
+            if relationship.get('state', 'active') != 'active':
+                continue
+            parent_subject = _PARENT_SUBJECT.get(relationship.get('type'))
+            if parent_subject is None:
+                continue
+            subject = relationship['subject_package_id']
+            object_id = relationship['object_package_id']
+            if parent_subject:
+                self._add_edge(subject, object_id)
+            else:
+                self._add_edge(object_id, subject)
+        self._track_modified(dataset)
+
+    def remove_dataset(self, package_id):
+        package = self.packages.pop(package_id, None)
+        if package is not None and self.names.get(package['name']) == package_id:
+            del self.names[package['name']]
+        self._remove_edges(package_id)
+
+    @classmethod
+    def build(cls, connection, page_size=paginator.DEFAULT_PAGE_SIZE,
+              concurrency=paginator.DEFAULT_CONCURRENCY):
+        """Build the graph from a scan of the catalog listing.
+        """
+        graph = cls()
+        for dataset in paginator.iter_datasets(connection, page_size, concurrency):
+            graph.add_dataset(dataset)
+        logging.info('Built a graph of %d datasets with %d parents',
+                     len(graph.packages), len(graph.children))
+        return graph
+
+    def refresh(self, connection):
+        """Replace the relationships of the datasets modified since the graph
+         was last built or refreshed, and drop the datasets no longer listed.
+         Returns the number of datasets updated and removed.
+        """
+        since = self.metadata_modified
+        changed = list(iter_modified_since(connection, since)) if since is not None else []
+        live_ids = set(iter_dataset_ids(connection))
+        for dataset in changed:
+            self.add_dataset(dataset, replace=True)
+        removed = [package_id for package_id in self.packages if package_id not in live_ids]
+        for package_id in removed:
+            self.remove_dataset(package_id)
+        logging.info('Updated %d and removed %d datasets in the graph', len(changed), len(removed))
+        return len(changed), len(removed)
+
+    @classmethod
+    def load(cls, file_name):
+        with open(file_name, 'r') as graph_file:
+            state = json.load(graph_file)
+        graph = cls()
+        graph.metadata_modified = state['metadata_modified']
+        graph.packages = state['packages']
+        graph.names = {package['name']: package_id
+                       for package_id, package in graph.packages.items()}
+        for parent, child in state['edges']:
+            graph._add_edge(parent, child)
+        return graph
+
+    def save(self, file_name):
+        temp_file_name = file_name + '.tmp'
+        with open(temp_file_name, 'w') as graph_file:
+            json.dump({'metadata_modified': self.metadata_modified,
+                       'saved': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                       'packages': self.packages,
+                       'edges': [[parent, child] for parent, children in self.children.items()
+                                 for child in children]},
+                      graph_file)
+        os.replace(temp_file_name, file_name)
+
+    def _id(self, name):
+        # Accept either the name or the id of a dataset.
+        if name in self.packages:
+            return name
+        return self.names.get(name)
+
+    def _name(self, package_id):
+        package = self.packages.get(package_id)
+        return package['name'] if package is not None else package_id
+
+    def ancestors(self, name):
+        """Return the names of the ancestors of a dataset, from its parent up
+         to the top of its collection. Where a dataset has more than one
+         parent, the first is followed.
+        """
+        package_id = self._id(name)
+        visited = {package_id}
+        ancestors = []
+        while self.parents.get(package_id):
+            package_id = self.parents[package_id][0]
+            if package_id in visited:
+                break
+            visited.add(package_id)
+            ancestors.append(self._name(package_id))
+        return ancestors
+
+    def subtree(self, name):
+        """Return the datasets below a dataset, one level at a time, as a list
+         of dictionaries with the name, the name of the parent and the level
+         of each, in the form returned by
+         hierarchy_search_compare.get_relationships_from_api.
+        """
+        package_id = self._id(name)
+        subtree = []
+        visited = {package_id}
+        level = [package_id]
+        i = 1
+        while level:
+            next_level = []
+            for parent in level:
+                for child in self.children.get(parent, []):
+                    subtree.append({'name': self._name(child), 'parent': self._name(parent),
+                                    'level': i})
+                    if child not in visited:
+                        visited.add(child)
+                        next_level.append(child)
+            level = next_level
+            i += 1
+        return subtree
+
+    def hierarchy(self, name):
+        """Return the nested hierarchy of the collection holding a dataset, in
+         the form returned by hierarchy_search_compare.get_hierarchy_show, or
+         an empty dictionary if the dataset is not in the graph.
+        """
+        if self._id(name) is None:
+            return {}
+        ancestors = self.ancestors(name)
+        root = ancestors[-1] if ancestors else self._name(self._id(name))
+        hierarchy = [{'name': root, 'parent': None, 'level': 0}] + self.subtree(root)
+        return hierarchy_search_compare.nest_hierarchy(hierarchy, self._packages_in(hierarchy))
+
+    def _packages_in(self, hierarchy):
+        # Look up the packages named in a hierarchy only, so a query costs
+        # time in proportion to the subtree rather than the catalog.
+        packages = {}
+        for entry in hierarchy:
+            package_id = self.names.get(entry['name'])
+            if package_id is not None:
+                packages[entry['name']] = self.packages[package_id]
+        return packages
+
+    def collections(self):
+        """Return the names of the datasets at the top of each collection
+         hierarchy, in name order.
+        """
+        return sorted(self._name(package_id) for package_id in self.children
+                      if not self.parents.get(package_id))
+
+    def export_collections(self, output_file_name):
+        """Write the nested hierarchy of every collection as newline-delimited
+         JSON, one collection per line. Returns the number of collections.
+        """
+        count = 0
+        packages = {package['name']: package for package in self.packages.values()}
+        with ndjson.open_output(output_file_name) as output_file:
+            for root in self.collections():
+                hierarchy = [{'name': root, 'parent': None, 'level': 0}] + self.subtree(root)
+                ndjson.write_record(output_file, {
+                    'name': root,
+                    'hierarchy': hierarchy_search_compare.nest_hierarchy(hierarchy, packages)})
+                count += 1
+        logging.info('Wrote %d collections to %s', count, output_file_name)
+        return count
+
+
+def get_hierarchy_graph(graph, data_dict):
+    """Return the nested hierarchy for the dataset named by the id in the
+     data dictionary, from the graph.
+    """
+    return graph.hierarchy(data_dict.get('id'))
+
+
+def open_graph(connection, file_name, page_size=paginator.DEFAULT_PAGE_SIZE,
+               concurrency=paginator.DEFAULT_CONCURRENCY, refresh=True, rebuild=False):
+    """Load the graph saved in a file, refreshing it from the connected CKAN
+     repository, or build it if there is no file yet or rebuild is set. The
+     graph is saved again whenever it changes.
+    """
+    if rebuild or not os.path.exists(file_name):
+        graph = RelationshipGraph.build(connection, page_size, concurrency)
+        graph.save(file_name)
+        return graph
+    graph = RelationshipGraph.load(file_name)
+    if refresh:
+        graph.refresh(connection)
+        graph.save(file_name)
+    return graph
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Answer collection hierarchy queries from a local graph of dataset relationships.
+''')
+    ap.add_argument('-g', '--graph', dest='graph', default='relationships.json',
+        help='The file holding the relationship graph. It is built if it does not exist.')
+    ap.add_argument('--rebuild', dest='rebuild', action='store_true',
+        help='Build the graph again from a full scan of the catalog.')
+    ap.add_argument('--no-refresh', dest='refresh', action='store_false',
+        help='Use the saved graph without checking for datasets modified since it was saved.')
+    ap.add_argument('--hierarchy', dest='hierarchy', default=None,
+        help='Print the nested hierarchy of the collection holding the named dataset.')
+    ap.add_argument('--ancestors', dest='ancestors', default=None,
+        help='Print the ancestors of the named dataset, from its parent to the top of its '
+             'collection.')
+    ap.add_argument('--subtree', dest='subtree', default=None,
+        help='Print the datasets below the named dataset, with their parents and levels.')
+    ap.add_argument('-e', '--export', dest='export', default=None,
+        help='Write the nested hierarchy of every collection to this file as newline-delimited '
+             'JSON.')
+    ap.add_argument('--page-size', dest='page_size', default=paginator.DEFAULT_PAGE_SIZE, type=int,
+        help='The number of datasets to request in each page of the catalog listing.')
+    ap.add_argument('--page-concurrency', dest='page_concurrency', default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of catalog listing pages to request at the same time.')
+    args = ap.parse_args()
+
+    remote = None
+    if args.rebuild or args.refresh or not os.path.exists(args.graph):
+        # Retrieve the URL and API Key from environment variables, if set.
+        url = os.getenv('CKAN_URL', None)
+        api_key = os.getenv('CKAN_KEY', None)
+
+        # Prompt for the API connection details if missing.
+        if not url:
+            url = input('Enter CKAN URL:')
+
+        remote = transport.remote_ckan(url, api_key)
+
+    graph = open_graph(remote, args.graph, args.page_size, args.page_concurrency,
+                       args.refresh, args.rebuild)
+
+    if args.hierarchy is not None:
+        print(json.dumps(graph.hierarchy(args.hierarchy), indent=2))
+    if args.ancestors is not None:
+        print(json.dumps(graph.ancestors(args.ancestors), indent=2))
+    if args.subtree is not None:
+        print(json.dumps(graph.subtree(args.subtree), indent=2))
+    if args.export is not None:
+        graph.export_collections(args.export)
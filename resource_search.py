@@ -9,8 +9,10 @@
  variable named 'CKAN_KEY'. The value for the API key will be prompted for
  input if the environment variable is not set.
  
- The program accepts a single command line argument, the query string to 
- use in conducting the search.
+ The program accepts a variable number of command line arguments.
+ The first argument is the query string to use in conducting the search.
+ The remaining arguments, if any, are the names of the resource fields to
+ include in the results. All fields are included if none are named.
  
  Note that any fields added to the extras portion of the CKAN schema can
  be referenced in the return field list by prefacing the field name with
@@ -24,14 +26,31 @@
   
     python resource_search.py extras_data_quality:false
 
+ With the --all option, the whole result set is retrieved in pages, several
+ pages at a time, and each resource is written as a line of newline-delimited
+ JSON as soon as its page arrives. Only the named fields are kept from each
+ page, so large audits do not buffer every resource in memory.
+
+  Example: List the id and URL of every CSV resource.
+
+    python resource_search.py --all -o csv_urls.ndjson format:CSV id url
+
+ With the --offline option, the query is answered from a local index of a
+ snapshot written by retrieve_all_metadata.py (see offline_index.py) rather
+ than by the CKAN instance, and no API key is needed.
+
 """
+import argparse
 import json
 import logging
 import os
 import sys
 import re
 
-from ckanapi import RemoteCKAN
+import ndjson
+import offline_index
+import paginator
+from transport import RemoteCKAN
 
 def do_resource_search(ckan_connection, search_term = "*:*"):
     result = None
@@ -43,6 +62,45 @@ def do_resource_search(ckan_connection, search_term = "*:*"):
         return result
 
     return result.get('results',None)
+
+def iter_resource_search(ckan_connection, search_term = "*:*", field_list = None,
+                         limit = 1000, concurrency = paginator.DEFAULT_CONCURRENCY):
+    """Yield every resource matching the search term, keeping only the listed
+     fields. Pages of results are requested concurrently, ordered by resource
+     id so the pages do not overlap.
+    """
+    def fetch_page(offset, limit):
+        result = ckan_connection.call_action(action='resource_search', data_dict={
+            'query': search_term,
+            'order_by': 'id',
+            'offset': offset,
+            'limit': limit
+            })
+        resources = result.get('results', [])
+        if field_list:
+            # Project the fields as soon as the page arrives, so the rest of
+            # each resource can be freed straight away.
+            resources = [{field: resource.get(field) for field in field_list}
+                         for resource in resources]
+        return resources
+
+    for offset, resources in paginator.iter_pages(fetch_page, limit, concurrency):
+        for resource in resources:
+            yield resource
+
+def write_resource_search(ckan_connection, output_file_name, search_term = "*:*",
+                          field_list = None, limit = 1000,
+                          concurrency = paginator.DEFAULT_CONCURRENCY):
+    """Write every resource matching the search term to a newline-delimited JSON file.
+    """
+    count = 0
+    with ndjson.open_output(output_file_name) as output_file:
+        for resource in iter_resource_search(ckan_connection, search_term, field_list,
+                                             limit, concurrency):
+            ndjson.write_record(output_file, resource)
+            count += 1
+    logging.info('Wrote %d resources to %s', count, output_file_name)
+    return count
  	
 if __name__ == '__main__':
 
@@ -51,15 +109,35 @@ if __name__ == '__main__':
 
     errors = []
 
-    if not url:
-        errors.append('ED_CKAN_URL environment variable is needed.')
-    if not api_key:
-        errors.append('ED_CKAN_KEY environment variable is needed.')
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Search the resources in a CKAN instance.
+''')
+    ap.add_argument('search_text', nargs='?', default=None,
+        help='The query string to use in conducting the search.')
+    ap.add_argument('field_list', nargs='*',
+        help='The names of the resource fields to include in the results.')
+    ap.add_argument('-a', '--all', dest='all', action='store_true',
+        help='Write every matching resource as newline-delimited JSON, retrieving the results '
+             'in pages.')
+    ap.add_argument('-o', '--output', dest='output', default='-',
+        help='The file for the newline-delimited JSON results. Defaults to standard output.')
+    ap.add_argument('--limit', dest='limit', default=1000, type=int,
+        help='The number of resources to request in each page of results.')
+    ap.add_argument('--concurrency', dest='concurrency', default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of pages of results to request at the same time.')
+    ap.add_argument('--offline', dest='offline', default=None,
+        help='Search a local index, or the snapshot written by retrieve_all_metadata.py, '
+             'instead of the CKAN instance.')
+    args = ap.parse_args()
 
-    search_text = "*:*"
-    if len(sys.argv) > 1:
-        search_text = sys.argv[1]
-    else:
+    if args.offline is None:
+        if not url:
+            errors.append('ED_CKAN_URL environment variable is needed.')
+        if not api_key:
+            errors.append('ED_CKAN_KEY environment variable is needed.')
+
+    search_text = args.search_text
+    if search_text is None:
         errors.append('No query string specified on command line.')
         
     if len(errors):
@@ -67,10 +145,21 @@ if __name__ == '__main__':
             logging.error(e)
         sys.exit(1)
 
-    remote_ckan = RemoteCKAN(address=url, apikey=api_key)
+    if args.offline is not None:
+        remote_ckan = offline_index.open_index(args.offline)
+    else:
+        remote_ckan = RemoteCKAN(address=url, apikey=api_key)
+
+    if args.all:
+        write_resource_search(remote_ckan, args.output, search_text, args.field_list,
+                              args.limit, args.concurrency)
+        sys.exit(0)
 
     # Perform the package search.
     resource_list = do_resource_search(remote_ckan, search_text)
+    if resource_list is not None and args.field_list:
+        resource_list = [{field: resource.get(field) for field in args.field_list}
+                         for resource in resource_list]
 
     print(json.dumps(resource_list, indent=2))
     
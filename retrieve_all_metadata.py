@@ -10,66 +10,349 @@
  The API key to use for authentication can be specified in an environment
  variable named 'CKAN_KEY'. The value for the API key will be prompted for input
  if the environment variable is not set.
+
+ By default the metadata is written as a single indented JSON document. With
+ the --ndjson option, each dataset is flattened and written as a line of
+ newline-delimited JSON as soon as it is retrieved, so memory use does not
+ grow with the size of the catalog. The NDJSON output can be compressed with
+ gzip using the --gzip option, or by giving a file name ending in ".gz".
+
+ With the --incremental option, an existing NDJSON snapshot is brought up to
+ date rather than harvested again. The latest metadata_modified value seen
+ is recorded in a state file next to the snapshot (or the file named with
+ --state). The next incremental run retrieves only the datasets modified
+ since then, replaces them in the snapshot, and drops any datasets no longer
+ listed in the catalog. Datasets listed in the catalog but missing from the
+ snapshot, such as those restored or made public without a newer
+ metadata_modified value, are retrieved as well. If there is no snapshot or
+ state yet, a full harvest is done.
+
+ While NDJSON output is written, the offset reached in the catalog listing
+ and the number of datasets written are saved to a checkpoint file every
+ minute or so. If the harvest stops early, running the script again with
+ the --resume option cuts the output back to the last checkpoint and
+ continues from there.
+
+ With the --columnar option, or an output file name ending in ".parquet" or
+ ".csv", the flattened datasets are written as a Parquet file (or a CSV file
+ if pyarrow is not installed) with the fixed set of columns described in
+ columnar_export.py, so reports can read only the columns they need.
  
  """
+import argparse
 import getpass
 import logging
 import os
 import sys
+import time
 
-import ckanapi
 import json
 
+import columnar_export
+import ndjson
+import paginator
+import transport
+from checkpoint import Checkpoint, DEFAULT_INTERVAL
 
-def retrieve_metadata(connection):
-    """Retrieve the metadata in the connected CKAN repository.
+
+def iter_metadata(connection, page_size=paginator.DEFAULT_PAGE_SIZE,
+                  concurrency=paginator.DEFAULT_CONCURRENCY):
+    """Yield the metadata for each dataset in the connected CKAN repository,
+     retrieving up to concurrency pages of page_size datasets at a time.
     """
-    result = []
     try:
-        offset = 0
-        increment = 1000
-        while (True):
-#        while (offset < increment):
-            pass_data_dict = { "limit": increment, "offset": offset }
-            pass_result = connection.call_action(action='current_package_list_with_resources', data_dict=pass_data_dict)
-            if len(pass_result) == 0: break
-            offset += increment
-            for dataset in pass_result:
-                result.append(dataset)
-            logging.info('Retrieving from offset %d', offset)
-        return result
+        for dataset in paginator.iter_datasets(connection, page_size, concurrency):
+            yield dataset
     except Exception as e:
         logging.info(e)
-        return result
+
+def retrieve_metadata(connection, page_size=paginator.DEFAULT_PAGE_SIZE,
+                      concurrency=paginator.DEFAULT_CONCURRENCY):
+    """Retrieve the metadata in the connected CKAN repository.
+    """
+    return list(iter_metadata(connection, page_size, concurrency))
+
+def unravel_dataset(dataset):
+    """Flatten the extras, organization, tags and groups of a single dataset.
+    """
+    if dataset.get("extras",None) is not None:
+        for extra in dataset["extras"]:
+            dataset[extra["key"]] = extra["value"]
+        dataset.pop("extras")
+    if dataset.get("organization",None) is not None:
+        dataset["org_id"] = dataset["organization"].get("id",None) 
+        dataset["org_name"] = dataset["organization"].get("name",None)
+        dataset.pop('organization')
+    if dataset.get("tags",None) is not None:
+        dataset["taglist"] = []
+        for tag in dataset["tags"]:
+            dataset["taglist"].append(tag["display_name"])
+        dataset.pop("tags")
+    if dataset.get("groups",None) is not None:
+        dataset["grouplist"] = []
+        for group in dataset["groups"]:
+            dataset["grouplist"].append(group["display_name"])
+        dataset.pop("groups")
+    if dataset.get("relationships_as_object", None) is not None:
+        dataset.pop("relationships_as_object")
+    return dataset
 
 def unravel_metadata(amd):
     for dataset in amd:
-        if dataset.get("extras",None) is not None:
-            for extra in dataset["extras"]:
-                dataset[extra["key"]] = extra["value"]
-            dataset.pop("extras")
-        if dataset.get("organization",None) is not None:
-            dataset["org_id"] = dataset["organization"].get("id",None) 
-            dataset["org_name"] = dataset["organization"].get("name",None)
-            dataset.pop('organization')
-        if dataset.get("tags",None) is not None:
-            dataset["taglist"] = []
-            for tag in dataset["tags"]:
-                dataset["taglist"].append(tag["display_name"])
-            dataset.pop("tags")
-        if dataset.get("groups",None) is not None:
-            dataset["grouplist"] = []
-            for group in dataset["groups"]:
-                dataset["grouplist"].append(group["display_name"])
-            dataset.pop("groups")
-        if dataset.get("relationships_as_object", None) is not None:
-            dataset.pop("relationships_as_object")
+        unravel_dataset(dataset)
     return amd
+
+def write_metadata_ndjson(connection, output_file_name, compress=None,
+                          page_size=paginator.DEFAULT_PAGE_SIZE,
+                          concurrency=paginator.DEFAULT_CONCURRENCY,
+                          checkpoint=None, resume=False):
+    """Retrieve, flatten and write each dataset in the connected CKAN repository
+     to a newline-delimited JSON file, one dataset at a time.
+     When a checkpoint is passed, the offset reached and the number of
+     datasets written are saved to it periodically and if the listing
+     fails. With resume, the file is cut back to the datasets written at the
+     last checkpoint, and the listing continues from there.
+    """
+    start = 0
+    count = 0
+    state = checkpoint.load() if checkpoint is not None and resume else None
+    if state is not None:
+        start, count = state['offset'], state['records']
+        ndjson.truncate_records(output_file_name, count, compress)
+        logging.info('Resuming from offset %d, after %d datasets.', start, count)
+
+    offset = start
+    complete = False
+    with ndjson.open_output(output_file_name, compress, append=state is not None) as output_file:
+        try:
+            for page_offset, datasets in paginator.iter_package_pages(connection, page_size,
+                                                                      concurrency, start):
+                logging.info('Retrieved %d datasets from offset %d', len(datasets), page_offset)
+                for dataset in datasets:
+                    ndjson.write_record(output_file, unravel_dataset(dataset))
+                    count += 1
+                offset = page_offset + len(datasets)
+                if checkpoint is not None and checkpoint.due():
+                    output_file.flush()
+                    checkpoint.save({'offset': offset, 'records': count})
+            complete = True
+        except Exception as e:
+            logging.info(e)
+    if checkpoint is not None:
+        if complete:
+            checkpoint.remove()
+        else:
+            checkpoint.save({'offset': offset, 'records': count})
+            logging.info('Saved checkpoint at offset %d', offset)
+    logging.info('Wrote %d datasets to %s', count, output_file_name)
+    return count
+
+def solr_date(timestamp):
+    """Convert a CKAN metadata timestamp to the format used in Solr range queries.
+     The fractional seconds are dropped, so a range starting at the result
+     includes the dataset the timestamp came from.
+    """
+    return timestamp[:19] + 'Z'
+
+def iter_modified_since(connection, since, rows=1000):
+    """Yield the datasets modified at or after the passed metadata timestamp,
+     in order of modification.
+    """
+    start = 0
+    while (True):
+        pass_data_dict = {
+            'q': '*:*',
+            'fq': f'metadata_modified:[{solr_date(since)} TO *]',
+            'sort': 'metadata_modified asc',
+            'rows': rows,
+            'start': start
+            }
+        pass_result = connection.call_action(action='package_search', data_dict=pass_data_dict)
+        datasets = pass_result.get('results', [])
+        if len(datasets) == 0: break
+        start += len(datasets)
+        for dataset in datasets:
+            yield dataset
+        logging.info('Retrieved %d of %d modified datasets', start, pass_result.get('count', 0))
+
+def iter_dataset_ids(connection, rows=1000):
+    """Yield the identifiers of all the datasets in the connected CKAN repository.
+     The identifiers are listed in order, each page starting after the last
+     identifier of the previous one, so no deep paging is needed.
+    """
+    last_id = None
+    while (True):
+        pass_data_dict = {'q': '*:*', 'fl': 'id', 'sort': 'id asc', 'rows': rows}
+        if last_id is not None:
+            pass_data_dict['fq'] = f'id:{{"{last_id}" TO *]'
+        pass_result = connection.call_action(action='package_search', data_dict=pass_data_dict)
+        datasets = pass_result.get('results', [])
+        if len(datasets) == 0: break
+        for dataset in datasets:
+            yield dataset['id']
+        last_id = datasets[-1]['id']
+
+def iter_datasets_by_id(connection, ids, rows=100):
+    """Yield the datasets with the passed identifiers, looked up with one
+     package_search call for each batch of rows identifiers.
+    """
+    ids = sorted(ids)
+    for start in range(0, len(ids), rows):
+        batch = ids[start:start + rows]
+        terms = ' OR '.join(json.dumps(id) for id in batch)
+        pass_data_dict = {'q': '*:*', 'fq': f'id:({terms})', 'rows': len(batch)}
+        pass_result = connection.call_action(action='package_search', data_dict=pass_data_dict)
+        for dataset in pass_result.get('results', []):
+            yield dataset
+
+def read_state(state_file_name):
+    """Read the incremental harvest state, or return None if there is none.
+    """
+    try:
+        with open(state_file_name, 'r') as state_file:
+            return json.load(state_file)
+    except FileNotFoundError:
+        return None
+
+def write_state(state_file_name, state):
+    """Replace the incremental harvest state.
+    """
+    temp_file_name = state_file_name + '.tmp'
+    with open(temp_file_name, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temp_file_name, state_file_name)
+
+def harvest_incremental(connection, snapshot_file_name, state_file_name=None, compress=None,
+                        page_size=paginator.DEFAULT_PAGE_SIZE,
+                        concurrency=paginator.DEFAULT_CONCURRENCY):
+    """Bring an NDJSON metadata snapshot up to date with the connected CKAN repository.
+     Returns the new harvest state, or None if the snapshot was left unchanged
+     because of an error.
+    """
+    if state_file_name is None:
+        state_file_name = snapshot_file_name + '.state.json'
+    state = read_state(state_file_name)
+    high_water_mark = None
+
+    if (state is None or state.get('metadata_modified') is None
+            or not os.path.exists(snapshot_file_name)):
+        logging.info('No previous harvest found for %s. Retrieving all datasets.',
+                     snapshot_file_name)
+        temp_file_name = snapshot_file_name + '.tmp'
+        count = 0
+        try:
+            with ndjson.open_output(temp_file_name,
+                                    compress or snapshot_file_name.endswith('.gz')) as output_file:
+                # The paginator is read directly, rather than through
+                # iter_metadata, so a failed listing is not taken for the
+                # whole catalog.
+                for dataset in paginator.iter_datasets(connection, page_size, concurrency):
+                    modified = dataset.get('metadata_modified')
+                    if modified is not None and (high_water_mark is None
+                                                 or modified > high_water_mark):
+                        high_water_mark = modified
+                    ndjson.write_record(output_file, unravel_dataset(dataset))
+                    count += 1
+        except Exception as e:
+            logging.error('Unable to retrieve all datasets. The snapshot %s was not written.',
+                          snapshot_file_name, exc_info=e)
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            return None
+        os.replace(temp_file_name, snapshot_file_name)
+        logging.info('Wrote %d datasets to %s', count, snapshot_file_name)
+    else:
+        high_water_mark = state.get('metadata_modified')
+        try:
+            changed = {}
+            for dataset in iter_modified_since(connection, high_water_mark):
+                modified = dataset.get('metadata_modified')
+                if modified is not None and modified > high_water_mark:
+                    high_water_mark = modified
+                changed[dataset['id']] = unravel_dataset(dataset)
+            live_ids = set(iter_dataset_ids(connection))
+        except Exception as e:
+            logging.error('Unable to retrieve changes. The snapshot %s was not updated.',
+                          snapshot_file_name, exc_info=e)
+            return None
+
+        kept = 0
+        removed = 0
+        added = 0
+        snapshot_ids = set()
+        temp_file_name = snapshot_file_name + '.tmp'
+        try:
+            with ndjson.open_output(temp_file_name,
+                                    compress or snapshot_file_name.endswith('.gz')) as output_file:
+                for dataset in ndjson.read_records(snapshot_file_name):
+                    snapshot_ids.add(dataset['id'])
+                    if dataset['id'] in changed:
+                        continue
+                    if dataset['id'] not in live_ids:
+                        removed += 1
+                        continue
+                    ndjson.write_record(output_file, dataset)
+                    kept += 1
+                for dataset in changed.values():
+                    ndjson.write_record(output_file, dataset)
+                # Live datasets missing from the snapshot are not found by
+                # iter_modified_since when their metadata_modified value is
+                # older than the high-water mark, so they are looked up by id.
+                missing = live_ids - snapshot_ids - set(changed)
+                for dataset in iter_datasets_by_id(connection, missing):
+                    ndjson.write_record(output_file, unravel_dataset(dataset))
+                    added += 1
+        except Exception as e:
+            logging.error('Unable to retrieve missing datasets. The snapshot %s was not updated.',
+                          snapshot_file_name, exc_info=e)
+            if os.path.exists(temp_file_name):
+                os.remove(temp_file_name)
+            return None
+        os.replace(temp_file_name, snapshot_file_name)
+        logging.info('Kept %d, updated %d, added %d missing and removed %d datasets in %s',
+                     kept, len(changed), added, removed, snapshot_file_name)
+
+    state = {'metadata_modified': high_water_mark,
+             'harvested': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+    write_state(state_file_name, state)
+    return state
     
     
 if __name__ == '__main__':
 
     logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''Retrieve the metadata for all datasets in a CKAN instance.
+''')
+    ap.add_argument('output_file_name', nargs='?', default=None,
+        help='The name of the file to write. The name will be prompted for input if not provided.')
+    ap.add_argument('-n', '--ndjson', dest='ndjson', action='store_true',
+        help='Stream the flattened datasets as newline-delimited JSON, one dataset per line.')
+    ap.add_argument('-z', '--gzip', dest='compress', action='store_true', default=None,
+        help='Compress the newline-delimited JSON output with gzip.')
+    ap.add_argument('-c', '--columnar', dest='columnar', action='store_true',
+        help='Write the flattened datasets as Parquet, or as CSV if pyarrow is not installed.')
+    ap.add_argument('-i', '--incremental', dest='incremental', action='store_true',
+        help='Update an existing newline-delimited JSON snapshot with only the datasets '
+             'changed since the last harvest.')
+    ap.add_argument('-s', '--state', dest='state_file_name', default=None,
+        help='The file recording the progress of incremental harvests. Defaults to the output '
+             'file name followed by ".state.json".')
+    ap.add_argument('--page-size', dest='page_size', default=paginator.DEFAULT_PAGE_SIZE, type=int,
+        help='The number of datasets to request in each page of the catalog listing.')
+    ap.add_argument('--page-concurrency', dest='page_concurrency',
+        default=paginator.DEFAULT_CONCURRENCY, type=int,
+        help='The number of catalog listing pages to request at the same time.')
+    ap.add_argument('--checkpoint', dest='checkpoint', default=None,
+        help='The file for saving the progress of newline-delimited JSON output. Defaults to '
+             'the output file name followed by ".checkpoint.json".')
+    ap.add_argument('--checkpoint-interval', dest='checkpoint_interval',
+        default=DEFAULT_INTERVAL, type=float,
+        help='The number of seconds between saves of the progress.')
+    ap.add_argument('--resume', dest='resume', action='store_true',
+        help='Continue newline-delimited JSON output from the saved progress of an earlier run.')
+    args = ap.parse_args()
     
     # Retrieve the URL and API Key from environment variables, if set.
     url = os.getenv('CKAN_URL', None)
@@ -81,13 +364,30 @@ if __name__ == '__main__':
     if not api_key:
         api_key = getpass.getpass('Enter CKAN API key:')
 
-    remote = ckanapi.RemoteCKAN(url, api_key)
+    remote = transport.remote_ckan(url, api_key)
 
-    output_file_name = ''
-    if len(sys.argv) > 1:
-        output_file_name = sys.argv[1]
-    else:
+    output_file_name = args.output_file_name
+    if output_file_name is None:
         output_file_name = input('Enter output file name:')
 
-    with open(output_file_name, "w") as output_file:
-        output_file.write(json.dumps(unravel_metadata(retrieve_metadata(remote)), indent=2))
+    if args.incremental:
+        if harvest_incremental(remote, output_file_name, args.state_file_name, args.compress,
+                               args.page_size, args.page_concurrency) is None:
+            sys.exit(1)
+    elif args.columnar or output_file_name.endswith(('.parquet', '.csv')):
+        columnar_export.write_columnar(
+            (unravel_dataset(dataset) for dataset in iter_metadata(remote,
+                args.page_size, args.page_concurrency)),
+            output_file_name)
+    elif args.ndjson or args.compress or output_file_name.endswith('.gz'):
+        checkpoint = None
+        if output_file_name != '-':
+            checkpoint = Checkpoint(args.checkpoint or output_file_name + '.checkpoint.json',
+                                    args.checkpoint_interval)
+        write_metadata_ndjson(remote, output_file_name, args.compress,
+                              args.page_size, args.page_concurrency,
+                              checkpoint, args.resume)
+    else:
+        with open(output_file_name, "w") as output_file:
+            output_file.write(json.dumps(unravel_metadata(retrieve_metadata(remote,
+                args.page_size, args.page_concurrency)), indent=2))
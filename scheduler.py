@@ -0,0 +1,244 @@
+"""Adaptive, rate-limit-aware scheduling of outbound HTTP requests.
+ Every request made through the shared transport session waits for a slot
+ from the scheduler before it is sent. Slots are handed out per endpoint,
+ which here is the host of the URL, since that is what servers throttle.
+
+ Each endpoint has two limits, both adjusted as responses arrive:
+ - a limit on the number of requests in flight, and
+ - a token bucket limiting the request rate. The bucket does not limit the
+   rate until the server first signals throttling.
+ Both follow the additive increase, multiplicative decrease (AIMD) pattern.
+ A throttling signal halves the number of requests in flight and sets the
+ rate to half of the rate that was just achieved. While responses keep
+ arriving without errors, and their latency stays within a factor of the
+ fastest latency seen, the number of requests in flight grows by one for
+ every full window of successful requests, and the rate grows by a fixed
+ amount each second.
+
+ The throttling signals are a 429 or 503 response and an
+ X-RateLimit-Remaining header of zero. The endpoint is paused for the time
+ given by the Retry-After header, or by the X-RateLimit-Reset header, or
+ for a default pause, and a throttled 429 or 503 request is sent again once
+ the pause is over. These are the only resends of 429 and 503 responses;
+ the connection pool does not retry them itself. When X-RateLimit-Remaining runs low and the reset time is
+ known, the rate is also lowered so the remaining requests are spread over
+ the time left. Errors and connection failures halve the number of requests
+ in flight without pausing. Responses to requests that were already in
+ flight when the server pushed back lead to at most one decrease per round
+ trip.
+
+ """
+import collections
+import logging
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+from host_pool import host_of
+
+
+class TokenBucket:
+    """Token bucket handing out one token per request, at a rate of tokens
+     per second with up to burst tokens saved up. A rate of None does not
+     limit requests.
+    """
+
+    def __init__(self, rate=None, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        if self.rate is not None:
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def set_rate(self, rate, now=None):
+        self._refill(time.monotonic() if now is None else now)
+        self.rate = rate
+
+    def take(self, now=None):
+        """Take a token, returning 0 if one was available, or the number of
+         seconds to wait before trying again.
+        """
+        if now is None:
+            now = time.monotonic()
+        self._refill(now)
+        if self.rate is None or self._tokens >= 1:
+            self._tokens = max(0, self._tokens - 1)
+            return 0
+        return (1 - self._tokens) / self.rate
+
+
+def _header_seconds(value, now):
+    # Interpret a Retry-After style header as a number of seconds from now.
+    # X-RateLimit-Reset may also be an absolute Unix time.
+    if value is None:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - now)
+        except (TypeError, ValueError):
+            return None
+    if seconds > 1e9:
+        return max(0.0, seconds - now)
+    return max(0.0, seconds)
+
+
+class _Endpoint:
+    """Scheduling state for the requests to one endpoint. Guarded by the
+     scheduler's condition lock.
+    """
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.limit = float(concurrency)
+        self.active = 0
+        self.bucket = TokenBucket()
+        self.paused_until = 0.0
+        self.successes = 0
+        self.latency = None
+        self.fastest = None
+        self.increased = time.monotonic()
+        self.decreased = 0.0
+        # Completion times of recent requests, for measuring the rate achieved.
+        self.completed = collections.deque(maxlen=256)
+
+
+class Scheduler:
+    """Hands out request slots per endpoint, adapting the number of requests
+     in flight and the request rate to the responses.
+    """
+
+    def __init__(self, concurrency=16, max_concurrency=64, min_rate=0.2,
+                 rate_increase=1.0, latency_factor=3.0, default_pause=1.0,
+                 low_remaining=0.1):
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.min_rate = min_rate
+        self.rate_increase = rate_increase
+        self.latency_factor = latency_factor
+        self.default_pause = default_pause
+        self.low_remaining = low_remaining
+        self._cond = threading.Condition()
+        self._endpoints = {}
+
+    def endpoint(self, url):
+        name = host_of(url)
+        with self._cond:
+            endpoint = self._endpoints.get(name)
+            if endpoint is None:
+                endpoint = self._endpoints[name] = _Endpoint(name, self.concurrency)
+            return endpoint
+
+    def acquire(self, url):
+        """Wait for a slot to send a request to the URL, returning the
+         endpoint to pass to release when the response arrives.
+        """
+        endpoint = self.endpoint(url)
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                wait = endpoint.paused_until - now
+                if wait <= 0 and endpoint.active < int(endpoint.limit):
+                    wait = endpoint.bucket.take(now)
+                    if wait <= 0:
+                        endpoint.active += 1
+                        return endpoint
+                self._cond.wait(wait if wait > 0 else None)
+
+    def release(self, endpoint, elapsed, response=None, error=False):
+        """Record the outcome of a request and free its slot. Returns True if
+         the response was a throttling signal, so the request should be sent
+         again.
+        """
+        now = time.monotonic()
+        with self._cond:
+            endpoint.active -= 1
+            endpoint.completed.append(now)
+            throttled = False
+            if error or response is None:
+                self._decrease(endpoint, now, pause=None)
+            else:
+                throttled = self._observe(endpoint, response, elapsed, now)
+            self._cond.notify_all()
+        return throttled
+
+    def _achieved_rate(self, endpoint, now):
+        # The rate of requests completed over the last few seconds.
+        recent = [t for t in endpoint.completed if now - t <= 5.0]
+        if len(recent) < 2:
+            return None
+        return len(recent) / max(now - recent[0], 1e-3)
+
+    def _decrease(self, endpoint, now, pause=None):
+        # Requests already in flight when the server pushed back report the
+        # same condition, so decrease at most once per round trip.
+        if now - endpoint.decreased < (endpoint.latency or 1.0):
+            if pause is not None:
+                endpoint.paused_until = max(endpoint.paused_until, now + pause)
+            return
+        endpoint.decreased = now
+        endpoint.limit = max(1.0, endpoint.limit / 2)
+        endpoint.successes = 0
+        if pause is not None:
+            endpoint.paused_until = max(endpoint.paused_until, now + pause)
+            rates = [rate for rate in (self._achieved_rate(endpoint, now), endpoint.bucket.rate)
+                     if rate is not None]
+            new_rate = min(rates) / 2 if rates else self.min_rate
+            endpoint.bucket.set_rate(max(self.min_rate, new_rate), now)
+            endpoint.increased = now
+        logging.info('Throttling %s to %d requests in flight at %s requests per second',
+                     endpoint.name, int(endpoint.limit),
+                     'any' if endpoint.bucket.rate is None else f'{endpoint.bucket.rate:.2f}')
+
+    def _increase(self, endpoint, elapsed, now):
+        if endpoint.latency is None:
+            endpoint.latency = elapsed
+        else:
+            endpoint.latency = 0.8 * endpoint.latency + 0.2 * elapsed
+        endpoint.fastest = elapsed if endpoint.fastest is None else min(endpoint.fastest, elapsed)
+        if endpoint.latency > self.latency_factor * max(endpoint.fastest, 0.01):
+            return
+        endpoint.successes += 1
+        if endpoint.successes >= int(endpoint.limit) and endpoint.limit < self.max_concurrency:
+            endpoint.limit += 1
+            endpoint.successes = 0
+        if endpoint.bucket.rate is not None:
+            endpoint.bucket.set_rate(endpoint.bucket.rate
+                                     + self.rate_increase * (now - endpoint.increased), now)
+        endpoint.increased = now
+
+    def _observe(self, endpoint, response, elapsed, now):
+        headers = response.headers
+        wall_now = time.time()
+        retry_after = _header_seconds(headers.get('Retry-After'), wall_now)
+        reset = _header_seconds(headers.get('X-RateLimit-Reset'), wall_now)
+        remaining = headers.get('X-RateLimit-Remaining')
+        limit = headers.get('X-RateLimit-Limit')
+        try:
+            remaining = None if remaining is None else int(remaining)
+            limit = None if limit is None else int(limit)
+        except ValueError:
+            remaining = limit = None
+
+        if response.status_code in (429, 503) or remaining == 0:
+            pause = retry_after if retry_after is not None else reset
+            self._decrease(endpoint, now, self.default_pause if pause is None else pause)
+            return response.status_code in (429, 503)
+
+        if response.status_code >= 500:
+            self._decrease(endpoint, now)
+            return False
+
+        if (remaining is not None and limit and reset
+                and remaining <= self.low_remaining * limit):
+            # Spread the remaining requests over the time left.
+            endpoint.bucket.set_rate(max(self.min_rate, remaining / reset), now)
+            return False
+
+        self._increase(endpoint, elapsed, now)
+        return False
@@ -0,0 +1,78 @@
+"""Splitting full-catalog scans into shards run by separate processes.
+ A scan run with --shard i/N handles only the i-th of N disjoint slices of
+ the work, with i counted from 0, so the slices can be scanned by a pool of
+ processes on one host or spread across several hosts. The catalog listing
+ is split by page: shard i requests pages i, i + N, i + 2N and so on (see
+ paginator.iter_pages). Scans that compare the catalog against another
+ list, such as the distributions in a DCAT-US file, split only the catalog,
+ and each shard reads the whole of the other list, so every pair is still
+ compared by exactly one shard.
+
+ Each shard writes its results to a partial output file, recording the kind
+ of scan, the shard and the options that must agree across shards. The
+ merge_shards.py script checks that a complete, consistent set of partial
+ files is passed and combines them.
+
+ """
+import argparse
+import json
+import os
+
+
+def parse_shard(text):
+    """Parse a shard given as "i/N" into an (index, count) pair. Suitable as
+     an argparse type.
+    """
+    try:
+        index, count = (int(part) for part in text.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'A shard is given as i/N, not {text!r}.')
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'The shard index must be from 0 to N - 1, not {text!r}.')
+    return index, count
+
+
+def shard_label(shard):
+    """Return a label for a shard, for use in file names.
+    """
+    index, count = shard
+    return f'shard-{index}-of-{count}'
+
+
+def write_partial(file_name, kind, shard, options, results):
+    """Write the results of one shard of a scan to a partial output file.
+     The options are the settings that must match across the shards.
+    """
+    temp_name = file_name + '.tmp'
+    with open(temp_name, 'w') as output_file:
+        json.dump({'kind': kind, 'shard': list(shard), 'options': options,
+                   'results': results}, output_file)
+    os.replace(temp_name, file_name)
+
+
+def read_partials(file_names):
+    """Read the partial output files of a scan, returning the kind of scan,
+     its options and the results of each shard in shard order. Raises
+     ValueError unless the files hold every shard of one scan exactly once.
+    """
+    partials = []
+    for file_name in file_names:
+        with open(file_name, 'r') as input_file:
+            partials.append(json.load(input_file))
+    if not partials:
+        raise ValueError('No partial output files were passed.')
+    first = partials[0]
+    count = first['shard'][1]
+    for partial in partials:
+        if partial['kind'] != first['kind'] or partial['options'] != first['options']:
+            raise ValueError('The partial output files are from different scans.')
+        if partial['shard'][1] != count:
+            raise ValueError('The partial output files are from scans split into different numbers of shards.')
+    indexes = sorted(partial['shard'][0] for partial in partials)
+    if indexes != list(range(count)):
+        missing = sorted(set(range(count)) - set(indexes))
+        repeated = sorted(set(i for i in indexes if indexes.count(i) > 1))
+        raise ValueError(f'Expected shards 0 to {count - 1} once each; '
+                         f'missing {missing}, repeated {repeated}.')
+    partials.sort(key=lambda partial: partial['shard'][0])
+    return first['kind'], first['options'], [partial['results'] for partial in partials]
@@ -0,0 +1,226 @@
+"""Python command-line script for comparing two metadata snapshots written by
+retrieve_all_metadata.py.
+ The datasets in the two snapshots are matched by id, and each dataset that
+ was added, removed or modified between them is written as a line of
+ newline-delimited JSON:
+
+     {"change": "added", "id": ..., "name": ...}
+     {"change": "removed", "id": ..., "name": ...}
+     {"change": "modified", "id": ..., "name": ...,
+      "fields": [{"field": ..., "old": ..., "new": ...}, ...]}
+
+ For modified datasets, each top-level field that differs is listed with its
+ old and new values. A field missing from one of the snapshots is left out
+ of that side. Fields named with --ignore, such as metadata_modified, are
+ not compared.
+
+ Memory use does not depend on the size of the snapshots. Each dataset is
+ reduced to its id, a SHA-256 digest of its canonical JSON (with sorted keys
+ and without the ignored fields) and the canonical JSON itself. The
+ datasets of each snapshot are sorted by id in runs of up to --run-mb
+ megabytes of canonical JSON, which are written to temporary files, and the
+ runs are merged as they are read. When there are more runs than can be
+ open at once, groups of them are first merged into longer runs. The two
+ sorted streams are then merged by id, and only datasets whose digests
+ differ are decoded again to compare their fields.
+
+ Example: list the changes between two daily snapshots, ignoring the
+ modification times.
+
+     python snapshot_diff.py catalog-0501.ndjson.gz catalog-0502.ndjson.gz \\
+       -i metadata_modified -o changes.ndjson
+
+ """
+import argparse
+import hashlib
+import heapq
+import json
+import logging
+import os
+import tempfile
+from operator import itemgetter
+
+import ndjson
+from columnar_export import read_snapshot
+
+# The number of megabytes of canonical JSON sorted in memory at a time.
+_DEFAULT_RUN_MB = 64
+
+# The largest number of runs merged at the same time, keeping the number of
+# open files well within the usual limits.
+_MAX_OPEN_RUNS = 128
+
+
+def canonical(dataset, ignore=()):
+    """Return the canonical JSON text of a dataset, with sorted keys and
+     without the ignored fields.
+    """
+    if ignore:
+        dataset = {key: value for key, value in dataset.items() if key not in ignore}
+    return json.dumps(dataset, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+def _write_run(entries, temp_dir):
+    # The canonical JSON holds no raw tabs or newlines, so each entry is
+    # written as one tab-separated line.
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=temp_dir, suffix='.run',
+                                     delete=False) as run_file:
+        for package_id, digest, text in entries:
+            run_file.write(f'{json.dumps(package_id)}\t{digest}\t{text}\n')
+    return run_file.name
+
+
+def _read_run(run_file):
+    for line in run_file:
+        package_id, digest, text = line.rstrip('\n').split('\t', 2)
+        yield json.loads(package_id), digest, text
+
+
+def _merge_runs(run_names, temp_dir):
+    # Merge groups of runs into longer runs, in place, until they can all be
+    # opened at the same time. Merged runs are removed.
+    while len(run_names) > _MAX_OPEN_RUNS:
+        group = run_names[:_MAX_OPEN_RUNS]
+        del run_names[:_MAX_OPEN_RUNS]
+        run_files = [open(run_name, 'r', encoding='utf-8') for run_name in group]
+        try:
+            merged = _write_run(heapq.merge(*(_read_run(run_file) for run_file in run_files),
+                                            key=itemgetter(0)), temp_dir)
+        finally:
+            for run_file in run_files:
+                run_file.close()
+            for run_name in group:
+                os.remove(run_name)
+        run_names.append(merged)
+
+
+def sorted_entries(snapshot_file_name, ignore=(), run_mb=_DEFAULT_RUN_MB, temp_dir=None):
+    """Yield (id, digest, canonical JSON) entries for the datasets in a
+     snapshot, in id order, holding at most about run_mb megabytes of
+     canonical JSON in memory.
+    """
+    run_limit = run_mb * 1024 * 1024
+    run = []
+    run_length = 0
+    run_names = []
+    skipped = 0
+    try:
+        for dataset in read_snapshot(snapshot_file_name):
+            if dataset.get('id') is None:
+                skipped += 1
+                continue
+            text = canonical(dataset, ignore)
+            run.append((dataset['id'], hashlib.sha256(text.encode('utf-8')).hexdigest(), text))
+            run_length += len(text)
+            if run_length >= run_limit:
+                run.sort(key=itemgetter(0))
+                run_names.append(_write_run(run, temp_dir))
+                run = []
+                run_length = 0
+        if skipped:
+            logging.warning('Skipped %d datasets without an id in %s', skipped, snapshot_file_name)
+        run.sort(key=itemgetter(0))
+        if not run_names:
+            yield from run
+            return
+        if run:
+            run_names.append(_write_run(run, temp_dir))
+            run = []
+        logging.info('Merging %d sorted runs of %s', len(run_names), snapshot_file_name)
+        _merge_runs(run_names, temp_dir)
+        run_files = [open(run_name, 'r', encoding='utf-8') for run_name in run_names]
+        try:
+            yield from heapq.merge(*(_read_run(run_file) for run_file in run_files),
+                                   key=itemgetter(0))
+        finally:
+            for run_file in run_files:
+                run_file.close()
+    finally:
+        for run_name in run_names:
+            os.remove(run_name)
+
+
+def field_differences(old, new):
+    """Return the top-level fields that differ between two versions of a
+     dataset, as a list of dictionaries with the field name and the old and
+     new values, in field name order.
+    """
+    differences = []
+    for field in sorted(set(old) | set(new)):
+        if old.get(field) != new.get(field) or (field in old) != (field in new):
+            difference = {'field': field}
+            if field in old:
+                difference['old'] = old[field]
+            if field in new:
+                difference['new'] = new[field]
+            differences.append(difference)
+    return differences
+
+
+def diff_snapshots(old_file_name, new_file_name, ignore=(), run_mb=_DEFAULT_RUN_MB,
+                   temp_dir=None):
+    """Yield a change record for each dataset added, removed or modified
+     between two snapshots, in id order.
+    """
+    old_entries = sorted_entries(old_file_name, ignore, run_mb, temp_dir)
+    new_entries = sorted_entries(new_file_name, ignore, run_mb, temp_dir)
+    old = next(old_entries, None)
+    new = next(new_entries, None)
+    while old is not None or new is not None:
+        if new is None or (old is not None and old[0] < new[0]):
+            yield {'change': 'removed', 'id': old[0], 'name': json.loads(old[2]).get('name')}
+            old = next(old_entries, None)
+        elif old is None or new[0] < old[0]:
+            yield {'change': 'added', 'id': new[0], 'name': json.loads(new[2]).get('name')}
+            new = next(new_entries, None)
+        else:
+            if old[1] != new[1]:
+                old_dataset = json.loads(old[2])
+                new_dataset = json.loads(new[2])
+                yield {'change': 'modified', 'id': new[0], 'name': new_dataset.get('name'),
+                       'fields': field_differences(old_dataset, new_dataset)}
+            old = next(old_entries, None)
+            new = next(new_entries, None)
+
+
+def write_changes(changes, output_file_name):
+    """Write change records as newline-delimited JSON, returning the number
+     of each kind of change.
+    """
+    counts = {'added': 0, 'removed': 0, 'modified': 0}
+    with ndjson.open_output(output_file_name) as output_file:
+        for change in changes:
+            ndjson.write_record(output_file, change)
+            counts[change['change']] += 1
+    return counts
+
+
+if __name__ == '__main__':
+
+    logging.basicConfig(level=os.environ.get("LOGLEVEL",logging.INFO))
+
+    ap = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+        description='''List the datasets added, removed and modified between two metadata snapshots.
+''')
+    ap.add_argument('old_file_name',
+        help='The earlier snapshot written by retrieve_all_metadata.py, as JSON or '
+             'newline-delimited JSON.')
+    ap.add_argument('new_file_name',
+        help='The later snapshot written by retrieve_all_metadata.py, as JSON or '
+             'newline-delimited JSON.')
+    ap.add_argument('-o', '--output', dest='output', default='-',
+        help='The file for the changes, as newline-delimited JSON, compressed if the name ends '
+             'in ".gz". Defaults to standard output.')
+    ap.add_argument('-i', '--ignore', dest='ignore', action='append', default=[],
+        help='A field not to compare, such as metadata_modified. May be given more than once.')
+    ap.add_argument('--run-mb', dest='run_mb', default=_DEFAULT_RUN_MB, type=float,
+        help='The number of megabytes of dataset metadata sorted in memory at a time.')
+    ap.add_argument('--temp-dir', dest='temp_dir', default=None,
+        help='The directory for the sorted runs. Defaults to the system temporary directory.')
+    args = ap.parse_args()
+
+    counts = write_changes(diff_snapshots(args.old_file_name, args.new_file_name,
+                                          set(args.ignore), args.run_mb, args.temp_dir),
+                           args.output)
+    logging.info('Added %d, removed %d and modified %d datasets',
+                 counts['added'], counts['removed'], counts['modified'])
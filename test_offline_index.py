@@ -0,0 +1,51 @@
+"""Tests for the range queries of the offline index.
+ Run with: python -m unittest test_offline_index
+ """
+import json
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+import offline_index
+
+
+class RangeQueryTest(unittest.TestCase):
+
+    def setUp(self):
+        # Ten datasets modified a minute apart from 01:00, stored with
+        # microseconds as package_show returns them.
+        self.temp_dir = tempfile.TemporaryDirectory()
+        snapshot_file_name = os.path.join(self.temp_dir.name, 'catalog.ndjson')
+        with open(snapshot_file_name, 'w') as snapshot_file:
+            for i in range(10):
+                modified = datetime(2020, 1, 1, 1) + timedelta(minutes=i)
+                snapshot_file.write(json.dumps({
+                    'id': f'id-{i}', 'name': f'dataset-{i}',
+                    'metadata_modified': modified.isoformat(timespec='microseconds')}) + '\n')
+        self.index = offline_index.open_index(snapshot_file_name)
+
+    def tearDown(self):
+        self.index.close()
+        self.temp_dir.cleanup()
+
+    def count(self, fq):
+        return self.index.call_action('package_search', {'q': '*:*', 'fq': fq})['count']
+
+    def test_inclusive_bounds_include_timestamps_on_the_bound(self):
+        self.assertEqual(self.count(
+            'metadata_modified:[2020-01-01T01:00:00Z TO 2020-01-01T01:05:00Z]'), 6)
+
+    def test_exclusive_bounds_exclude_timestamps_on_the_bound(self):
+        self.assertEqual(self.count(
+            'metadata_modified:{2020-01-01T01:00:00Z TO 2020-01-01T01:05:00Z}'), 4)
+
+    def test_fractional_bounds(self):
+        self.assertEqual(self.count(
+            'metadata_modified:[2020-01-01T01:04:59.999Z TO *]'), 5)
+        self.assertEqual(self.count(
+            'metadata_modified:[* TO 2020-01-01T01:05:00.000Z}'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,229 @@
+"""Shared HTTP transport for the scripts in this repository.
+ Every CKAN API call and every request for a data file goes through a single
+ requests.Session, so connections are kept alive and reused rather than
+ paying for a new TCP and TLS handshake on each request.
+
+ The session is set up in one place:
+ - The connection pool keeps up to HTTP_POOL_SIZE connections per host
+   (default 32), for up to the same number of hosts.
+ - Connection errors and 500, 502, 503 and 504 responses are retried up to
+   HTTP_RETRIES times (default 3), backing off exponentially from
+   HTTP_BACKOFF seconds (default 0.5) and honoring any Retry-After header.
+ - Responses are requested with gzip or deflate compression.
+ - Requests that do not set their own timeout wait at most HTTP_TIMEOUT
+   seconds (default 60) for the server.
+ - Requests are scheduled per host by an adaptive scheduler (see
+   scheduler.py), starting at HTTP_HOST_CONCURRENCY requests in flight
+   (default 16) and adjusting to the throttling signals of the server, up
+   to HTTP_MAX_HOST_CONCURRENCY (default 64). Throttled requests are sent
+   again, up to HTTP_RETRIES times, once the server allows. Setting
+   HTTP_ADAPTIVE to 0 turns the scheduler off.
+ - When instrumentation is enabled (see metrics.py), every request and every
+   CKAN action call is recorded.
+ The values in parentheses can be changed with environment variables of the
+ same names, or by calling configure() before the session is first used.
+
+ """
+import logging
+import os
+import threading
+import time
+
+import ckanapi
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+import metrics
+from scheduler import Scheduler
+
+_settings = {
+    'pool_size': int(os.getenv('HTTP_POOL_SIZE', 32)),
+    'retries': int(os.getenv('HTTP_RETRIES', 3)),
+    'backoff': float(os.getenv('HTTP_BACKOFF', 0.5)),
+    'timeout': float(os.getenv('HTTP_TIMEOUT', 60)),
+    'adaptive': os.getenv('HTTP_ADAPTIVE', '1') not in ('0', 'false', 'no'),
+    'host_concurrency': int(os.getenv('HTTP_HOST_CONCURRENCY', 16)),
+    'max_host_concurrency': int(os.getenv('HTTP_MAX_HOST_CONCURRENCY', 64)),
+}
+
+_lock = threading.Lock()
+_session = None
+
+
+class _Session(requests.Session):
+    """Session applying the default timeout to requests that do not set one,
+     and sending each request when the scheduler, if any, allows.
+    """
+
+    def __init__(self, timeout, scheduler=None, retries=0):
+        super().__init__()
+        self.timeout = timeout
+        self.scheduler = scheduler
+        self.retries = retries
+
+    def request(self, method, url, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+        if not metrics.enabled:
+            return self._send(method, url, kwargs)[0]
+        start = time.monotonic()
+        try:
+            response, resent = self._send(method, url, kwargs)
+        except Exception:
+            metrics.observe('request', metrics.request_label(method, url),
+                            time.monotonic() - start, error=True)
+            raise
+        metrics.observe('request', metrics.request_label(method, url),
+                        time.monotonic() - start, _response_bytes(response, kwargs),
+                        error=response.status_code >= 400,
+                        retries=resent + _retry_count(response),
+                        status=response.status_code)
+        return response
+
+    def _send(self, method, url, kwargs):
+        # Send the request, returning the response and the number of times
+        # it was sent again after being throttled.
+        if self.scheduler is None:
+            return super().request(method, url, **kwargs), 0
+        attempt = 0
+        while True:
+            endpoint = self.scheduler.acquire(url)
+            start = time.monotonic()
+            try:
+                response = super().request(method, url, **kwargs)
+            except Exception:
+                self.scheduler.release(endpoint, time.monotonic() - start, error=True)
+                raise
+            throttled = self.scheduler.release(endpoint, time.monotonic() - start, response)
+            if not throttled or attempt >= self.retries:
+                return response, attempt
+            attempt += 1
+            logging.info('Request to %s was throttled, sending it again', url)
+            response.close()
+
+
+def _response_bytes(response, kwargs):
+    # The size of a response body. Streamed bodies have not been read yet,
+    # so their Content-Length is used instead, if given.
+    if not kwargs.get('stream'):
+        return len(response.content)
+    try:
+        return int(response.headers.get('Content-Length'))
+    except (TypeError, ValueError):
+        return None
+
+
+def _retry_count(response):
+    # The number of times urllib3 retried the request.
+    retries = getattr(response.raw, 'retries', None)
+    return len(retries.history) if retries is not None else 0
+
+
+class _SchedulerRetry(Retry):
+    """Retry policy leaving 429 and 503 responses to the scheduler, which
+     spreads the pause across every request to the host rather than just
+     this one.
+    """
+    RETRY_AFTER_STATUS_CODES = frozenset([413])
+
+
+def create_session(pool_size=None, retries=None, backoff=None, timeout=None, adaptive=None):
+    """Create a session with pooled connections, retries, compression, a
+     default timeout and adaptive scheduling. Settings not passed are taken
+     from the module settings.
+    """
+    pool_size = pool_size or _settings['pool_size']
+    retries = _settings['retries'] if retries is None else retries
+    backoff = _settings['backoff'] if backoff is None else backoff
+    timeout = timeout or _settings['timeout']
+    adaptive = _settings['adaptive'] if adaptive is None else adaptive
+
+    retry_class = _SchedulerRetry if adaptive else Retry
+    # With the scheduler, 503 responses are sent again by the session only,
+    # so an overloaded server is not retried in two layers.
+    status_forcelist = (500, 502, 504) if adaptive else (500, 502, 503, 504)
+    retry = retry_class(total=retries, connect=retries, read=retries, status=retries,
+                        backoff_factor=backoff,
+                        status_forcelist=status_forcelist,
+                        # The CKAN actions used here only read data, so it is
+                        # safe to retry them even though they are sent as POST
+                        # requests.
+                        allowed_methods=frozenset(['HEAD', 'GET', 'POST', 'OPTIONS']),
+                        respect_retry_after_header=True,
+                        raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    scheduler = None
+    if adaptive:
+        scheduler = Scheduler(concurrency=_settings['host_concurrency'],
+                              max_concurrency=_settings['max_host_concurrency'])
+    session = _Session(timeout, scheduler, retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['Accept-Encoding'] = 'gzip, deflate'
+    return session
+
+
+def configure(**settings):
+    """Change the transport settings. The shared session is recreated the
+     next time it is used.
+    """
+    global _session
+    with _lock:
+        for key, value in settings.items():
+            if key not in _settings:
+                raise ValueError(f'Unknown transport setting {key}')
+            if value is not None:
+                _settings[key] = value
+        if _session is not None:
+            _session.close()
+            _session = None
+
+
+def get_session():
+    """Return the shared session, creating it on first use.
+    """
+    global _session
+    with _lock:
+        if _session is None:
+            _session = create_session()
+            logging.debug('Created shared HTTP session with settings %s', _settings)
+        return _session
+
+
+class RemoteCKAN(ckanapi.RemoteCKAN):
+    """CKAN API client using the shared session and default timeout.
+    """
+
+    def __init__(self, address, apikey=None, **kwargs):
+        kwargs.setdefault('session', get_session())
+        super().__init__(address, apikey, **kwargs)
+
+    def call_action(self, action, data_dict=None, context=None, apikey=None,
+                    files=None, requests_kwargs=None):
+        requests_kwargs = dict(requests_kwargs or {})
+        if requests_kwargs.get('timeout') is None:
+            requests_kwargs['timeout'] = _settings['timeout']
+        if not metrics.enabled:
+            return super().call_action(action, data_dict, context, apikey, files,
+                                       requests_kwargs)
+        start = time.monotonic()
+        try:
+            result = super().call_action(action, data_dict, context, apikey, files,
+                                         requests_kwargs)
+        except Exception:
+            metrics.observe('action', action, time.monotonic() - start, error=True)
+            raise
+        metrics.observe('action', action, time.monotonic() - start)
+        return result
+
+    def close(self):
+        # The shared session outlives any one client.
+        self.session = None
+
+
+def remote_ckan(url, api_key=None):
+    """Create a CKAN API client for the passed URL, sharing the pooled session.
+    """
+    return RemoteCKAN(url, api_key)
@@ -0,0 +1,192 @@
+"""Persistent cache of HTTP validators, sizes and content digests for remote data files.
+ The cache is a SQLite database keyed by URL. Each entry records the
+ Content-Length, ETag and Last-Modified values returned the last time the
+ URL was probed, along with the time of the probe and the time the entry was
+ last used. Entries for files that have been downloaded in full also record
+ a digest of the contents and the time of the download. The digest is
+ discarded whenever a later probe returns different validators.
+
+ Entries probed within the time-to-live are considered fresh and can be used
+ without contacting the server. Stale entries keep their validators, so the
+ next probe can be a conditional request that the server answers with a
+ short 304 response when the file has not changed.
+
+ Entries that have not been used for longer than the maximum age are evicted
+ when the cache is closed. If a maximum number of entries is set, the least
+ recently used entries beyond that number are evicted as well.
+
+ Several processes can share one cache file, such as the shards of a scan
+ run with --shard (see sharding.py). The database uses write-ahead logging,
+ so readers never wait for writers, and each write is committed straight
+ away, so no process holds the write lock for long. Lookups do not write:
+ the times entries were used are kept in memory and recorded in batches.
+
+ """
+import logging
+import sqlite3
+import threading
+import time
+
+_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS urls (
+    url TEXT PRIMARY KEY,
+    content_length INTEGER,
+    etag TEXT,
+    last_modified TEXT,
+    probed REAL,
+    used REAL,
+    digest BLOB,
+    fetched REAL
+);
+CREATE INDEX IF NOT EXISTS urls_used ON urls (used);
+'''
+
+# Columns added since the first version of the schema, with their types.
+_ADDED_COLUMNS = [('digest', 'BLOB'), ('fetched', 'REAL')]
+
+# The number of lookups whose use times are kept before recording them.
+_USED_INTERVAL = 100
+
+# The number of seconds to wait for another process to finish writing.
+_BUSY_TIMEOUT = 60
+
+
+class UrlCache:
+    """On-disk cache of URL probe results, safe to share between threads.
+    """
+
+    def __init__(self, path, ttl=24*3600, max_age=30*24*3600, max_entries=None):
+        self.ttl = ttl
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._used = {}
+        self._db = sqlite3.connect(path, timeout=_BUSY_TIMEOUT, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(_SCHEMA)
+        columns = [row['name'] for row in self._db.execute('PRAGMA table_info(urls)')]
+        for name, type in _ADDED_COLUMNS:
+            if name not in columns:
+                self._db.execute(f'ALTER TABLE urls ADD COLUMN {name} {type}')
+        self._db.commit()
+
+    def get(self, url):
+        """Return the cached entry for a URL as a dictionary, or None if the
+         URL has not been probed before. Marks the entry as used.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT * FROM urls WHERE url = ?',
+                                   (url,)).fetchone()
+            if row is None:
+                return None
+            self._used[url] = time.time()
+            if len(self._used) >= _USED_INTERVAL:
+                self._record_used()
+            return dict(row)
+
+    def is_fresh(self, entry, now=None):
+        """Check whether a cached entry was probed within the time-to-live.
+        """
+        if now is None:
+            now = time.time()
+        return entry.get('probed') is not None and now - entry['probed'] < self.ttl
+
+    def has_fresh_digest(self, entry, now=None):
+        """Check whether a cached entry has a digest downloaded within the time-to-live.
+        """
+        if now is None:
+            now = time.time()
+        return (entry.get('digest') is not None and entry.get('fetched') is not None
+                and now - entry['fetched'] < self.ttl)
+
+    def put(self, url, content_length=None, etag=None, last_modified=None, probed=None):
+        """Record the result of probing a URL. Any digest already recorded is
+         kept only if the validators are unchanged.
+        """
+        now = time.time()
+        if probed is None:
+            probed = now
+        with self._lock:
+            self._db.execute('INSERT INTO urls '
+                             '(url, content_length, etag, last_modified, probed, used) '
+                             'VALUES (?, ?, ?, ?, ?, ?) '
+                             'ON CONFLICT (url) DO UPDATE SET '
+                             'digest = CASE WHEN etag IS excluded.etag '
+                             'AND last_modified IS excluded.last_modified '
+                             'AND content_length IS excluded.content_length '
+                             'THEN digest ELSE NULL END, '
+                             'content_length = excluded.content_length, '
+                             'etag = excluded.etag, '
+                             'last_modified = excluded.last_modified, '
+                             'probed = excluded.probed, '
+                             'used = excluded.used',
+                             (url, content_length, etag, last_modified, probed, now))
+            self._written()
+
+    def put_digest(self, url, digest, content_length=None, etag=None,
+                   last_modified=None, fetched=None):
+        """Record the digest of the contents downloaded from a URL, along with
+         the validators returned with the download. The content_length is the
+         Content-Length header of the download, as recorded by put.
+        """
+        now = time.time()
+        if fetched is None:
+            fetched = now
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO urls '
+                             '(url, content_length, etag, last_modified, probed, used, digest, fetched) '
+                             'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                             (url, content_length, etag, last_modified, fetched, now,
+                              digest, fetched))
+            self._written()
+
+    def _written(self):
+        # Called with the lock held. Commit straight away, so other processes
+        # sharing the file are not kept waiting for the write lock.
+        self._db.commit()
+
+    def _record_used(self):
+        # Called with the lock held. Record the use times of the entries
+        # looked up since the last time.
+        if self._used:
+            self._db.executemany('UPDATE urls SET used = MAX(COALESCE(used, 0), ?) WHERE url = ?',
+                                 [(used, url) for url, used in self._used.items()])
+            self._db.commit()
+            self._used = {}
+
+    def evict(self, now=None):
+        """Remove entries unused for longer than the maximum age, then the
+         least recently used entries beyond the maximum number of entries.
+        """
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._record_used()
+            removed = 0
+            if self.max_age is not None:
+                removed += self._db.execute('DELETE FROM urls WHERE used < ?',
+                                            (now - self.max_age,)).rowcount
+            if self.max_entries is not None:
+                removed += self._db.execute(
+                    'DELETE FROM urls WHERE url IN '
+                    '(SELECT url FROM urls ORDER BY used DESC LIMIT -1 OFFSET ?)',
+                    (self.max_entries,)).rowcount
+            self._db.commit()
+        if removed:
+            logging.info('Evicted %d entries from the URL cache.', removed)
+        return removed
+
+    def close(self):
+        """Evict expired entries and close the database.
+        """
+        self.evict()
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()